@@ -21,6 +21,8 @@ cd = CondaDependencies.create(
     conda_packages=["numpy", "cython", "pandas", "scikit-learn"],
     pip_packages=[
         "azureml-defaults",
+        "azureml-contrib-services",
+        "msgpack",
         "inference-schema[numpy-support]",
         "joblib==0.13.*",
         "azureml-dataprep[pandas, fuse]",
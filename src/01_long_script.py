@@ -97,7 +97,7 @@ logger.info("Training Completed")
 
 model = run.register_model(
     model_name=MODELNAME,
-    model_path=os.path.join("outputs", MODELFILENAME),
+    model_path=os.path.join("outputs", "model"),
     tags={
         "area": "freezerchain",
         "type": "classification",
@@ -28,19 +28,24 @@ logger.info("Environment complete")
 
 # PIPELINE PARAMS
 
-output_df_long = PipelineData("output_df_long", datastore=ws.get_default_datastore())
-output_df_nested = PipelineData(
-    "output_df_nested", datastore=ws.get_default_datastore()
+output_panel = PipelineData("output_panel", datastore=ws.get_default_datastore())
+output_labeled_panel = PipelineData(
+    "output_labeled_panel", datastore=ws.get_default_datastore()
 )
 time_series_length_param = PipelineParameter(
     name="time_series_length", default_value=10
 )
 threshold_param = PipelineParameter(name="threshold", default_value=180.0)
+panel_dtype_param = PipelineParameter(name="panel_dtype", default_value="float64")
 dataset_name_param = PipelineParameter(
     name="dataset_name", default_value="processed_json"
 )
 n_estimators_param = PipelineParameter(name="n_estimators", default_value=10)
 train_data_split_param = PipelineParameter(name="train_data_split", default_value=0.8)
+# Trains from scratch by default. With warm_start=True training adds trees for the cases the
+# registered model has not seen, up to max_estimators.
+warm_start_param = PipelineParameter(name="warm_start", default_value=False)
+max_estimators_param = PipelineParameter(name="max_estimators", default_value=100)
 redeploy_webservice_param = PipelineParameter(name="redeploy", default_value=True)
 webservicename_param = PipelineParameter(
     name="webservice", default_value="freezerchain-prediction-v0-2"
@@ -66,11 +71,13 @@ first_prepro_step = PythonScriptStep(
         "--dataset_name",
         dataset_name_param,
         "--output",
-        output_df_long,
+        output_panel,
         "--time_series_length",
         time_series_length_param,
+        "--dtype",
+        panel_dtype_param,
     ],
-    outputs=[output_df_long],
+    outputs=[output_panel],
     compute_target=compute_target,
     source_directory="src/preprocess",
     runconfig=run_config,
@@ -78,18 +85,18 @@ first_prepro_step = PythonScriptStep(
 )
 
 second_prepro_step = PythonScriptStep(
-    name="Convert to SKTime format",
+    name="Label dataset",
     script_name="02_long_to_nested.py",
     arguments=[
         "--input",
-        output_df_long,
+        output_panel,
         "--output",
-        output_df_nested,
+        output_labeled_panel,
         "--threshold",
         threshold_param,
     ],
-    inputs=[output_df_long],
-    outputs=[output_df_nested],
+    inputs=[output_panel],
+    outputs=[output_labeled_panel],
     compute_target=compute_target,
     source_directory="src/preprocess",
     runconfig=run_config,
@@ -106,14 +113,18 @@ estimator_step = EstimatorStep(
     ),
     estimator_entry_script_arguments=[
         "--input",
-        output_df_nested,
+        output_labeled_panel,
         "--n_estimators",
         n_estimators_param,
         "--train_data_split",
         train_data_split_param,
+        "--warm_start",
+        warm_start_param,
+        "--max_estimators",
+        max_estimators_param,
     ],
     runconfig_pipeline_params=None,
-    inputs=[output_df_nested],
+    inputs=[output_labeled_panel],
     compute_target=compute_target,
     allow_reuse=True,
 )
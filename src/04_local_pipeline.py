@@ -0,0 +1,323 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# PREPARE LOGGING
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# LOCAL PIPELINE
+
+
+class LocalData:
+    # Stand-in for PipelineData: a directory produced by one step and consumed by others.
+    # The path is only known once the producing step ran or was found in the cache.
+    def __init__(self, name):
+        self.name = name
+        self.path = None
+
+
+class LocalPath:
+    # An external input such as the raw partitions. It is fingerprinted by file names, sizes and
+    # modification times, so appending a partition invalidates the steps reading it.
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+
+class LocalStep:
+    # Stand-in for PythonScriptStep / EstimatorStep, run as a plain process
+    def __init__(
+        self,
+        name,
+        script_name,
+        source_directory,
+        arguments=(),
+        inputs=(),
+        outputs=(),
+        allow_reuse=True,
+    ):
+        self.name = name
+        self.script_name = script_name
+        self.source_directory = os.path.join(SRC_DIR, source_directory)
+        self.arguments = list(arguments)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.allow_reuse = allow_reuse
+        self.run_after_steps = []
+
+    def run_after(self, step):
+        self.run_after_steps.append(step)
+
+
+def _digest_directory(path, digest, content=True):
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in ("__pycache__", "outputs"))
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            digest.update(os.path.relpath(file_path, path).encode() + b"\0")
+            if content:
+                with open(file_path, "rb") as fh:
+                    for block in iter(lambda: fh.read(1 << 20), b""):
+                        digest.update(block)
+            else:
+                stat = os.stat(file_path)
+                digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+            digest.update(b"\0")
+
+
+def step_key(step):
+    # Content address of a step: its source folder, script, arguments and input data. Inputs are
+    # hashed by content, so an upstream re-run that produces identical data keeps this step cached.
+    digest = hashlib.sha256()
+    _digest_directory(step.source_directory, digest)
+    digest.update(step.script_name.encode() + b"\0")
+    for argument in step.arguments:
+        if isinstance(argument, LocalData):
+            if argument in step.outputs:
+                digest.update(f"output:{argument.name}".encode())
+            else:
+                _digest_directory(argument.path, digest)
+        elif isinstance(argument, LocalPath):
+            _digest_directory(argument.path, digest, content=False)
+        else:
+            digest.update(json.dumps(argument).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+class LocalPipeline:
+    # Runs steps as soon as all their inputs and run_after steps are done, up to max_workers at a time.
+    # Step results are stored in cache_dir/<step key>/: one folder per output, the "outputs" folder of
+    # the run and the step log. Steps with allow_reuse=True are skipped when their key is cached.
+    def __init__(self, steps, cache_dir, max_workers=None, python=sys.executable):
+        self.steps = steps
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.python = python
+        self._producers = {output: step for step in steps for output in step.outputs}
+
+    def dependencies(self, step):
+        producers = [
+            self._producers[data] for data in step.inputs if data in self._producers
+        ]
+        return set(producers + step.run_after_steps)
+
+    def run(self):
+        pending = list(self.steps)
+        done, results = set(), {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for step in [s for s in pending if self.dependencies(s) <= done]:
+                    pending.remove(step)
+                    running[executor.submit(self.execute, step)] = step
+                if not running:
+                    raise ValueError(
+                        f"Unsatisfiable dependencies: {[s.name for s in pending]}"
+                    )
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    results[step.name] = future.result()
+                    done.add(step)
+        return results
+
+    def execute(self, step):
+        start = time.perf_counter()
+        key = step_key(step)
+        step_dir = os.path.join(self.cache_dir, key)
+
+        cached = step.allow_reuse and os.path.exists(os.path.join(step_dir, "_SUCCESS"))
+        if cached:
+            logger.info(f"{step.name}: reused {key}")
+        else:
+            logger.info(f"{step.name}: running {step.script_name} ({key})")
+            self._run_process(step, step_dir)
+
+        for output in step.outputs:
+            output.path = os.path.join(step_dir, output.name)
+        return {
+            "key": key,
+            "status": "cached" if cached else "ran",
+            "seconds": time.perf_counter() - start,
+        }
+
+    def _run_process(self, step, step_dir):
+        # Like Azure ML, the script runs in a snapshot of its source folder. Results are moved into
+        # the cache only once the process succeeded.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        work_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix="run-")
+        try:
+            snapshot = os.path.join(work_dir, "snapshot")
+            shutil.copytree(
+                step.source_directory,
+                snapshot,
+                ignore=shutil.ignore_patterns("__pycache__", "outputs"),
+            )
+            result_dir = os.path.join(work_dir, "result")
+            os.makedirs(result_dir)
+
+            command = [self.python, step.script_name]
+            for argument in step.arguments:
+                if isinstance(argument, LocalData):
+                    if argument in step.outputs:
+                        command.append(os.path.join(result_dir, argument.name))
+                    else:
+                        command.append(argument.path)
+                elif isinstance(argument, LocalPath):
+                    command.append(argument.path)
+                else:
+                    command.append(str(argument))
+
+            with open(os.path.join(result_dir, "log.txt"), "w") as log:
+                returncode = subprocess.call(
+                    command, cwd=snapshot, stdout=log, stderr=subprocess.STDOUT
+                )
+            if returncode != 0:
+                with open(os.path.join(result_dir, "log.txt"), "r") as log:
+                    raise RuntimeError(
+                        f"Step '{step.name}' failed with exit code {returncode}:\n"
+                        + log.read()[-4000:]
+                    )
+
+            if os.path.isdir(os.path.join(snapshot, "outputs")):
+                shutil.move(
+                    os.path.join(snapshot, "outputs"),
+                    os.path.join(result_dir, "outputs"),
+                )
+            open(os.path.join(result_dir, "_SUCCESS"), "w").close()
+            if os.path.exists(step_dir):
+                shutil.rmtree(step_dir)
+            os.replace(result_dir, step_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--local_root",
+        type=str,
+        required=True,
+        help="/yyyy/MM/dd/ JSON lines files, e.g. from preprocess/generate_data.py",
+    )
+    parser.add_argument(
+        "--cache_dir", type=str, default=".pipeline_cache", help="step cache"
+    )
+    parser.add_argument(
+        "--partition_cache",
+        type=str,
+        default=None,
+        help="incremental preprocessing cache, see 01_raw_to_long.py --cache_dir",
+    )
+    parser.add_argument("--time_series_length", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=180.0)
+    parser.add_argument(
+        "--panel_dtype", type=str, default="float64", choices=["float64", "float32"]
+    )
+    parser.add_argument("--n_estimators", type=int, default=10)
+    parser.add_argument("--train_data_split", type=float, default=0.8)
+    parser.add_argument(
+        "--max_workers", type=int, default=None, help="steps run concurrently"
+    )
+    parser.add_argument("--output", type=str, default=None, help="write report here")
+    args = parser.parse_args()
+
+    # DEFINE PIPELINE STEPS
+    # Same steps as 02_modular_pipeline.py. Updating the dataset is replaced by fingerprinting
+    # --local_root; deploying and validating need a workspace and are left out.
+
+    output_panel = LocalData("output_panel")
+    output_labeled_panel = LocalData("output_labeled_panel")
+
+    parse_arguments = [
+        "--dataset_name",
+        "local",
+        "--local_root",
+        LocalPath(args.local_root),
+        "--output",
+        output_panel,
+        "--time_series_length",
+        args.time_series_length,
+        "--dtype",
+        args.panel_dtype,
+    ]
+    if args.partition_cache is not None:
+        parse_arguments += ["--cache_dir", os.path.abspath(args.partition_cache)]
+    first_prepro_step = LocalStep(
+        name="Parse dataset",
+        script_name="01_raw_to_long.py",
+        source_directory="preprocess",
+        arguments=parse_arguments,
+        outputs=[output_panel],
+    )
+
+    second_prepro_step = LocalStep(
+        name="Label dataset",
+        script_name="02_long_to_nested.py",
+        source_directory="preprocess",
+        arguments=[
+            "--input",
+            output_panel,
+            "--output",
+            output_labeled_panel,
+            "--threshold",
+            args.threshold,
+        ],
+        inputs=[output_panel],
+        outputs=[output_labeled_panel],
+    )
+
+    train_step = LocalStep(
+        name="Train Model",
+        script_name="train_pipeline.py",
+        source_directory="train",
+        arguments=[
+            "--input",
+            output_labeled_panel,
+            "--n_estimators",
+            args.n_estimators,
+            "--train_data_split",
+            args.train_data_split,
+        ],
+        inputs=[output_labeled_panel],
+    )
+
+    # RUN PIPELINE
+
+    pipeline = LocalPipeline(
+        [first_prepro_step, second_prepro_step, train_step],
+        cache_dir=args.cache_dir,
+        max_workers=args.max_workers,
+    )
+    start = time.perf_counter()
+    results = pipeline.run()
+    report = {"seconds": time.perf_counter() - start, "steps": results}
+    logger.info("Pipeline complete")
+
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            fh.write(report_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import score
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--model_dir", type=str, required=True, help="directory containing model.pkl"
+)
+parser.add_argument(
+    "--payload", type=str, default="sample_data.json", help="request payload"
+)
+parser.add_argument(
+    "--iterations", type=int, default=1000, help="requests per scoring path"
+)
+args = parser.parse_args()
+
+os.environ["AZUREML_MODEL_DIR"] = args.model_dir
+os.environ["SCORE_MODEL_FORMAT"] = "pickle"  # compare the two paths of the sktime model
+score.init()
+score.prediction_cache.capacity = 0  # every request has to hit the model
+if not score.model_cache.get(score.default_model).supports_fast_path:
+    raise SystemExit(
+        "The loaded model is not supported by the fast path or has no model_compiled.npz."
+    )
+
+with open(args.payload, "r") as fh:
+    payload = fh.read()
+
+
+def measure(fast_path):
+    score.fast_path = fast_path
+    score.run(payload)  # warm up
+
+    latencies = np.empty(args.iterations)
+    for i in range(args.iterations):
+        start = time.perf_counter()
+        score.run(payload)
+        latencies[i] = time.perf_counter() - start
+
+    latencies *= 1000
+    return {
+        "mean_ms": latencies.mean(),
+        "p50_ms": np.percentile(latencies, 50),
+        "p99_ms": np.percentile(latencies, 99),
+    }
+
+
+# Both paths must agree before their latencies are worth comparing
+fast_response = score.run(payload)
+score.fast_path = False
+assert score.run(payload) == fast_response, "Fast path response differs"
+
+results = {"fallback": measure(fast_path=False), "fast": measure(fast_path=True)}
+results["speedup"] = results["fallback"]["mean_ms"] / results["fast"]["mean_ms"]
+print(json.dumps(results, indent=2))
@@ -0,0 +1,295 @@
+import hashlib
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+
+import numpy as np
+
+# Shared with everything else in the process, not counted by deep_sizeof
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+class RingBuffer:
+    # Latest readings (and their timeCreated) of one device, oldest reading first once full
+    __slots__ = ["values", "times", "count", "position", "last_seen"]
+
+    def __init__(self, length: int):
+        self.values = np.empty(length, dtype=np.float64)
+        self.times = np.empty(length, dtype=object)
+        self.count = 0
+        self.position = 0
+        self.last_seen = 0.0
+
+    def extend(self, values: np.ndarray, times):
+        length = len(self.values)
+        values, times = values[-length:], times[-length:]
+        slots = (self.position + np.arange(len(values))) % length
+        self.values[slots] = values
+        self.times[slots] = times
+        self.position = (self.position + len(values)) % length
+        self.count = min(self.count + len(values), length)
+
+    @property
+    def full(self):
+        return self.count == len(self.values)
+
+    def window(self):
+        order = (self.position + np.arange(len(self.values))) % len(self.values)
+        return self.values[order], self.times[order]
+
+
+class DeviceWindowStore:
+    # Rolling windows per ConnectionDeviceId, so clients only need to send their newest readings.
+    # Memory is bounded by max_devices (least recently used devices are dropped first) and by
+    # ttl_seconds (devices that did not send anything for that long start over).
+    def __init__(
+        self,
+        window_length: int,
+        max_devices: int = 10000,
+        ttl_seconds: float = 3600.0,
+        clock=time.monotonic,
+    ):
+        self.window_length = window_length
+        self.max_devices = max_devices
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _evict(self, now: float):
+        # Buffers are kept in order of last use, so expired ones are always at the front
+        while self._buffers:
+            device_id, buffer = next(iter(self._buffers.items()))
+            if now - buffer.last_seen <= self.ttl_seconds:
+                break
+            del self._buffers[device_id]
+        while len(self._buffers) > self.max_devices:
+            self._buffers.popitem(last=False)
+
+    def append(self, device_id, values, times):
+        # Add the newest readings of a device. Returns (values, times, count) where values and times
+        # are the full window, or None until the device has sent window_length readings.
+        values = np.asarray(values, dtype=np.float64)
+        with self._lock:
+            now = self._clock()
+            self._evict(now)
+
+            buffer = self._buffers.pop(device_id, None)
+            if buffer is None:
+                buffer = RingBuffer(self.window_length)
+            buffer.extend(values, times)
+            buffer.last_seen = now
+            self._buffers[device_id] = buffer
+            self._evict(now)
+
+            if not buffer.full:
+                return None, None, buffer.count
+            window_values, window_times = buffer.window()
+            return window_values, window_times, buffer.count
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+
+
+class PredictionCache:
+    # Bounded LRU cache of predictions, keyed by model version and window. Entries expire after
+    # ttl_seconds, capacity=0 disables the cache.
+    def __init__(
+        self, capacity: int = 10000, ttl_seconds: float = 60.0, clock=time.monotonic
+    ):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, window: np.ndarray, model_version: str):
+        digest = hashlib.blake2b(
+            np.ascontiguousarray(window, dtype=np.float64).tobytes(), digest_size=16
+        ).digest()
+        return model_version, digest
+
+    def get(self, key):
+        # Returns (True, prediction) on a hit and (False, None) on a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._clock() - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, prediction):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (prediction, self._clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def deep_sizeof(obj):
+    # Bytes held in memory by obj and everything it references: Python objects by sys.getsizeof, NumPy
+    # arrays by the buffer they own. Arrays viewing a buffer owned by something else, like the node
+    # arrays of sklearn's Cython trees, count that buffer. Objects without a __dict__ are walked
+    # through their __getstate__, which is how those trees show their arrays.
+    seen, states = set(), []
+    total, pending = 0, [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, np.ndarray):
+            base = obj.base.obj if isinstance(obj.base, memoryview) else obj.base
+            if isinstance(base, (np.ndarray, bytes, bytearray)):
+                pending.append(base)
+            elif base is not None:
+                total += obj.nbytes
+            if obj.dtype == object:
+                pending.extend(obj.ravel())
+        elif isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif not isinstance(obj, (str, bytes, int, float, complex, bool)):
+            state = getattr(obj, "__dict__", None)
+            if state is None and hasattr(obj, "__getstate__"):
+                state = obj.__getstate__()
+                # Keep the state alive, so its id is not reused for an object still to be counted
+                states.append(state)
+            if state is not None:
+                pending.append(state)
+            for slot in getattr(type(obj), "__slots__", ()):
+                if hasattr(obj, slot):
+                    pending.append(getattr(obj, slot))
+    return total
+
+
+class ModelCache:
+    # Models loaded on first use and kept in LRU order. The least recently used models are unloaded
+    # while more than max_models are loaded or their sizes add up to more than max_bytes, except the
+    # model just requested. loader(model_id) returns (model, its size in memory in bytes).
+    def __init__(self, loader, max_models: int = 8, max_bytes: int = 256 * 2**20):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self._loader = loader
+        self._entries = OrderedDict()  # model_id -> (model, size)
+        self._loading = {}  # model_id -> lock held while the model loads
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, model_id):
+        return model_id in self._entries
+
+    def _metric(self, model_id):
+        return self._metrics.setdefault(
+            model_id,
+            {"loads": 0, "hits": 0, "evictions": 0, "loadSeconds": None, "bytes": None},
+        )
+
+    def _hit(self, model_id):
+        # Call with self._lock held. Returns the model, or None if it is not loaded.
+        entry = self._entries.get(model_id)
+        if entry is None:
+            return None
+        self._entries.move_to_end(model_id)
+        self._metric(model_id)["hits"] += 1
+        return entry[0]
+
+    def get(self, model_id):
+        with self._lock:
+            model = self._hit(model_id)
+            if model is not None:
+                return model
+            loading = self._loading.setdefault(model_id, threading.Lock())
+
+        # Concurrent requests for the same model wait for one load, other models are not blocked
+        with loading:
+            with self._lock:
+                model = self._hit(model_id)
+                if model is not None:
+                    return model
+
+            start = time.perf_counter()
+            model, size = self._loader(model_id)
+            load_seconds = time.perf_counter() - start
+
+            with self._lock:
+                metric = self._metric(model_id)
+                metric["loads"] += 1
+                metric["loadSeconds"] = load_seconds
+                metric["bytes"] = size
+                self._entries[model_id] = (model, size)
+                self._evict()
+            return model
+
+    def peek(self, model_id):
+        # The model if it is loaded, without loading it, counting a hit or changing the LRU order
+        with self._lock:
+            entry = self._entries.get(model_id)
+            return None if entry is None else entry[0]
+
+    def _evict(self):
+        # The newest entry is last and survives even if it alone exceeds max_bytes
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_models
+            or sum(size for _, size in self._entries.values()) > self.max_bytes
+        ):
+            model_id, _ = self._entries.popitem(last=False)
+            self._metric(model_id)["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": list(self._entries),
+                "bytes": sum(size for _, size in self._entries.values()),
+                "maxBytes": self.max_bytes,
+                "maxModels": self.max_models,
+                "models": {
+                    model_id: dict(metric, loaded=model_id in self._entries)
+                    for model_id, metric in self._metrics.items()
+                },
+            }
@@ -18,6 +18,12 @@ parser.add_argument(
     default="freezerchain-prediction-v0-2",
     help="Name of the deployed Webservice",
 )
+parser.add_argument(
+    "--models",
+    type=str,
+    default="sktime_freezer_classifier",
+    help="comma separated <name> or <name>:<version> of the models to host, the first is the default",
+)
 args = parser.parse_args()
 
 run = Run.get_context()
@@ -35,18 +41,26 @@ if args.redeploy:
         service.delete()
         print("deleted existing Webservice.")
 
-    model = Model(ws, "sktime_freezer_classifier")
+    # Requests pick a model with their "model" field, see score.resolve_model
+    models = []
+    for model_name in args.models.split(","):
+        name, _, version = model_name.partition(":")
+        models.append(Model(ws, name, version=int(version) if version else None))
 
     inference_config = InferenceConfig(
         entry_script="score.py", source_directory="./", environment=freezer_environment
     )
 
-    aci_config = AciWebservice.deploy_configuration(cpu_cores=1, memory_gb=1)
+    aci_config = AciWebservice.deploy_configuration(
+        cpu_cores=1,
+        memory_gb=1,
+        environment_variables={"SCORE_DEFAULT_MODEL": args.models.split(",")[0]},
+    )
 
     service = Model.deploy(
         workspace=ws,
         name=args.webservicename,
-        models=[model],
+        models=models,
         inference_config=inference_config,
         deployment_config=aci_config,
     )
@@ -0,0 +1,179 @@
+import json
+import struct
+
+import numpy as np
+
+from utils import DecodedPayload, PayloadError
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+FLOAT32 = "application/x-freezer-float32"
+CONTENT_TYPES = {
+    JSON: JSON,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    FLOAT32: FLOAT32,
+}
+
+# FLOAT32 request frame, little-endian: the number of readings and the byte lengths of the UTF-8
+# device ID, first and last timeCreated and model name, then those strings and the readings as
+# float32. A request holds one or more frames back to back. Frames can't be stateful, the window of
+# a device needs the timeCreated of every reading.
+FRAME_HEADER = struct.Struct("<IHHHH")
+# FLOAT32 response record, one per frame: the hasError flag and the byte lengths of the JSON encoded
+# result, device ID, timeCreatedStart, timeCreatedEnd and errorMessage, then those strings
+RECORD_HEADER = struct.Struct("<BHHHHH")
+# Longest string a frame or record can hold, in UTF-8 bytes
+MAX_FIELD_BYTES = 2**16 - 1
+
+
+def content_type(header: str = None):
+    # The encoding named by a Content-Type header. Anything else is read as JSON.
+    media_type = (header or "").split(";")[0].strip().lower()
+    return CONTENT_TYPES.get(media_type, JSON)
+
+
+def _msgpack():
+    # msgpack is only needed by clients that ask for it
+    try:
+        import msgpack
+    except ImportError:
+        raise ValueError(f"{MSGPACK} is not supported, msgpack is not installed.")
+    return msgpack
+
+
+def _field(value: str, name: str, truncate: bool = False):
+    # A string field of a frame or record. Longer ones raise ValueError, or lose their end if
+    # truncate is set.
+    encoded = (value or "").encode("utf-8")
+    if len(encoded) > MAX_FIELD_BYTES:
+        if not truncate:
+            raise ValueError(
+                f"{name} is {len(encoded)} bytes long, {FLOAT32} fields hold at most "
+                f"{MAX_FIELD_BYTES}."
+            )
+        encoded = encoded[:MAX_FIELD_BYTES].decode("utf-8", "ignore").encode("utf-8")
+    return encoded
+
+
+def _frame_payload(device_id, time_created_start, time_created_end, model, readings):
+    if not device_id:
+        return DecodedPayload(
+            PayloadError("device_id", "No ConnectionDeviceIds found.")
+        )
+    decoded = DecodedPayload()
+    decoded.connection_device_id = device_id
+    decoded.time_created_start = time_created_start or None
+    decoded.time_created_end = time_created_end or None
+    decoded.model = model or None
+    decoded.temperature = readings.astype(np.float64)
+    return decoded
+
+
+def decode_frames(body: bytes):
+    # FLOAT32 request -> DecodedPayloads, raises ValueError for truncated frames
+    payloads = []
+    offset = 0
+    while offset < len(body):
+        if len(body) - offset < FRAME_HEADER.size:
+            raise ValueError(f"Truncated frame header at byte {offset}.")
+        n_readings, *lengths = FRAME_HEADER.unpack_from(body, offset)
+        offset += FRAME_HEADER.size
+        end = offset + sum(lengths) + 4 * n_readings
+        if end > len(body):
+            raise ValueError(f"Truncated frame at byte {offset}.")
+        strings = []
+        for length in lengths:
+            strings.append(body[offset : offset + length].decode("utf-8"))
+            offset += length
+        readings = np.frombuffer(body, dtype="<f4", count=n_readings, offset=offset)
+        offset = end
+        payloads.append(_frame_payload(*strings, readings))
+    return payloads
+
+
+def encode_frame(
+    readings,
+    connection_device_id: str,
+    time_created_start: str = "",
+    time_created_end: str = "",
+    model: str = "",
+):
+    # One FLOAT32 request frame, e.g. for a client
+    strings = [
+        _field(connection_device_id, "ConnectionDeviceId"),
+        _field(time_created_start, "timeCreatedStart"),
+        _field(time_created_end, "timeCreatedEnd"),
+        _field(model, "model"),
+    ]
+    readings = np.asarray(readings, dtype="<f4")
+    return (
+        FRAME_HEADER.pack(len(readings), *(len(string) for string in strings))
+        + b"".join(strings)
+        + readings.tobytes()
+    )
+
+
+def encode_records(responses):
+    # create_response dicts -> FLOAT32 response. Error messages longer than a field are cut off,
+    # other fields that long raise ValueError.
+    records = []
+    for response in responses:
+        strings = [
+            _field(json.dumps(response["result"]), "result"),
+            _field(response["ConnectionDeviceId"], "ConnectionDeviceId"),
+            _field(response["timeCreatedStart"], "timeCreatedStart"),
+            _field(response["timeCreatedEnd"], "timeCreatedEnd"),
+            _field(response["errorMessage"], "errorMessage", truncate=True),
+        ]
+        records.append(
+            RECORD_HEADER.pack(
+                response["hasError"], *(len(string) for string in strings)
+            )
+        )
+        records.extend(strings)
+    return b"".join(records)
+
+
+def decode_records(body: bytes):
+    # FLOAT32 response -> create_response dicts, e.g. for a client. An empty device ID or error
+    # message reads as None.
+    responses = []
+    offset = 0
+    while offset < len(body):
+        has_error, *lengths = RECORD_HEADER.unpack_from(body, offset)
+        offset += RECORD_HEADER.size
+        strings = []
+        for length in lengths:
+            strings.append(body[offset : offset + length].decode("utf-8"))
+            offset += length
+        result, device_id, start, end, error_message = strings
+        responses.append(
+            {
+                "result": json.loads(result),
+                "ConnectionDeviceId": device_id or None,
+                "timeCreatedStart": start,
+                "timeCreatedEnd": end,
+                "hasError": bool(has_error),
+                "errorMessage": error_message or None,
+            }
+        )
+    return responses
+
+
+def decode_request(body: bytes, encoding: str = JSON):
+    # Request body -> what score.run_batch and friends take. FLOAT32 bodies always decode to a list.
+    if encoding == MSGPACK:
+        return _msgpack().unpackb(body, raw=False)
+    if encoding == FLOAT32:
+        return decode_frames(body)
+    return json.loads(body)
+
+
+def encode_response(result, encoding: str = JSON):
+    if encoding == MSGPACK:
+        return _msgpack().packb(result)
+    if encoding == FLOAT32:
+        return encode_records(result if isinstance(result, list) else [result])
+    return json.dumps(result).encode()
@@ -0,0 +1,250 @@
+import numpy as np
+
+COMPILED_FOREST_VERSION = 2
+COMPILED_MODEL_FILENAME = "model_compiled.npz"
+
+# Interval features used by sktime's TimeSeriesForestClassifier, in the order of their kind codes
+FEATURE_KINDS = ("mean", "std", "time_series_slope")
+
+
+def interval_features(engine, intervals, feature_names):
+    # Same column order as sktime's RandomIntervalFeatureExtractor: all intervals of the first
+    # feature, then all intervals of the second feature, ...
+    return np.column_stack(
+        [
+            engine.feature(start, end, FEATURE_KINDS.index(name))
+            for name in feature_names
+            for start, end in intervals
+        ]
+    )
+
+
+def _feature_names(transformer):
+    features = transformer.features if transformer.features is not None else [np.mean]
+    return [feature.__name__ for feature in features]
+
+
+def _forest(model):
+    # TSCStrategy wraps the fitted TimeSeriesForestClassifier
+    return getattr(model, "estimator", model)
+
+
+def supports_fast_path(model):
+    # The fast path only understands forests of (RandomIntervalFeatureExtractor, DecisionTree) pipelines
+    try:
+        for pipeline in _forest(model).estimators_:
+            transformer, tree = pipeline.steps[0][1], pipeline.steps[-1][1]
+            if not all(name in FEATURE_KINDS for name in _feature_names(transformer)):
+                return False
+            if not (hasattr(transformer, "intervals_") and hasattr(tree, "tree_")):
+                return False
+    except (AttributeError, IndexError, TypeError):
+        return False
+    return True
+
+
+def required_length(model):
+    # Readings a time series needs for every interval of the model, None if the layout is unknown
+    if isinstance(model, CompiledForest):
+        return int(model.feature_end.max()) if len(model.feature_end) else 0
+    try:
+        return max(
+            int(end)
+            for pipeline in _forest(model).estimators_
+            for _, end in pipeline.steps[0][1].intervals_
+        )
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+
+
+def _tree_predict_proba(tree, Xt: np.ndarray):
+    # DecisionTreeClassifier.predict_proba without input validation. Like sklearn, the features
+    # are evaluated as float32.
+    leaves = tree.tree_.apply(np.ascontiguousarray(Xt, dtype=np.float32))
+    proba = tree.tree_.value[leaves, 0, : tree.n_classes_]
+    normalizer = proba.sum(axis=1)[:, np.newaxis]
+    normalizer[normalizer == 0.0] = 1.0
+    return proba / normalizer
+
+
+def predict_fast(model, panel: np.ndarray):
+    # Predict a (n_cases, 1, length) panel straight from NumPy, without building a nested DataFrame.
+    # Features can differ from sktime's in the last bits, score.py only uses this for models whose
+    # compiled export matched sktime.
+    forest = _forest(model)
+    # Prefix sums are computed once and interval features shared by several trees only once.
+    engine = IntervalFeatures(panel[:, 0, :])
+
+    proba = None
+    for pipeline in forest.estimators_:
+        transformer, tree = pipeline.steps[0][1], pipeline.steps[-1][1]
+        Xt = interval_features(
+            engine, transformer.intervals_, _feature_names(transformer)
+        )
+        tree_proba = _tree_predict_proba(tree, Xt)
+        proba = tree_proba if proba is None else proba + tree_proba
+    proba /= len(forest.estimators_)
+
+    return forest.classes_.take(np.argmax(proba, axis=1), axis=0)
+
+
+class IntervalFeatures:
+    # Prefix sums of x, x**2 and t*x over a (n_cases, length) array, so the mean, std and slope of any
+    # interval cost O(1) per case instead of O(interval length). Rows are shifted by their first value
+    # beforehand to keep the sums small. Features are memoised by (start, end, kind): trees sharing an
+    # interval compute it once. The memo lives as long as the engine, i.e. one panel. Fitting does not
+    # use it, sktime computes its own features there.
+    def __init__(self, X: np.ndarray):
+        X = np.asarray(X, dtype=np.float64)
+        self.n_cases, self.length = X.shape
+        self.offset = X[:, 0] if self.length else np.zeros(self.n_cases)
+        self._X = X
+        centered = X - self.offset[:, np.newaxis]
+        t = np.arange(self.length)
+        self._sums = []
+        for values in (centered, centered**2, t * centered):
+            sums = np.zeros((self.n_cases, self.length + 1))
+            np.cumsum(values, axis=1, out=sums[:, 1:])
+            self._sums.append(sums)
+        self._cache = {}
+
+    def _interval_sums(self, start: int, end: int):
+        return [sums[:, end] - sums[:, start] for sums in self._sums]
+
+    def mean(self, start: int, end: int):
+        sum_x, _, _ = self._interval_sums(start, end)
+        return sum_x / (end - start) + self.offset
+
+    def std(self, start: int, end: int):
+        n = end - start
+        if n < 2:
+            return np.zeros(self.n_cases)
+        sum_x, sum_xx, _ = self._interval_sums(start, end)
+        var = sum_xx / n - (sum_x / n) ** 2
+        # Rounding of the prefix sums dominates where the variance is tiny compared to them.
+        # Those rows are recomputed from the readings.
+        unstable = var < 1e-6 * self._sums[1][:, end] / n
+        std = np.sqrt(np.maximum(var, 0.0))
+        if unstable.any():
+            std[unstable] = np.std(self._X[unstable, start:end], axis=1)
+        return std
+
+    def slope(self, start: int, end: int):
+        # sktime's time_series_slope, with time counted from the interval start
+        n = end - start
+        if n < 2:
+            return np.zeros(self.n_cases)
+        sum_x, _, sum_tx = self._interval_sums(start, end)
+        sum_tx = sum_tx - start * sum_x
+        return (sum_tx / n - (n - 1) / 2 * sum_x / n) / ((n**2 - 1) / 12)
+
+    def feature(self, start: int, end: int, kind: int):
+        key = (int(start), int(end), int(kind))
+        if key not in self._cache:
+            self._cache[key] = (self.mean, self.std, self.slope)[key[2]](*key[:2])
+        return self._cache[key]
+
+
+class CompiledForest:
+    # A TimeSeriesForestClassifier flattened into plain arrays:
+    # - feature_start/feature_end/feature_kind: every distinct interval feature used by any tree
+    # - node_*: the nodes of all trees back to back. Leaves point to themselves and node_value holds
+    #   the normalised class probabilities of every node.
+    # - tree_root: index of the first node of every tree
+    # Compacted forests (leaf_values) only keep the probabilities of leaves: node_value has one row per
+    # leaf and a leaf's node_feature is its row. Arrays may use any integer and float width.
+    # Keep in sync with train/forest.py, both folders are uploaded separately.
+    ARRAYS = (
+        "classes",
+        "feature_start",
+        "feature_end",
+        "feature_kind",
+        "node_feature",
+        "node_threshold",
+        "node_left",
+        "node_right",
+        "node_value",
+        "tree_root",
+    )
+
+    def __init__(self, max_depth: int, leaf_values: bool = False, **arrays):
+        self.max_depth = int(max_depth)
+        self.leaf_values = bool(leaf_values)
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @property
+    def n_estimators(self):
+        return len(self.tree_root)
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            format_version=COMPILED_FOREST_VERSION,
+            max_depth=self.max_depth,
+            leaf_values=self.leaf_values,
+            **{name: getattr(self, name) for name in self.ARRAYS},
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as arrays:
+            # Version 1 forests have no leaf_values and read as uncompacted
+            if int(arrays["format_version"]) not in (1, COMPILED_FOREST_VERSION):
+                raise ValueError(
+                    f"Unsupported compiled forest version {int(arrays['format_version'])}."
+                )
+            return cls(
+                max_depth=int(arrays["max_depth"]),
+                leaf_values="leaf_values" in arrays and bool(arrays["leaf_values"]),
+                **{name: arrays[name] for name in cls.ARRAYS},
+            )
+
+    def features(self, X):
+        # All interval features of a (n_cases, length) array or of its IntervalFeatures
+        engine = X if isinstance(X, IntervalFeatures) else IntervalFeatures(X)
+        Xt = np.empty((engine.n_cases, len(self.feature_kind)))
+        for i, (start, end, kind) in enumerate(
+            zip(self.feature_start, self.feature_end, self.feature_kind)
+        ):
+            Xt[:, i] = engine.feature(start, end, kind)
+        return Xt
+
+    def apply(self, Xt: np.ndarray):
+        # Walk all trees for all cases at once, only advancing pairs that have not reached a leaf yet.
+        # Like sklearn, features are compared as float32.
+        Xt = Xt.astype(np.float32)
+        nodes = np.tile(self.tree_root, Xt.shape[0]).astype(np.intp)
+        rows = np.repeat(np.arange(Xt.shape[0]), self.n_estimators)
+        active = np.flatnonzero(self.node_left[nodes] != nodes)
+        while active.size:
+            current = nodes[active]
+            go_left = Xt[rows[active], self.node_feature[current]] <= (
+                self.node_threshold[current]
+            )
+            nodes[active] = np.where(
+                go_left, self.node_left[current], self.node_right[current]
+            )
+            active = active[self.node_left[nodes[active]] != nodes[active]]
+        return nodes.reshape(Xt.shape[0], self.n_estimators)
+
+    def predict_proba(self, panel):
+        # panel: (n_cases, 1, length), (n_cases, length) or the IntervalFeatures of either
+        X = panel
+        if not isinstance(X, IntervalFeatures):
+            X = np.asarray(panel, dtype=np.float64)
+            if X.ndim == 3:
+                X = X[:, 0, :]
+        Xt = self.features(X)
+        leaves = self.apply(Xt)
+        if self.leaf_values:
+            leaves = self.node_feature[leaves]
+
+        # Sum the trees one after another like sklearn's ForestClassifier does
+        proba = np.zeros((Xt.shape[0], len(self.classes)))
+        for tree in range(self.n_estimators):
+            proba += self.node_value[leaves[:, tree]]
+        return proba / self.n_estimators
+
+    def predict(self, panel: np.ndarray):
+        return self.classes.take(np.argmax(self.predict_proba(panel), axis=1), axis=0)
@@ -0,0 +1,321 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import score
+from encoding import (
+    CONTENT_TYPES,
+    FLOAT32,
+    JSON,
+    decode_records,
+    decode_request,
+    encode_frame,
+    encode_response,
+)
+
+
+def generate_payloads(
+    n_payloads,
+    seed=0,
+    invalid_fraction=0.05,
+    max_history=30,
+    window_length=score.TIMESERIESLENGTH,
+):
+    # Synthetic Stream Analytics payloads shaped like sample_data.json. The device ID is either a
+    # top-level key or part of every event. A fraction of the payloads is invalid on purpose:
+    # too short for window_length, without a device ID or with conflicting device IDs.
+    max_history = max(max_history, window_length)
+    rng = np.random.RandomState(seed)
+    start = datetime.datetime(2020, 4, 7, 5, 51, 1)
+    payloads = []
+    for i in range(n_payloads):
+        device_id = f"device{rng.randint(1000):03d}"
+        kind = "valid"
+        if rng.rand() < invalid_fraction:
+            kind = rng.choice(["too_short", "no_device_id", "multiple_device_ids"])
+
+        if kind == "too_short":
+            n_events = rng.randint(1, window_length)
+        else:
+            n_events = rng.randint(window_length, max_history + 1)
+        temperature = 253 + rng.randn(n_events).cumsum() * 0.5
+        events = []
+        for j in range(n_events):
+            time_created = start + datetime.timedelta(seconds=5 * (i + j))
+            events.append(
+                {
+                    "temperature": float(temperature[j]),
+                    "ambienttemperature": float(21 + rng.randn()),
+                    "timeCreated": time_created.strftime("%Y-%m-%dT%H:%M:%S.%f") + "0Z",
+                    "ConnectionDeviceId": device_id,
+                    "ConnectionDeviceGenerationId": "637211838651873534",
+                }
+            )
+
+        payload = {"allevents": events}
+        if kind == "no_device_id":
+            for event in events:
+                del event["ConnectionDeviceId"]
+        elif kind == "multiple_device_ids":
+            events[0]["ConnectionDeviceId"] = device_id + "-other"
+        elif rng.rand() < 0.5:
+            payload["ConnectionDeviceId"] = device_id
+            for event in events:
+                del event["ConnectionDeviceId"]
+        payloads.append(json.dumps(payload))
+    return payloads
+
+
+def in_process_client(model_dir, disable_cache):
+    if model_dir is not None:
+        os.environ["AZUREML_MODEL_DIR"] = model_dir
+    score.init()
+    if disable_cache:
+        score.prediction_cache.capacity = 0
+    return score.run
+
+
+def target_window_length(args):
+    # The window length of the model under test: --window_length, or the training.json of the model
+    # in-process scoring uses by default, or the one of --model_dir
+    if args.window_length is not None:
+        return args.window_length
+    if args.url is None:
+        return score.model_window_length(score.model_folders[score.default_model])
+    if args.model_dir is not None:
+        return score.model_window_length(args.model_dir)
+    return score.TIMESERIESLENGTH
+
+
+def frame_device_id(data: dict):
+    # The one device ID of a payload as a FLOAT32 frame carries it, "" without one. Raises
+    # ValueError for conflicting device IDs, a frame can't carry them.
+    if data.get("ConnectionDeviceId"):
+        return data["ConnectionDeviceId"]
+    device_ids = {
+        event["ConnectionDeviceId"]
+        for event in data["allevents"]
+        if event.get("ConnectionDeviceId")
+    }
+    if len(device_ids) > 1:
+        raise ValueError(f"Conflicting device IDs {sorted(device_ids)}.")
+    return device_ids.pop() if device_ids else ""
+
+
+def encode_payload(payload: str, encoding: str = JSON):
+    # A JSON payload in another encoding. Raises ValueError for payloads FLOAT32 can't carry.
+    if encoding != FLOAT32:
+        return encode_response(json.loads(payload), encoding)
+    data = json.loads(payload)
+    events = data["allevents"]
+    return encode_frame(
+        [event["temperature"] for event in events],
+        frame_device_id(data),
+        events[0].get("timeCreated"),
+        events[-1].get("timeCreated"),
+    )
+
+
+def encodable_payloads(payloads, encoding):
+    # The payloads the client can send in its encoding, the others would arrive as different payloads
+    encodable = []
+    for payload in payloads:
+        try:
+            encode_payload(payload, encoding)
+        except ValueError:
+            continue
+        encodable.append(payload)
+    return encodable
+
+
+def http_client(url, encoding=JSON):
+    bodies = {}  # payloads are encoded once, outside of the measured requests
+
+    def send(payload):
+        if payload not in bodies:
+            bodies[payload] = encode_payload(payload, encoding)
+        request = urllib.request.Request(
+            url, data=bodies[payload], headers={"Content-Type": encoding}
+        )
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+        if encoding == FLOAT32:
+            return decode_records(body)[0]
+        return decode_request(body, encoding)
+
+    return send
+
+
+def run_load(send, payloads, n_requests, concurrency, qps=None):
+    # Closed loop (qps=None): `concurrency` clients send back to back.
+    # Open loop: requests are started at a fixed rate and their latency is measured from the
+    # scheduled start, so a slow service cannot hide its queueing delay.
+    latencies = np.full(n_requests, np.nan)
+    error_responses = np.zeros(n_requests, dtype=bool)
+    failures = np.zeros(n_requests, dtype=bool)
+    counter = iter(range(n_requests))
+    lock = threading.Lock()
+
+    def request(i, scheduled):
+        try:
+            response = send(payloads[i % len(payloads)])
+            error_responses[i] = bool(response.get("hasError"))
+        except Exception:
+            failures[i] = True
+        latencies[i] = time.perf_counter() - scheduled
+
+    def closed_loop_client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            request(i, time.perf_counter())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if qps is None:
+            for _ in range(concurrency):
+                executor.submit(closed_loop_client)
+        else:
+            for i in range(n_requests):
+                scheduled = start + i / qps
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+                executor.submit(request, i, scheduled)
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = latencies * 1000
+    return {
+        "requests": n_requests,
+        "elapsedSeconds": elapsed,
+        "throughputRps": n_requests / elapsed,
+        "latencyMs": {
+            "mean": float(np.mean(latencies_ms)),
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p95": float(np.percentile(latencies_ms, 95)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+            "max": float(np.max(latencies_ms)),
+        },
+        "errorResponseRate": float(error_responses.mean()),
+        "failureRate": float(failures.mean()),
+    }
+
+
+def compare_reports(baseline, report):
+    # Ratios current / baseline. Runs are only comparable with the same payloads and load shape.
+    keys = ("payloadDigest", "requests", "concurrency", "qps", "target", "encoding")
+    mismatched = [
+        key for key in keys if baseline["config"].get(key) != report["config"].get(key)
+    ]
+    before, after = baseline["results"], report["results"]
+    return {
+        "comparable": not mismatched,
+        "mismatchedConfig": mismatched,
+        "throughputRatio": after["throughputRps"] / before["throughputRps"],
+        "latencyRatio": {
+            key: after["latencyMs"][key] / before["latencyMs"][key]
+            for key in ("p50", "p95", "p99")
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url", type=str, default=None, help="scoring URI, default: in-process run()"
+    )
+    parser.add_argument(
+        "--model_dir", type=str, default=None, help="model for in-process scoring"
+    )
+    parser.add_argument("--requests", type=int, default=2000, help="requests to send")
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="clients / requests in flight"
+    )
+    parser.add_argument(
+        "--qps", type=float, default=None, help="target rate, default: closed loop"
+    )
+    parser.add_argument(
+        "--payloads", type=int, default=500, help="distinct synthetic payloads"
+    )
+    parser.add_argument(
+        "--invalid_fraction", type=float, default=0.05, help="share of bad payloads"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="payload random seed")
+    parser.add_argument(
+        "--window_length",
+        type=int,
+        default=None,
+        help="readings the model scores, default: its training.json",
+    )
+    parser.add_argument(
+        "--encoding",
+        type=str,
+        default=JSON,
+        choices=sorted(set(CONTENT_TYPES.values())),
+        help="request and response encoding of the HTTP client",
+    )
+    parser.add_argument(
+        "--disable_cache",
+        action="store_true",
+        help="turn off the prediction cache for in-process scoring",
+    )
+    parser.add_argument("--output", type=str, default=None, help="write report here")
+    parser.add_argument(
+        "--baseline", type=str, default=None, help="earlier report to compare against"
+    )
+    args = parser.parse_args()
+
+    if args.url is None:
+        send = in_process_client(args.model_dir, args.disable_cache)
+    else:
+        send = http_client(args.url, args.encoding)
+    args.window_length = target_window_length(args)
+    payloads = generate_payloads(
+        args.payloads,
+        seed=args.seed,
+        invalid_fraction=args.invalid_fraction,
+        window_length=args.window_length,
+    )
+    if args.url is not None:
+        n_generated = len(payloads)
+        payloads = encodable_payloads(payloads, args.encoding)
+        if len(payloads) < n_generated:
+            print(
+                f"Skipping {n_generated - len(payloads)} payloads {args.encoding} can't carry"
+            )
+
+    # Warm up before measuring
+    for payload in payloads[: min(len(payloads), 20)]:
+        send(payload)
+
+    report = {
+        "config": dict(
+            vars(args),
+            target=args.url or "in-process",
+            payloadDigest=hashlib.sha256("".join(payloads).encode()).hexdigest()[:16],
+        ),
+        "results": run_load(
+            send, payloads, args.requests, args.concurrency, qps=args.qps
+        ),
+    }
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fh:
+            report["comparison"] = compare_reports(json.load(fh), report)
+
+    report_json = json.dumps(report, indent=2)
+    print(report_json)
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            fh.write(report_json)
+
+
+if __name__ == "__main__":
+    main()
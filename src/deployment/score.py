@@ -1,83 +1,452 @@
+import time
+
+# pandas, joblib and sktime are only imported when a pickled model is loaded
+_import_start = time.perf_counter()
+
+import hashlib
 import json
 import logging
 import os
 
-import joblib
-import pandas as pd
+import numpy as np
+
+try:
+    # The AML server only hands the raw request, and so its Content-Type, to a @rawhttp run
+    from azureml.contrib.services.aml_request import rawhttp
+    from azureml.contrib.services.aml_response import AMLResponse
+except ImportError:
+    AMLResponse = None
 
-from sktime.utils.load_data import from_long_to_nested
-from utils import create_response, get_connection_device_id
+    def rawhttp(func):
+        return func
 
+
+from cache import DeviceWindowStore, ModelCache, PredictionCache, deep_sizeof
+from encoding import JSON, content_type, decode_request, encode_response
+from forest import (
+    COMPILED_MODEL_FILENAME,
+    CompiledForest,
+    predict_fast,
+    required_length,
+    supports_fast_path,
+)
+from utils import DecodedPayload, create_response, decode_payload, panel_to_nested
+
+IMPORT_SECONDS = time.perf_counter() - _import_start
 TIMESERIESLENGTH = 10
+TRAINING_STATE_FILENAME = "training.json"
+DEFAULT_MODEL_ID = "default"
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def find_model_file(model_dir, filename):
+    # Models are registered as a folder, older ones as a single file
+    for root, _, filenames in os.walk(model_dir):
+        if filename in filenames:
+            return os.path.join(root, filename)
+    return None
+
+
+def discover_models(root):
+    # Model id -> folder of every model below root. Azure ML mounts several models as
+    # <name>/<version>/..., giving ids like "sktime_freezer_classifier/3", and a single model as root
+    # itself. A model in root is named after root's <name>/<version>, DEFAULT_MODEL_ID outside of
+    # Azure ML. The "model" folder a model was registered from is not part of the id.
+    root = os.path.abspath(root)
+    name, version = os.path.basename(os.path.dirname(root)), os.path.basename(root)
+    root_id = f"{name}/{version}" if version.isdigit() else DEFAULT_MODEL_ID
+    models = {}
+    for folder, dirs, filenames in os.walk(root):
+        dirs.sort()
+        if COMPILED_MODEL_FILENAME in filenames or "model.pkl" in filenames:
+            parts = [
+                part
+                for part in os.path.relpath(folder, root).split(os.sep)
+                if part != "."
+            ]
+            if parts and parts[-1] == "model":
+                parts = parts[:-1]
+            models.setdefault("/".join(parts) or root_id, folder)
+    return models
+
+
+def _version_key(model_id):
+    version = model_id.rsplit("/", 1)[-1]
+    return int(version) if version.isdigit() else -1
+
+
+def resolve_model(requested=None):
+    # Model id for a request's "model" field: an id, "<name>:<version>", or a name for its newest
+    # version. Requests without one get the default model.
+    if requested is None:
+        return default_model
+    requested = str(requested).replace(":", "/")
+    if requested in model_folders:
+        return requested
+    versions = [
+        model_id for model_id in model_folders if model_id.split("/")[0] == requested
+    ]
+    if not versions:
+        raise ValueError(
+            f"Unknown model '{requested}', available: {sorted(model_folders)}."
+        )
+    return max(versions, key=_version_key)
+
+
+def load_model(model_dir, model_format="auto"):
+    # Returns (model, model_format, model_path). "compiled" loads the exported NumPy forest without
+    # importing sktime, "pickle" the joblib dump of the TSCStrategy and "auto" prefers the former.
+    if model_format in ("auto", "compiled"):
+        model_path = find_model_file(model_dir, COMPILED_MODEL_FILENAME)
+        if model_path is not None:
+            return CompiledForest.load(model_path), "compiled", model_path
+        if model_format == "compiled":
+            raise FileNotFoundError(f"No {COMPILED_MODEL_FILENAME} in {model_dir}")
+
+    model_path = find_model_file(model_dir, "model.pkl")
+    if model_path is None:
+        raise FileNotFoundError(f"No model.pkl in {model_dir}")
+    import joblib
+
+    return joblib.load(model_path), "pickle", model_path
+
+
+class ScoringModel:
+    # A loaded model with what scoring needs to know about it
+    def __init__(self, model_id, model, model_format, model_path, window_length):
+        self.model_id = model_id
+        self.model = model
+        self.model_format = model_format
+        self.model_version = _file_digest(model_path)
+        self.window_length = window_length
+        # The fast path rounds its interval features differently from sktime, which can flip a split
+        # after the float32 cast. Trainers only export model_compiled.npz next to model.pkl when the
+        # exported forest predicted their test cases exactly like sktime, so only those pickles take it.
+        self.supports_fast_path = (
+            model_format == "pickle"
+            and os.path.exists(
+                os.path.join(os.path.dirname(model_path), COMPILED_MODEL_FILENAME)
+            )
+            and supports_fast_path(model)
+        )
+
+
+def model_window_length(model_dir):
+    # Every trainer records the time series length next to the model
+    path = find_model_file(model_dir, TRAINING_STATE_FILENAME)
+    if path is not None:
+        with open(path, "r") as fh:
+            return int(json.load(fh)["time_series_length"])
+    logging.warning(
+        f"No {TRAINING_STATE_FILENAME} in {model_dir}, assuming windows of {TIMESERIESLENGTH} readings."
+    )
+    return TIMESERIESLENGTH
+
+
+def _load_scoring_model(model_id):
+    # Returns (ScoringModel, size in bytes) for the ModelCache
+    model_dir = model_folders[model_id]
+    model, model_format, model_path = load_model(
+        model_dir, model_format=os.environ.get("SCORE_MODEL_FORMAT", "auto")
+    )
+
+    # A model reading past the end of its windows would fail every batch it is in
+    window_length = model_window_length(model_dir)
+    length = required_length(model)
+    if length is not None and length > window_length:
+        raise ValueError(
+            f"Model {model_id} reads {length} readings per time series, but its windows have {window_length}."
+        )
+
+    entry = ScoringModel(model_id, model, model_format, model_path, window_length)
+    logging.info(
+        f"Model {model_id} loaded ({model_format}, version {entry.model_version[:12]}, "
+        f"windows of {window_length} readings, fast path {entry.supports_fast_path})."
+    )
+    return entry, deep_sizeof(model)
+
+
+def window_store(window_length):
+    # Rolling windows for clients that only send their newest readings ("stateful": true), one store
+    # per window length
+    store = device_windows.get(window_length)
+    if store is None:
+        store = device_windows.setdefault(
+            window_length,
+            DeviceWindowStore(
+                window_length,
+                max_devices=int(os.environ.get("SCORE_WINDOW_MAX_DEVICES", 10000)),
+                ttl_seconds=float(os.environ.get("SCORE_WINDOW_TTL_SECONDS", 3600)),
+            ),
+        )
+    return store
 
 
 def init():
-    global model
+    global model_folders, default_model, model_cache, fast_path, parity_check
+    global device_windows, prediction_cache, cold_start
 
-    # The AZUREML_MODEL_DIR environment variable indicates
-    # a directory containing the model file you registered.
-    model_filename = "model.pkl"
-    model_path = os.path.join(os.environ["AZUREML_MODEL_DIR"], model_filename)
-    model = joblib.load(model_path)
+    # The AZUREML_MODEL_DIR environment variable indicates a directory containing the registered
+    # model, or one folder per model if several were deployed. Models are loaded on first use, up to
+    # SCORE_MODEL_CACHE_MAX models or SCORE_MODEL_CACHE_MB megabytes of memory (see cache.deep_sizeof)
+    # at a time.
+    model_folders = discover_models(os.environ["AZUREML_MODEL_DIR"])
+    if not model_folders:
+        raise FileNotFoundError(f"No models in {os.environ['AZUREML_MODEL_DIR']}")
+    default_model = resolve_model(
+        os.environ.get("SCORE_DEFAULT_MODEL", sorted(model_folders)[0].split("/")[0])
+    )
+    model_cache = ModelCache(
+        _load_scoring_model,
+        max_models=int(os.environ.get("SCORE_MODEL_CACHE_MAX", 8)),
+        max_bytes=int(float(os.environ.get("SCORE_MODEL_CACHE_MB", 256)) * 2**20),
+    )
+    logging.info(f"Models: {sorted(model_folders)}, default {default_model}.")
 
-    logging.info("Model loaded.")
+    # Predictions are cached per model version and window. A new cache on every init() drops the
+    # predictions of models that are no longer deployed.
+    prediction_cache = PredictionCache(
+        capacity=int(os.environ.get("SCORE_CACHE_CAPACITY", 10000)),
+        ttl_seconds=float(os.environ.get("SCORE_CACHE_TTL_SECONDS", 60)),
+    )
 
+    # Predict pickled models straight from NumPy unless disabled, the model layout is not supported
+    # or the model failed the export check of its trainer. SCORE_PARITY_CHECK=1 compares every fast prediction against the pandas/sktime path.
+    fast_path = os.environ.get("SCORE_FAST_PATH", "1") != "0"
+    parity_check = os.environ.get("SCORE_PARITY_CHECK", "0") == "1"
+    logging.info(f"Fast path enabled: {fast_path}")
 
-def run(data):
-    has_error = False
-    logging.info("started run.")
+    device_windows = {}
+
+    # Load the default model and run one prediction, so the first request does not pay for lazy
+    # initialisation
+    load_start = time.perf_counter()
+    entry = model_cache.get(default_model)
+    load_seconds = time.perf_counter() - load_start
+    warm_up_start = time.perf_counter()
+    predict(entry, np.zeros((1, 1, entry.window_length)))
+    warm_up_seconds = time.perf_counter() - warm_up_start
+
+    cold_start = {
+        "importSeconds": IMPORT_SECONDS,
+        "loadSeconds": load_seconds,
+        "warmUpSeconds": warm_up_seconds,
+    }
+    logging.info(
+        f"Cold start: imports {IMPORT_SECONDS:.3f}s, model load {load_seconds:.3f}s, warm-up {warm_up_seconds:.3f}s."
+    )
+
+
+def predict(entry, panel):
+    model = entry.model
+    if entry.model_format == "compiled":
+        return model.predict(panel)
+    if not (fast_path and entry.supports_fast_path):
+        return model.predict(panel_to_nested(panel))
+
+    predictions = predict_fast(model, panel)
+    if parity_check:
+        expected = model.predict(panel_to_nested(panel))
+        if not np.array_equal(predictions, expected):
+            logging.warning(
+                f"Fast path predictions {predictions.tolist()} differ from {expected.tolist()}."
+            )
+    return predictions
 
-    # CONVERT STREAM ANALYTICS TO SKTIME FORMAT
-    logging.info("loading json.")
-    data = json.loads(data)
-    logging.info("json loaded.")
 
-    # Parse timestamps and temperature data
-    time_created_start = data.get("allevents")[0].get("timeCreated")
-    time_created_end = data.get("allevents")[-1].get("timeCreated")
-    temperature_data = [event.get("temperature") for event in data.get("allevents")]
+def stats():
+    # Reading the stats neither loads the default model nor counts as a hit
+    default = model_cache.peek(default_model)
+    return {
+        "modelFormat": default.model_format if default is not None else None,
+        "modelVersion": default.model_version if default is not None else None,
+        "defaultModel": default_model,
+        "coldStart": cold_start,
+        "predictionCache": prediction_cache.stats(),
+        "modelCache": model_cache.stats(),
+    }
 
-    logging.info(f"time_created_start: {time_created_start}")
-    logging.info(f"time_created_end: {time_created_end}")
-    logging.info(f"temperature_data: {temperature_data}")
 
-    # Check connection_device_id
-    connection_device_id, has_error, error_message = get_connection_device_id(data)
-    if has_error:
-        return create_response(has_error=has_error, error_message=error_message)
+def prepare_window(data, window_length=TIMESERIESLENGTH):
+    # Validate a single Stream Analytics payload and cut out its last window_length readings.
+    # Returns the window and the fields for create_response, or an error response.
+    payload = decode_payload(data, window_length)
+    if payload.error is not None:
+        return (
+            None,
+            None,
+            create_response(has_error=True, error_message=payload.error.message),
+        )
+
+    # In stateful mode the readings extend the window stored for the device
+    if payload.stateful:
+        return prepare_stateful_window(payload, window_length)
+
+    fields = {
+        "connection_device_id": payload.connection_device_id,
+        "time_created_start": payload.time_created_start,
+        "time_created_end": payload.time_created_end,
+    }
+    return payload.temperature, fields, None
 
-    # Assert time series has at least TIMESERIESLENGTH elements
-    if len(temperature_data) < TIMESERIESLENGTH:
-        error_message = f"Time series of length {len(temperature_data)} does not have enough samples ({TIMESERIESLENGTH} samples required)."
-        logging.warning(error_message)
-        return create_response(has_error=True, error_message=error_message)
 
-    # Convert data to sktime format
-    case_id, dim_id = 0, 0
+def prepare_stateful_window(payload, window_length=TIMESERIESLENGTH):
+    connection_device_id = payload.connection_device_id
     try:
-        long_data = [
-            [case_id, dim_id, reading_id, reading_data]
-            for reading_id, reading_data in enumerate(
-                temperature_data[-TIMESERIESLENGTH:]
-            )
-        ]
+        window, window_time_created, count = window_store(window_length).append(
+            connection_device_id, payload.temperature, payload.time_created
+        )
     except Exception as e:
+        # e.g. device IDs that can't be dict keys
         error_message = (
-            f"Could not convert dataset to long format due to exception: '{e}'"
+            f"Could not convert dataset to panel format due to exception: '{e}'"
         )
         logging.error(error_message)
-        return create_response(has_error=True, error_message=error_message)
+        return None, None, create_response(has_error=True, error_message=error_message)
 
-    # Predict
-    long_df = pd.DataFrame(
-        long_data, columns=["case_id", "dim_id", "reading_id", "value"]
-    )
-    sktime_df = from_long_to_nested(long_df)
-    prediction = model.predict(sktime_df).tolist()[0]
-
-    return create_response(
-        prediction=prediction,
-        connection_device_id=connection_device_id,
-        time_created_start=time_created_start,
-        time_created_end=time_created_end,
+    # Wait until the device has sent window_length readings
+    if window is None:
+        error_message = f"Window of device '{connection_device_id}' holds {count} of {window_length} readings."
+        logging.info(error_message)
+        return (
+            None,
+            None,
+            create_response(
+                connection_device_id=connection_device_id,
+                has_error=True,
+                error_message=error_message,
+            ),
+        )
+
+    fields = {
+        "connection_device_id": connection_device_id,
+        "time_created_start": window_time_created[0],
+        "time_created_end": window_time_created[-1],
+    }
+    return window, fields, None
+
+
+def requested_model(payload, default=None):
+    # The "model" field of a JSON payload, or the model of a decoded binary one
+    if isinstance(payload, dict):
+        return payload.get("model", default)
+    if isinstance(payload, DecodedPayload) and payload.model is not None:
+        return payload.model
+    return default
+
+
+def run_batch(payloads, model_name=None):
+    # Score many payloads with one predict call per model. A payload's "model" field picks the model,
+    # model_name applies to payloads without one. Invalid payloads get their own error response, the
+    # responses keep the order of the payloads.
+    responses = [None] * len(payloads)
+    pending = {}  # model id -> (ScoringModel, windows, [(i, fields, cache_key)])
+    for i, payload in enumerate(payloads):
+        try:
+            model_id = resolve_model(requested_model(payload, model_name))
+        except ValueError as e:
+            logging.warning(str(e))
+            responses[i] = create_response(has_error=True, error_message=str(e))
+            continue
+        try:
+            entry = model_cache.get(model_id)
+        except Exception as e:
+            error_message = f"Could not load model '{model_id}' due to exception: '{e}'"
+            logging.error(error_message)
+            responses[i] = create_response(has_error=True, error_message=error_message)
+            continue
+
+        try:
+            window, fields, error_response = prepare_window(
+                payload, entry.window_length
+            )
+        except Exception as e:
+            error_message = f"Could not parse payload due to exception: '{e}'"
+            logging.error(error_message)
+            error_response = create_response(
+                has_error=True, error_message=error_message
+            )
+
+        if error_response is not None:
+            responses[i] = error_response
+            continue
+
+        # Devices often re-send the same window
+        cache_key = prediction_cache.key(window, entry.model_version)
+        cached, prediction = prediction_cache.get(cache_key)
+        if cached:
+            responses[i] = create_response(prediction=prediction, **fields)
+            continue
+        _, windows, waiting = pending.setdefault(model_id, (entry, [], []))
+        windows.append(window)
+        waiting.append((i, fields, cache_key))
+
+    for entry, windows, waiting in pending.values():
+        # Stack all windows of a model into one (n_cases, 1, window_length) panel
+        panel = np.stack(windows)[:, np.newaxis, :]
+        predictions = predict(entry, panel).tolist()
+        for (i, fields, cache_key), prediction in zip(waiting, predictions):
+            prediction_cache.put(cache_key, prediction)
+            responses[i] = create_response(prediction=prediction, **fields)
+
+    return responses
+
+
+def handle_payload(data):
+    # A list of payloads, or an object with a "batch" key, is scored as one batch
+    if isinstance(data, list):
+        return run_batch(data)
+    if "batch" in data:
+        return run_batch(data["batch"], data.get("model"))
+    if data.get("stats"):
+        return stats()
+
+    return run_batch([data])[0]
+
+
+def handle_request(body: bytes, content_type_header: str = None, handle=handle_payload):
+    # A /score request body -> (status, response body, Content-Type), scored by handle(data). The
+    # response uses the encoding of the request, errors are JSON: 400 for bodies that don't decode,
+    # 500 for anything failing after that. Shared by run_raw and server.py.
+    encoding = content_type(content_type_header)
+    try:
+        data = decode_request(body, encoding)
+    except Exception as e:
+        name = "JSON" if encoding == JSON else f"{encoding} body"
+        return 400, json.dumps({"error": f"Invalid {name}: {e}"}).encode(), JSON
+    try:
+        return 200, encode_response(handle(data), encoding), encoding
+    except Exception as e:
+        return 500, json.dumps({"error": str(e)}).encode(), JSON
+
+
+def run_raw(request):
+    if request.method != "POST":
+        return AMLResponse(json.dumps({"error": "Use POST"}), 405, json_str=True)
+    status, body, encoding = handle_request(
+        request.get_data(cache=False), request.headers.get("Content-Type")
     )
+    return AMLResponse(body, status, {"Content-Type": encoding})
+
+
+@rawhttp
+def run(data):
+    logging.info("started run.")
+
+    # Deployed, data is the raw request. Local callers pass the JSON string.
+    if not isinstance(data, (str, bytes)):
+        return run_raw(data)
+
+    # CONVERT STREAM ANALYTICS TO SKTIME FORMAT
+    logging.info("loading json.")
+    data = json.loads(data)
+    logging.info("json loaded.")
+
+    return handle_payload(data)
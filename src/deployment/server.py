@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import score
+from utils import DecodedPayload
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Server Error"}
+
+
+class MicroBatcher:
+    # Queues single payloads and scores them with one score.run_batch call once max_batch_size
+    # payloads are waiting or the oldest one waited max_wait_ms. At most `workers` batches are scored
+    # at the same time, so requests pile up into bigger batches while all workers are busy.
+    def __init__(self, loop, max_batch_size=32, max_wait_ms=5.0, workers=1):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._workers = asyncio.Semaphore(workers)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+    async def submit(self, payload):
+        future = self._loop.create_future()
+        await self._queue.put((payload, future))
+        return await future
+
+    async def score(self, function, *args):
+        # Run any other scoring call on the same workers
+        return await self._loop.run_in_executor(self._executor, function, *args)
+
+    async def serve(self):
+        while True:
+            await self._workers.acquire()
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self._flush(batch))
+
+    async def _flush(self, batch):
+        try:
+            responses = await self.score(score.run_batch, [p for p, _ in batch])
+        except Exception as e:
+            logging.exception("Batch failed.")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+        finally:
+            self._workers.release()
+
+
+async def handle_payload(batcher, data):
+    # Same request shapes as score.run: single payloads are micro-batched, lists and
+    # {"batch": [...]} are already batches. A single FLOAT32 frame is micro-batched like a single
+    # JSON payload.
+    if (
+        isinstance(data, list)
+        and len(data) == 1
+        and isinstance(data[0], DecodedPayload)
+    ):
+        return await batcher.submit(data[0])
+    if isinstance(data, list):
+        return await batcher.score(score.run_batch, data)
+    if isinstance(data, dict) and "batch" in data:
+        return await batcher.score(score.run_batch, data["batch"], data.get("model"))
+    if isinstance(data, dict) and data.get("stats"):
+        return score.stats()
+    return await batcher.submit(data)
+
+
+def blocking_handler(batcher, loop):
+    # handle(data) for score.handle_request, which runs on a request thread and waits for the
+    # event loop to score the payload
+    def handle(data):
+        return asyncio.run_coroutine_threadsafe(
+            handle_payload(batcher, data), loop
+        ).result()
+
+    return handle
+
+
+async def read_request(reader):
+    # Minimal HTTP/1.1 parser: request line, headers and a Content-Length body
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, version = request_line.decode("latin-1").split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, version, headers, body
+
+
+def write_response(writer, status, body, content_type="application/json", close=False):
+    writer.write(
+        (
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        ).encode("latin-1")
+        + body
+    )
+
+
+async def handle_connection(batcher, requests, reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, path, version, headers, body = request
+            close = (
+                headers.get("connection", "").lower() == "close"
+                or version == "HTTP/1.0"
+            )
+
+            if method == "GET" and path == "/":
+                write_response(writer, 200, b"Healthy", "text/plain", close)
+            elif method == "POST" and path == "/score":
+                # Decoding and encoding run on a request thread, so big bodies don't block the loop
+                status, body, encoding = await loop.run_in_executor(
+                    requests,
+                    score.handle_request,
+                    body,
+                    headers.get("content-type"),
+                    blocking_handler(batcher, loop),
+                )
+                write_response(writer, status, body, encoding, close)
+            else:
+                write_response(writer, 404, b"Not Found", "text/plain", close)
+
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    batcher = MicroBatcher(
+        asyncio.get_running_loop(),
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        workers=args.workers,
+    )
+    # Every request in flight holds a thread while it waits for its batch
+    requests = ThreadPoolExecutor(max_workers=args.request_threads)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(batcher, requests, reader, writer),
+        args.host,
+        args.port,
+    )
+    batching = asyncio.ensure_future(batcher.serve())
+    print(f"Scoring Uri: 'http://{args.host}:{args.port}/score'")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            batching.cancel()
+            requests.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="bind address")
+    parser.add_argument("--port", type=int, default=5001, help="bind port")
+    parser.add_argument(
+        "--model_dir", type=str, default=None, help="overrides AZUREML_MODEL_DIR"
+    )
+    parser.add_argument(
+        "--max_batch_size", type=int, default=32, help="payloads per predict call"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=5.0,
+        help="longest time a payload waits for its batch to fill",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="batches scored concurrently"
+    )
+    parser.add_argument(
+        "--request_threads",
+        type=int,
+        default=64,
+        help="requests decoded, waiting for their batch or encoded concurrently",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    if args.model_dir is not None:
+        os.environ["AZUREML_MODEL_DIR"] = args.model_dir
+    score.init()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
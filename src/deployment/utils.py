@@ -1,37 +1,360 @@
 import logging
+from operator import itemgetter
 
+import numpy as np
+
+# Stream Analytics payload, as checked by decode_payload:
+# {
+#     "allevents": [                   non-empty list of event objects, oldest first
+#         {
+#             "temperature": number,   anything np.float64 accepts, only the scored readings are checked
+#             "timeCreated": str,      passed through to the response
+#             "ConnectionDeviceId": str,
+#         },
+#     ],
+#     "ConnectionDeviceId": str,       optional, else all events must carry the same one
+#     "stateful": bool,                optional, see DeviceWindowStore
+# }
+# or a device upload in the series format of sample.json:
+# {
+#     "granularity": str,              a key of GRANULARITIES, the spacing the series is resampled to
+#     "series": [                      non-empty list of readings, in any order and possibly with gaps
+#         {"value": number, "timestamp": str},   see parse_timestamps
+#     ],
+#     "ConnectionDeviceId": str,       optional, required for stateful payloads
+#     "stateful": bool,                optional
+# }
+# Error messages are the ones the scoring service always returned for these payloads.
+PAYLOAD_ERROR_LEVELS = {
+    "malformed": logging.ERROR,
+    "device_id": logging.WARNING,
+    "too_short": logging.WARNING,
+    "conversion": logging.ERROR,
+}
+# Seconds between the readings of a series payload
+GRANULARITIES = {"secondly": 1, "minutely": 60, "hourly": 3600, "daily": 86400}
+
+
+class PayloadError:
+    __slots__ = ["kind", "message"]
+
+    def __init__(self, kind: str, message: str):
+        self.kind = kind
+        self.message = message
+        logging.log(PAYLOAD_ERROR_LEVELS[kind], message)
+
+
+class DecodedPayload:
+    # The readings to score and the fields of the response, or the error to respond with.
+    # temperature holds the last window_length readings, or all readings of stateful payloads.
+    # time_created is only filled for stateful payloads, model only for binary ones (see encoding.py).
+    __slots__ = [
+        "temperature",
+        "time_created",
+        "time_created_start",
+        "time_created_end",
+        "connection_device_id",
+        "stateful",
+        "model",
+        "error",
+    ]
+
+    def __init__(self, error: PayloadError = None):
+        self.temperature = None
+        self.time_created = None
+        self.time_created_start = None
+        self.time_created_end = None
+        self.connection_device_id = None
+        self.stateful = False
+        self.model = None
+        self.error = error
+
+
+def _malformed(message: str):
+    return DecodedPayload(
+        PayloadError(
+            "malformed", f"Could not parse payload due to exception: '{message}'"
+        )
+    )
+
+
+def _not_an_event(event):
+    return f"'{type(event).__name__}' object has no attribute 'get'"
+
+
+def _events_error(events):
+    # What indexing the first event of a non-list "allevents" fails with
+    if isinstance(events, dict):
+        return "0"
+    if isinstance(events, str):
+        return _not_an_event(events) if events else "string index out of range"
+    return f"'{type(events).__name__}' object is not subscriptable"
+
+
+def _device_id_error(events):
+    # Rare, so the events are walked again to name all IDs
+    try:
+        device_ids = list(
+            set(
+                [
+                    event.get("ConnectionDeviceId")
+                    for event in events
+                    if event.get("ConnectionDeviceId") is not None
+                ]
+            )
+        )
+    except TypeError as e:
+        return _malformed(e)
+    return DecodedPayload(
+        PayloadError("device_id", f"Multiple ConnectionDeviceIds found ({device_ids}).")
+    )
+
+
+# granularity_seconds, parse_timestamps and resample_series are copied from preprocess/utils.py, the
+# scoring image only gets this folder. Change them together.
+def granularity_seconds(granularity):
+    if not isinstance(granularity, str) or granularity not in GRANULARITIES:
+        raise ValueError(
+            f"Unknown granularity {granularity!r}, expected one of {sorted(GRANULARITIES)}."
+        )
+    return GRANULARITIES[granularity]
+
+
+def parse_timestamps(timestamps):
+    # ISO 8601 strings like "2020-06-28 11:33:00+02:00" -> datetime64[s] in UTC. The date and time,
+    # with or without seconds, are parsed by NumPy in one go and fractions of a second are dropped.
+    # The offset is parsed here: "Z" and no offset read as UTC, +HH:MM, +HHMM and +HH (or with "-")
+    # are subtracted. Raises ValueError for anything else.
+    raw = np.asarray(timestamps, dtype=bytes)
+    if not len(raw):
+        return np.empty(0, dtype="datetime64[s]")
+    lengths = np.char.str_len(raw)
+    if np.any(lengths < 16):
+        raise ValueError("Timestamps must look like yyyy-mm-ddThh:mm[:ss[.f]][offset].")
+    # Zero padding behind every timestamp, so the offset can be sliced out of the longest one
+    chars = np.zeros((len(raw), raw.itemsize + 7), dtype=np.uint8)
+    chars[:, : raw.itemsize] = raw.view(np.uint8).reshape(len(raw), raw.itemsize)
+    if np.any((chars[:, 10] != ord("T")) & (chars[:, 10] != ord(" "))):
+        raise ValueError("Timestamps must separate date and time with 'T' or ' '.")
+
+    # Where the offset starts: after hh:mm, :ss and the digits of a fraction
+    has_seconds = chars[:, 16] == ord(":")
+    ends = np.where(has_seconds, 19, 16)
+    has_fraction = has_seconds & (chars[:, 19] == ord("."))
+    if np.any(has_fraction):
+        digit = (chars >= ord("0")) & (chars <= ord("9"))
+        fraction_ends = np.argmax(~digit & (np.arange(chars.shape[1]) > 19), axis=1)
+        if np.any(fraction_ends[has_fraction] == 20):
+            raise ValueError("Timestamp fractions must have digits.")
+        ends = np.where(has_fraction, fraction_ends, ends)
+
+    # "yyyy-mm-ddThh:mm:ss" without fraction and offset, seconds default to zero
+    local = np.full((len(raw), 19), ord("0"), dtype=np.uint8)
+    local[:, :16] = chars[:, :16]
+    local[:, 10] = ord("T")
+    local[:, 16] = ord(":")
+    local[has_seconds, 17:19] = chars[has_seconds, 17:19]
+    utc = local.view("S19").ravel().astype("datetime64[s]")
+
+    offset_lengths = lengths - ends
+    offsets = np.take_along_axis(chars, ends[:, np.newaxis] + np.arange(6), axis=1)
+    signed = (offsets[:, 0] == ord("+")) | (offsets[:, 0] == ord("-"))
+    valid = (
+        (offset_lengths == 0)
+        | ((offset_lengths == 1) & (offsets[:, 0] == ord("Z")))
+        | (signed & np.isin(offset_lengths, (3, 5, 6)))
+    )
+    colon = offset_lengths == 6
+    if not np.all(valid) or np.any(offsets[signed & colon, 3] != ord(":")):
+        raise ValueError("Timestamp offsets must be Z, +HH:MM, +HHMM or +HH.")
+    if not np.any(signed):
+        return utc
+
+    rows = np.flatnonzero(signed)
+    offsets, offset_lengths, colon = offsets[rows], offset_lengths[rows], colon[rows]
+    # +HH:MM -> +HHMM and +HH -> +HH00
+    offsets[colon, 3:5] = offsets[colon, 4:6]
+    offsets[offset_lengths == 3, 3:5] = ord("0")
+    digits = offsets[:, 1:5].astype(np.int64) - ord("0")
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 2] * 10 + digits[:, 3]
+    if np.any((digits < 0) | (digits > 9)) or np.any((hours > 23) | (minutes > 59)):
+        raise ValueError("Timestamp offsets must be Z, +HH:MM, +HHMM or +HH.")
+    sign = np.where(offsets[:, 0] == ord("-"), -1, 1)
+    utc[rows] -= (sign * (hours * 3600 + minutes * 60)).astype("timedelta64[s]")
+    return utc
+
+
+def resample_series(times, values, step: int, keep_last: int = None):
+    # Put readings onto a grid of step seconds, from the first to the last reading. Every reading
+    # goes to the nearest grid point, the latest one wins where several do, and grid points without
+    # a reading repeat the one before. With keep_last, only the last keep_last grid points are built.
+    # Returns the grid (datetime64[s]), its values and the length of the full grid.
+    seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+    values = np.asarray(values)
+    if not len(seconds):
+        return seconds.astype("datetime64[s]"), values, 0
+    order = np.argsort(seconds, kind="stable")
+    slots = (seconds[order] + step // 2) // step
+    latest = np.append(slots[1:] != slots[:-1], True)
+    slots, order = slots[latest], order[latest]
+    length = int(slots[-1] - slots[0]) + 1
+
+    # The grid starts keep_last points before the end, filled from the last reading before it
+    start = slots[0] if keep_last is None else max(slots[0], slots[-1] - keep_last + 1)
+    first = np.searchsorted(slots, start, side="right") - 1
+    positions = np.maximum(slots[first:] - start, 0)
+    filled = np.zeros(positions[-1] + 1, dtype=np.intp)
+    filled[positions] = np.arange(len(positions))
+    filled = np.maximum.accumulate(filled)
+
+    grid = (np.arange(start, slots[-1] + 1) * step).astype("datetime64[s]")
+    return grid, values[order[first:]][filled], length
+
+
+def _decode_series(data: dict, window_length: int):
+    # A payload in the series format, resampled onto its granularity before the window is cut
+    stateful = bool(data.get("stateful"))
+    series = data.get("series")
+    if not isinstance(series, list) or not series:
+        return _malformed("series must be a non-empty list")
+    try:
+        step = granularity_seconds(data.get("granularity"))
+    except ValueError as e:
+        return _malformed(e)
 
-def get_connection_device_id(data):
-    # Check if ConnectionDeviceId is provided as a key value pair.
     connection_device_id = data.get("ConnectionDeviceId")
-    if connection_device_id is not None:
-        logging.info(f"ConnectionDeviceId: '{connection_device_id}'")
-        return connection_device_id, False, None
+    if not isinstance(connection_device_id, (str, type(None))):
+        return _malformed("ConnectionDeviceId must be a string")
+    if stateful and connection_device_id is None:
+        return DecodedPayload(
+            PayloadError("device_id", "No ConnectionDeviceIds found.")
+        )
 
-    # If not connection_device_id key exists, get connection_device_id from the single events
-    unique_connection_device_ids = list(
-        set(
-            [
-                event.get("ConnectionDeviceId")
-                for event in data.get("allevents")
-                if event.get("ConnectionDeviceId") is not None
-            ]
+    try:
+        values = np.fromiter(
+            map(itemgetter("value"), series), dtype=np.float64, count=len(series)
+        )
+        times = parse_timestamps(list(map(itemgetter("timestamp"), series)))
+    except Exception as e:
+        return DecodedPayload(
+            PayloadError(
+                "conversion",
+                f"Could not convert dataset to panel format due to exception: '{e}'",
+            )
         )
+    grid, temperature, length = resample_series(
+        times, values, step, keep_last=window_length
     )
+    if not stateful and length < window_length:
+        return DecodedPayload(
+            PayloadError(
+                "too_short",
+                f"Time series of length {length} does not have enough samples ({window_length} samples required).",
+            )
+        )
 
-    if len(unique_connection_device_ids) > 1:
-        error_message = (
-            f"Multiple ConnectionDeviceIds found ({unique_connection_device_ids})."
+    time_created = np.datetime_as_string(grid, timezone="UTC").tolist()
+    decoded = DecodedPayload()
+    decoded.temperature = temperature
+    decoded.time_created_start = time_created[0]
+    decoded.time_created_end = time_created[-1]
+    decoded.connection_device_id = connection_device_id
+    decoded.stateful = stateful
+    decoded.time_created = time_created if stateful else None
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info(f"time_created_start: {decoded.time_created_start}")
+        logging.info(f"time_created_end: {decoded.time_created_end}")
+        logging.info(f"temperature_data: {temperature.tolist()}")
+    return decoded
+
+
+def decode_payload(data, window_length: int):
+    # Validate a payload against the schema above in one pass over its events. Binary payloads
+    # arrive decoded already, only their window is left to cut.
+    if isinstance(data, DecodedPayload):
+        if data.error is not None:
+            return data
+        return _cut_window(data, data.temperature, window_length)
+    if not isinstance(data, dict):
+        return _malformed(_not_an_event(data))
+    if "series" in data and "allevents" not in data:
+        return _decode_series(data, window_length)
+    events = data.get("allevents")
+    if not isinstance(events, list):
+        return _malformed(_events_error(events))
+    if not events:
+        return _malformed("list index out of range")
+    for event in (events[0], events[-1]):
+        if not isinstance(event, dict):
+            return _malformed(_not_an_event(event))
+
+    # The device ID of the payload, else the one all events agree on
+    connection_device_id = data.get("ConnectionDeviceId")
+    from_events = connection_device_id is None
+    conflicting = False
+    stateful = bool(data.get("stateful"))
+    temperature = []
+    time_created = [] if stateful else None
+    for event in events:
+        if not isinstance(event, dict):
+            return _malformed(_not_an_event(event))
+        temperature.append(event.get("temperature"))
+        if stateful:
+            time_created.append(event.get("timeCreated"))
+        if from_events:
+            device_id = event.get("ConnectionDeviceId")
+            if device_id is not None:
+                if isinstance(device_id, (list, dict)):
+                    conflicting = True
+                elif connection_device_id is None:
+                    connection_device_id = device_id
+                elif device_id != connection_device_id:
+                    conflicting = True
+
+    decoded = DecodedPayload()
+    decoded.time_created_start = events[0].get("timeCreated")
+    decoded.time_created_end = events[-1].get("timeCreated")
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info(f"time_created_start: {decoded.time_created_start}")
+        logging.info(f"time_created_end: {decoded.time_created_end}")
+        logging.info(f"temperature_data: {temperature}")
+
+    if conflicting:
+        return _device_id_error(events)
+    if connection_device_id is None:
+        return DecodedPayload(
+            PayloadError("device_id", "No ConnectionDeviceIds found.")
         )
-        logging.warning(error_message)
-        return None, True, error_message
-    if len(unique_connection_device_ids) < 1:
-        error_message = "No ConnectionDeviceIds found."
-        logging.warning(error_message)
-        return None, True, error_message
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info(f"ConnectionDeviceId: '{connection_device_id}'")
+    decoded.connection_device_id = connection_device_id
+    decoded.stateful = stateful
+    decoded.time_created = time_created
+    return _cut_window(decoded, temperature, window_length)
 
-    logging.info(f"ConnectionDeviceId: '{unique_connection_device_ids[0]}'")
-    return unique_connection_device_ids[0], False, None
+
+def _cut_window(decoded: DecodedPayload, temperature, window_length: int):
+    # Stateful payloads extend the device's window, all of their readings are used
+    if not decoded.stateful:
+        if len(temperature) < window_length:
+            return DecodedPayload(
+                PayloadError(
+                    "too_short",
+                    f"Time series of length {len(temperature)} does not have enough samples ({window_length} samples required).",
+                )
+            )
+        temperature = temperature[-window_length:]
+    try:
+        decoded.temperature = np.asarray(temperature, dtype=np.float64)
+    except Exception as e:
+        return DecodedPayload(
+            PayloadError(
+                "conversion",
+                f"Could not convert dataset to panel format due to exception: '{e}'",
+            )
+        )
+    return decoded
 
 
 def create_response(
@@ -50,3 +373,22 @@ def create_response(
         "hasError": has_error,
         "errorMessage": error_message,
     }
+
+
+def panel_to_nested(panel: np.ndarray):
+    # sktime's nested format: one column per dimension, holding one pd.Series per case
+    import pandas as pd
+
+    n_cases, n_dims, _ = panel.shape
+    return pd.DataFrame(
+        {
+            f"dim_{dim_id}": pd.Series(
+                [
+                    pd.Series(panel[case_id, dim_id], dtype=np.float64)
+                    for case_id in range(n_cases)
+                ],
+                dtype=object,
+            )
+            for dim_id in range(n_dims)
+        }
+    )
@@ -1,64 +1,263 @@
 import argparse
-import json
+import datetime
 import os
+import shutil
 
-import pandas as pd
-from azureml.core import Dataset, Run
+import numpy as np
 
-time_series_length = 10
-
-# Load arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("--dataset_name", type=str, help="name of the input dataset")
-parser.add_argument("--output", type=str, help="output data")
-parser.add_argument(
-    "--time_series_length", type=int, help="number of samles per time series"
+from utils import (
+    case_digests,
+    concatenate_partitions,
+    decode_allevents,
+    decode_series,
+    list_partitions,
+    load_partition_state,
+    partition_fingerprint,
+    partition_path,
+    preprocess_partition,
+    ragged_to_panel,
+    read_allevents,
+    read_series,
+    save_panel,
+    save_partition_state,
+    stale_partitions,
 )
-args = parser.parse_args()
 
-ws = Run.get_context().experiment.workspace
 
-rawdata = Dataset.get_by_name(ws, name=args.dataset_name)
-# input_named = input_data.as_named_input('rawdata')
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_name", type=str, help="name of the input dataset")
+    parser.add_argument("--output", type=str, help="output data")
+    parser.add_argument(
+        "--time_series_length", type=int, help="number of samles per time series"
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=10000, help="rows decoded per worker task"
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="decoding processes (default: all cores)",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="float64",
+        choices=["float64", "float32"],
+        help="storage dtype of the panel",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="per-partition panel cache, only new or changed partitions are parsed",
+    )
+    parser.add_argument(
+        "--local_root",
+        type=str,
+        default=None,
+        help="read /yyyy/MM/dd/ JSON lines files from here instead of the dataset",
+    )
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        default="allevents",
+        choices=["allevents", "series"],
+        help="Stream Analytics 'allevents' rows or device uploads like sample.json "
+        "('granularity' and 'series'), which are resampled onto their granularity",
+    )
+    args = parser.parse_args()
+    return args
 
-# Get dataframe
-# rawdata = Run.get_context().input_datasets["rawdata"]
-rawdata_df = rawdata.to_pandas_dataframe()
 
-# Convert to JSON
-rawdata_df["allevents"] = rawdata_df["allevents"].apply(lambda x: json.loads(x))
+def get_dataset(name):
+    # azureml is only needed when reading the registered dataset
+    from azureml.core import Dataset, Run
 
-# Reset PartitionDate Index to a simple range. We'll use it to index our "cases" ("samples")
-rawdata_df.reset_index(drop=True, inplace=True)
+    ws = Run.get_context().experiment.workspace
+    return Dataset.get_by_name(ws, name=name)
 
 
-# sktime expects a specific format. For now the easiest way is to convert our DataFrame to a long format
-# and then use the sktime parser.
-def dataframe_to_long(df, size):
-    case_id = 0
-    for _, case in df.iterrows():
-        events = case["allevents"]
+def raw_column(df, input_format: str):
+    # The column decode_raw takes, series documents are rebuilt from their two columns
+    if input_format == "series":
+        return df[["granularity", "series"]].to_dict("records")
+    return df["allevents"]
 
-        # We ignore cases with insufficient readings
-        if len(events) < size:
-            continue
 
-        # We also slice samples with too many readings ([-size:])
-        for reading_id, values in enumerate(events[-size:]):
-            yield case_id, 0, reading_id, values["temperature"]
-            # We can add more dimensions later on.
-            # yield case_id, 1, reading_id, values["ambienttemperature"]
+def partition_metadata(row_partitions, case_index):
+    # The partitions and partition_cases of a panel parsed in one go from rows in PartitionDate
+    # order, like concatenate_partitions records them. Warm starts need them.
+    partitions, row_codes = np.unique(np.asarray(row_partitions), return_inverse=True)
+    return {
+        "partitions": partitions.tolist(),
+        "partition_cases": np.bincount(
+            row_codes[case_index], minlength=len(partitions)
+        ).tolist(),
+    }
 
-        case_id += 1  # can't use the row index because we skip rows.
 
+def main(args):
+    if args.input_format == "series":
+        read_raw, decode_raw = read_series, decode_series
+    else:
+        read_raw, decode_raw = read_allevents, decode_allevents
+
+    if not (args.output is None):
+        os.makedirs(args.output, exist_ok=True)
+        print("%s created" % args.output)
+
+    if args.cache_dir is None:
+        # Parse everything, in PartitionDate order where the rows have one
+        row_partitions = None
+        if args.local_root is not None:
+            raw_allevents, row_partitions = [], []
+            for partition_date, paths in list_partitions(args.local_root).items():
+                partition_rows = read_raw(paths)
+                raw_allevents.extend(partition_rows)
+                row_partitions.extend([partition_date] * len(partition_rows))
+        else:
+            rawdata = get_dataset(args.dataset_name)
+            # input_named = input_data.as_named_input('rawdata')
+
+            # Get dataframe
+            # rawdata = Run.get_context().input_datasets["rawdata"]
+            rawdata_df = rawdata.to_pandas_dataframe()
+            if "PartitionDate" in rawdata_df.columns:
+                rawdata_df = rawdata_df.sort_values("PartitionDate", kind="mergesort")
+                row_partitions = rawdata_df["PartitionDate"].dt.strftime("%Y-%m-%d")
+            raw_allevents = raw_column(rawdata_df, args.input_format)
+
+        # Decode the JSON events in parallel, keeping only the readings we need
+        decoded = decode_raw(
+            raw_allevents,
+            keep_last=args.time_series_length,
+            chunk_size=args.chunk_size,
+            n_workers=args.n_workers,
+        )
+
+        # Build a dense (n_cases, n_dims, time_series_length) panel
+        panel, case_index = ragged_to_panel(
+            decoded, time_series_length=args.time_series_length
+        )
+
+        # Store output
+        save_panel(
+            args.output,
+            panel,
+            case_index,
+            dtype=args.dtype,
+            digests=case_digests(raw_allevents)[case_index],
+            dimensions=["temperature"],
+            dataset_name=args.dataset_name,
+            **(
+                {}
+                if row_partitions is None
+                else partition_metadata(row_partitions, case_index)
+            ),
+        )
+    else:
+        # Incremental: only parse partitions that are new or changed since the last run
+        config = {
+            "time_series_length": args.time_series_length,
+            "dtype": args.dtype,
+            "dimensions": ["temperature"],
+        }
+        # Only recorded when it differs from the default, so existing caches stay valid
+        if args.input_format != "allevents":
+            config["input_format"] = args.input_format
+        state = load_partition_state(args.cache_dir)
+        cached = state["partitions"] if state["config"] == config else {}
+
+        if args.local_root is not None:
+            sources = list_partitions(args.local_root)
+            fingerprints = {
+                partition_date: partition_fingerprint(paths)
+                for partition_date, paths in sources.items()
+            }
+            partition_dates = sorted(fingerprints)
+
+            def raw_partition(partition_date):
+                return read_raw(sources[partition_date])
+
+        else:
+            rawdata = get_dataset(args.dataset_name)
+            if cached:
+                # Only load the partitions from the watermark on. The watermark partition itself is
+                # reloaded, Stream Analytics may have appended to it since.
+                rawdata = rawdata.with_timestamp_columns(
+                    partition_timestamp="PartitionDate"
+                ).time_after(
+                    datetime.datetime.strptime(state["watermark"], "%Y-%m-%d"),
+                    include_boundary=True,
+                )
+            rawdata_df = rawdata.to_pandas_dataframe()
+            partition_column = rawdata_df["PartitionDate"].dt.strftime("%Y-%m-%d")
+            # A registered dataset can't tell whether a partition changed, all loaded ones are parsed
+            fingerprints = dict.fromkeys(partition_column.unique())
+            partition_dates = sorted(set(cached) | set(fingerprints))
+
+            def raw_partition(partition_date):
+                return raw_column(
+                    rawdata_df.loc[partition_column == partition_date],
+                    args.input_format,
+                )
+
+        if not partition_dates:
+            source = args.local_root or f"dataset {args.dataset_name}"
+            raise SystemExit(
+                f"No partitions found in {source} or {args.cache_dir}, nothing to preprocess."
+            )
+
+        stale = stale_partitions(state, fingerprints, config)
+        for partition_date in stale:
+            metadata = preprocess_partition(
+                args.cache_dir,
+                partition_date,
+                raw_partition(partition_date),
+                time_series_length=args.time_series_length,
+                dtype=args.dtype,
+                chunk_size=args.chunk_size,
+                n_workers=args.n_workers,
+                input_format=args.input_format,
+            )
+            print(
+                f"Partition {partition_date}: {metadata['n_cases']} cases "
+                f"from {metadata['n_rows']} rows"
+            )
+        print(f"{len(stale)} of {len(partition_dates)} partitions parsed")
+
+        # Drop partitions that disappeared from the source
+        for partition_date in set(cached) - set(partition_dates):
+            shutil.rmtree(
+                partition_path(args.cache_dir, partition_date), ignore_errors=True
+            )
+
+        # Store output
+        concatenate_partitions(
+            args.cache_dir,
+            partition_dates,
+            args.output,
+            dimensions=["temperature"],
+            dataset_name=args.dataset_name,
+        )
+        save_partition_state(
+            args.cache_dir,
+            {
+                "watermark": partition_dates[-1],
+                "config": config,
+                "partitions": {
+                    partition_date: fingerprints.get(
+                        partition_date, cached.get(partition_date)
+                    )
+                    for partition_date in partition_dates
+                },
+            },
+        )
 
-df_long = pd.DataFrame(
-    dataframe_to_long(rawdata_df, size=args.time_series_length),
-    columns=["case_id", "dim_id", "reading_id", "value"],
-)
 
-# Store output
-if not (args.output is None):
-    os.makedirs(args.output, exist_ok=True)
-    print("%s created" % args.output)
-df_long.to_pickle(os.path.join(args.output, "df_long.pkl"))
+# Worker processes import this module again, e.g. on Windows where they are spawned
+if __name__ == "__main__":
+    args = parse_args()
+    main(args=args)
@@ -0,0 +1,246 @@
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from generate_data import write_partitions
+from utils import (
+    decode_allevents,
+    link_panel,
+    load_panel,
+    panel_labels,
+    ragged_to_panel,
+    save_labels,
+    save_panel,
+)
+
+# train/utils.py holds prepare_dataframe and the nested conversion, it shares the module name with
+# preprocess/utils.py.
+_spec = importlib.util.spec_from_file_location(
+    "train_utils",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "train", "utils.py"),
+)
+train_utils = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(train_utils)
+
+
+def iterrows_to_long(raw_df, size):
+    # The original 01_raw_to_long.py implementation, kept as a baseline
+    df = raw_df.copy()
+    df["allevents"] = df["allevents"].apply(lambda x: json.loads(x))
+    df.reset_index(drop=True, inplace=True)
+
+    def dataframe_to_long(df, size):
+        case_id = 0
+        for _, case in df.iterrows():
+            events = case["allevents"]
+            if len(events) < size:
+                continue
+            for reading_id, values in enumerate(events[-size:]):
+                yield case_id, 0, reading_id, values["temperature"]
+            case_id += 1
+
+    return pd.DataFrame(
+        dataframe_to_long(df, size),
+        columns=["case_id", "dim_id", "reading_id", "value"],
+    )
+
+
+def read_partitions(root):
+    # Local stand-in for Dataset.to_pandas_dataframe()
+    paths = sorted(glob.glob(os.path.join(root, "*", "*", "*", "*.json")))
+    return pd.concat(
+        [pd.read_json(path, lines=True, dtype=False) for path in paths],
+        ignore_index=True,
+    )
+
+
+def stages(args, data_dir, work_dir):
+    # (name, function, max cases) in pipeline order. Every function takes and extends the state dict.
+    length = args.time_series_length
+    panel_dir = os.path.join(work_dir, "panel")
+    labeled_dir = os.path.join(work_dir, "labeled")
+
+    def read(state):
+        state["raw_df"] = read_partitions(data_dir)
+
+    def iterrows_baseline(state):
+        iterrows_to_long(state["raw_df"], length)
+
+    def decode_serial(state):
+        decode_allevents(state["raw_df"]["allevents"], keep_last=length, n_workers=1)
+
+    def decode_parallel(state):
+        state["decoded"] = decode_allevents(
+            state["raw_df"]["allevents"],
+            keep_last=length,
+            chunk_size=args.chunk_size,
+            n_workers=args.workers,
+        )
+
+    def build_panel(state):
+        state["panel"], state["case_index"] = ragged_to_panel(state["decoded"], length)
+
+    def labels(state):
+        panel_labels(state["panel"], args.threshold)
+
+    def write_panel(state):
+        save_panel(panel_dir, state["panel"], state["case_index"], dtype=args.dtype)
+        state["panel_bytes"] = sum(
+            os.path.getsize(os.path.join(panel_dir, name))
+            for name in os.listdir(panel_dir)
+        )
+
+    def label_step(state):
+        artifact = load_panel(panel_dir)
+        link_panel(panel_dir, labeled_dir)
+        save_labels(
+            labeled_dir,
+            panel_labels(artifact.panel, args.threshold),
+            threshold=args.threshold,
+        )
+
+    def nested(state):
+        train_utils.panel_to_nested(load_panel(labeled_dir).panel)
+
+    def prepare_dataframe(state):
+        train_utils.prepare_dataframe(
+            state["raw_df"],
+            time_series_length=length,
+            threshold=args.threshold,
+            chunk_size=args.chunk_size,
+            n_workers=args.workers,
+        )
+
+    return [
+        ("read", read, None),
+        ("iterrows_baseline", iterrows_baseline, args.baseline_max_cases),
+        ("decode_serial", decode_serial, None),
+        ("decode_parallel", decode_parallel, None),
+        ("panel", build_panel, None),
+        ("labels", labels, None),
+        ("save_panel", write_panel, None),
+        ("label_step", label_step, None),
+        ("nested", nested, args.nested_max_cases),
+        ("prepare_dataframe", prepare_dataframe, args.nested_max_cases),
+    ]
+
+
+def benchmark_size(args, n_cases):
+    data_dir = os.path.join(args.data_dir, str(n_cases))
+    if not os.path.exists(os.path.join(data_dir, "_SUCCESS")):
+        write_partitions(
+            data_dir, n_cases, n_partitions=args.partitions, seed=args.seed
+        )
+        open(os.path.join(data_dir, "_SUCCESS"), "w").close()
+
+    work_dir = tempfile.mkdtemp()
+    state, results = {}, []
+    try:
+        for name, stage, max_cases in stages(args, data_dir, work_dir):
+            if max_cases is not None and n_cases > max_cases:
+                continue
+            start = time.perf_counter()
+            stage(state)
+            result = {
+                "cases": n_cases,
+                "stage": name,
+                "seconds": time.perf_counter() - start,
+            }
+            result["cases_per_second"] = n_cases / result["seconds"]
+
+            # Run the stage again under tracemalloc, so the timing above is not distorted.
+            # Allocations in worker processes are not traced.
+            if args.memory:
+                tracemalloc.start()
+                stage(state)
+                result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+        results.append(
+            {"cases": n_cases, "stage": "artifact", "bytes": state["panel_bytes"]}
+        )
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def scaling_curves(results):
+    # Per stage: seconds per size and the exponent of a power law fit (1.0 means linear scaling)
+    curves = {}
+    for name in dict.fromkeys(r["stage"] for r in results if "seconds" in r):
+        points = [(r["cases"], r["seconds"]) for r in results if r["stage"] == name]
+        cases, seconds = np.array(points).T
+        curve = {"cases": cases.astype(int).tolist(), "seconds": seconds.tolist()}
+        if len(points) > 1:
+            curve["exponent"] = float(np.polyfit(np.log(cases), np.log(seconds), 1)[0])
+        curves[name] = curve
+    return curves
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        default="1000,10000,100000",
+        help="comma separated numbers of cases",
+    )
+    parser.add_argument(
+        "--data_dir", type=str, default="benchmark_data", help="generated datasets"
+    )
+    parser.add_argument("--partitions", type=int, default=10, help="days per dataset")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--time_series_length", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=180.0)
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--dtype", type=str, default="float64", choices=["float64", "float32"]
+    )
+    parser.add_argument(
+        "--baseline_max_cases",
+        type=int,
+        default=100000,
+        help="largest size for the iterrows baseline",
+    )
+    parser.add_argument(
+        "--nested_max_cases",
+        type=int,
+        default=1000000,
+        help="largest size for the nested sktime conversion",
+    )
+    parser.add_argument(
+        "--memory", action="store_true", help="also measure peak traced memory"
+    )
+    parser.add_argument("--output", type=str, default=None, help="write report here")
+    args = parser.parse_args()
+
+    results = []
+    for n_cases in sorted(int(size) for size in args.sizes.split(",")):
+        results.extend(benchmark_size(args, n_cases))
+
+    report = {
+        "config": vars(args),
+        "results": results,
+        "scaling": scaling_curves(results),
+    }
+    if args.output is not None:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    print(json.dumps(report["scaling"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import datetime
+import json
+import os
+
+import numpy as np
+
+
+def generate_cases(n_cases, rng, start, min_events=5, max_events=30):
+    # One Stream Analytics output row per case: "allevents" holds the JSON encoded events
+    lengths = rng.randint(min_events, max_events + 1, size=n_cases)
+    time_created = [
+        (start + datetime.timedelta(seconds=5 * i)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+        + "0Z"
+        for i in range(max_events)
+    ]
+    temperature = 253 + rng.randn(lengths.sum()).cumsum() * 0.05
+    temperature += np.repeat(rng.randn(n_cases) * 10, lengths)
+    ambient = 21 + rng.randn(lengths.sum())
+
+    device_ids = rng.randint(1000, size=n_cases)
+
+    offset = 0
+    for length, device_number in zip(lengths, device_ids):
+        device_id = f"freezer{device_number:03d}"
+        events = [
+            {
+                "temperature": float(temperature[offset + i]),
+                "ambienttemperature": float(ambient[offset + i]),
+                "timeCreated": time_created[i],
+                "ConnectionDeviceId": device_id,
+            }
+            for i in range(length)
+        ]
+        offset += length
+        yield {"allevents": json.dumps(events), "ConnectionDeviceID": device_id}
+
+
+def write_partitions(
+    root,
+    n_cases,
+    n_partitions=10,
+    seed=0,
+    start_date=datetime.date(2020, 4, 1),
+    chunk_size=10000,
+    min_events=5,
+    max_events=30,
+):
+    # Write n_cases rows as JSON lines into the /yyyy/MM/dd/ layout of the "sensordata" datastore.
+    # Returns the written file paths.
+    rng = np.random.RandomState(seed)
+    partition_sizes = np.full(n_partitions, n_cases // n_partitions)
+    partition_sizes[: n_cases % n_partitions] += 1
+
+    paths = []
+    for day, partition_size in enumerate(partition_sizes):
+        date = start_date + datetime.timedelta(days=day)
+        directory = os.path.join(
+            root, date.strftime("%Y"), date.strftime("%m"), date.strftime("%d")
+        )
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "part-00000.json")
+        start = datetime.datetime.combine(date, datetime.time())
+
+        with open(path, "w") as fh:
+            for chunk_start in range(0, partition_size, chunk_size):
+                n_chunk_cases = min(chunk_size, partition_size - chunk_start)
+                fh.writelines(
+                    json.dumps(row) + "\n"
+                    for row in generate_cases(
+                        n_chunk_cases, rng, start, min_events, max_events
+                    )
+                )
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, required=True, help="output root")
+    parser.add_argument("--cases", type=int, default=1000, help="number of rows")
+    parser.add_argument("--partitions", type=int, default=10, help="number of days")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--min_events", type=int, default=5, help="fewest events per row"
+    )
+    parser.add_argument(
+        "--max_events", type=int, default=30, help="most events per row"
+    )
+    args = parser.parse_args()
+
+    paths = write_partitions(
+        args.output,
+        args.cases,
+        n_partitions=args.partitions,
+        seed=args.seed,
+        min_events=args.min_events,
+        max_events=args.max_events,
+    )
+    print(f"{args.cases} cases written to {len(paths)} partitions in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,551 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+
+import numpy as np
+
+STRING_FIELDS = ("timeCreated", "ConnectionDeviceId")
+PANEL_FORMAT_VERSION = 1
+PARTITION_STATE_FILENAME = "partitions.json"
+# Seconds between the readings of a series document, see decode_series
+GRANULARITIES = {"secondly": 1, "minutely": 60, "hourly": 3600, "daily": 86400}
+
+# A panel artifact on disk: panel.npy, case_index.npy, optionally labels.npy and case_digests.npy, and
+# a metadata.json sidecar.
+PanelArtifact = namedtuple(
+    "PanelArtifact", ["panel", "case_index", "labels", "metadata", "case_digests"]
+)
+
+# Compact, column-wise view of the "allevents" column. "lengths" holds the number of events per case,
+# "counts" the number of events actually kept per case and "columns" one flat array per field.
+DecodedEvents = namedtuple("DecodedEvents", ["lengths", "counts", "columns"])
+
+
+def _decode_chunk(task):
+    raw_chunk, fields, keep_last = task
+    lengths = np.empty(len(raw_chunk), dtype=np.int64)
+    values = {field: [] for field in fields}
+    for i, raw in enumerate(raw_chunk):
+        events = json.loads(raw)
+        lengths[i] = len(events)
+        if keep_last is not None:
+            events = events[-keep_last:]
+        for field in fields:
+            if field in STRING_FIELDS:
+                values[field].extend(event.get(field) or "" for event in events)
+            else:
+                values[field].extend(event[field] for event in events)
+
+    counts = lengths if keep_last is None else np.minimum(lengths, keep_last)
+    columns = {
+        field: np.array(
+            values[field], dtype=str if field in STRING_FIELDS else np.float64
+        )
+        for field in fields
+    }
+    return lengths, counts, columns
+
+
+def decode_allevents(
+    raw_allevents,
+    fields=("temperature",),
+    keep_last: int = None,
+    chunk_size: int = 10000,
+    n_workers: int = None,
+):
+    # Decode the "allevents" JSON strings chunk by chunk in a process pool. Workers only return the
+    # requested fields as flat arrays, so no decoded dicts outlive their chunk.
+    # With keep_last set, only the last keep_last events of every case are kept.
+    raw_allevents = list(raw_allevents)
+    tasks = [
+        (raw_allevents[start : start + chunk_size], tuple(fields), keep_last)
+        for start in range(0, len(raw_allevents), chunk_size)
+    ]
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) <= 1:
+        chunks = [_decode_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks))) as executor:
+            chunks = list(executor.map(_decode_chunk, tasks))
+
+    if not chunks:
+        chunks = [_decode_chunk(([], tuple(fields), keep_last))]
+    return DecodedEvents(
+        lengths=np.concatenate([lengths for lengths, _, _ in chunks]),
+        counts=np.concatenate([counts for _, counts, _ in chunks]),
+        columns={
+            field: np.concatenate([columns[field] for _, _, columns in chunks])
+            for field in fields
+        },
+    )
+
+
+# Series documents (sample.json). deployment/utils.py has its own copies of granularity_seconds,
+# parse_timestamps and resample_series, train/utils.py of everything down to decode_series: every
+# step folder is uploaded on its own. Change them together.
+def granularity_seconds(granularity):
+    if not isinstance(granularity, str) or granularity not in GRANULARITIES:
+        raise ValueError(
+            f"Unknown granularity {granularity!r}, expected one of {sorted(GRANULARITIES)}."
+        )
+    return GRANULARITIES[granularity]
+
+
+def parse_timestamps(timestamps):
+    # ISO 8601 strings like "2020-06-28 11:33:00+02:00" -> datetime64[s] in UTC. The date and time,
+    # with or without seconds, are parsed by NumPy in one go and fractions of a second are dropped.
+    # The offset is parsed here: "Z" and no offset read as UTC, +HH:MM, +HHMM and +HH (or with "-")
+    # are subtracted. Raises ValueError for anything else.
+    raw = np.asarray(timestamps, dtype=bytes)
+    if not len(raw):
+        return np.empty(0, dtype="datetime64[s]")
+    lengths = np.char.str_len(raw)
+    if np.any(lengths < 16):
+        raise ValueError("Timestamps must look like yyyy-mm-ddThh:mm[:ss[.f]][offset].")
+    # Zero padding behind every timestamp, so the offset can be sliced out of the longest one
+    chars = np.zeros((len(raw), raw.itemsize + 7), dtype=np.uint8)
+    chars[:, : raw.itemsize] = raw.view(np.uint8).reshape(len(raw), raw.itemsize)
+    if np.any((chars[:, 10] != ord("T")) & (chars[:, 10] != ord(" "))):
+        raise ValueError("Timestamps must separate date and time with 'T' or ' '.")
+
+    # Where the offset starts: after hh:mm, :ss and the digits of a fraction
+    has_seconds = chars[:, 16] == ord(":")
+    ends = np.where(has_seconds, 19, 16)
+    has_fraction = has_seconds & (chars[:, 19] == ord("."))
+    if np.any(has_fraction):
+        digit = (chars >= ord("0")) & (chars <= ord("9"))
+        fraction_ends = np.argmax(~digit & (np.arange(chars.shape[1]) > 19), axis=1)
+        if np.any(fraction_ends[has_fraction] == 20):
+            raise ValueError("Timestamp fractions must have digits.")
+        ends = np.where(has_fraction, fraction_ends, ends)
+
+    # "yyyy-mm-ddThh:mm:ss" without fraction and offset, seconds default to zero
+    local = np.full((len(raw), 19), ord("0"), dtype=np.uint8)
+    local[:, :16] = chars[:, :16]
+    local[:, 10] = ord("T")
+    local[:, 16] = ord(":")
+    local[has_seconds, 17:19] = chars[has_seconds, 17:19]
+    utc = local.view("S19").ravel().astype("datetime64[s]")
+
+    offset_lengths = lengths - ends
+    offsets = np.take_along_axis(chars, ends[:, np.newaxis] + np.arange(6), axis=1)
+    signed = (offsets[:, 0] == ord("+")) | (offsets[:, 0] == ord("-"))
+    valid = (
+        (offset_lengths == 0)
+        | ((offset_lengths == 1) & (offsets[:, 0] == ord("Z")))
+        | (signed & np.isin(offset_lengths, (3, 5, 6)))
+    )
+    colon = offset_lengths == 6
+    if not np.all(valid) or np.any(offsets[signed & colon, 3] != ord(":")):
+        raise ValueError("Timestamp offsets must be Z, +HH:MM, +HHMM or +HH.")
+    if not np.any(signed):
+        return utc
+
+    rows = np.flatnonzero(signed)
+    offsets, offset_lengths, colon = offsets[rows], offset_lengths[rows], colon[rows]
+    # +HH:MM -> +HHMM and +HH -> +HH00
+    offsets[colon, 3:5] = offsets[colon, 4:6]
+    offsets[offset_lengths == 3, 3:5] = ord("0")
+    digits = offsets[:, 1:5].astype(np.int64) - ord("0")
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 2] * 10 + digits[:, 3]
+    if np.any((digits < 0) | (digits > 9)) or np.any((hours > 23) | (minutes > 59)):
+        raise ValueError("Timestamp offsets must be Z, +HH:MM, +HHMM or +HH.")
+    sign = np.where(offsets[:, 0] == ord("-"), -1, 1)
+    utc[rows] -= (sign * (hours * 3600 + minutes * 60)).astype("timedelta64[s]")
+    return utc
+
+
+def resample_series(times, values, step: int, keep_last: int = None):
+    # Put readings onto a grid of step seconds, from the first to the last reading. Every reading
+    # goes to the nearest grid point, the latest one wins where several do, and grid points without
+    # a reading repeat the one before. With keep_last, only the last keep_last grid points are built.
+    # Returns the grid (datetime64[s]), its values and the length of the full grid.
+    seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+    values = np.asarray(values)
+    if not len(seconds):
+        return seconds.astype("datetime64[s]"), values, 0
+    order = np.argsort(seconds, kind="stable")
+    slots = (seconds[order] + step // 2) // step
+    latest = np.append(slots[1:] != slots[:-1], True)
+    slots, order = slots[latest], order[latest]
+    length = int(slots[-1] - slots[0]) + 1
+
+    # The grid starts keep_last points before the end, filled from the last reading before it
+    start = slots[0] if keep_last is None else max(slots[0], slots[-1] - keep_last + 1)
+    first = np.searchsorted(slots, start, side="right") - 1
+    positions = np.maximum(slots[first:] - start, 0)
+    filled = np.zeros(positions[-1] + 1, dtype=np.intp)
+    filled[positions] = np.arange(len(positions))
+    filled = np.maximum.accumulate(filled)
+
+    grid = (np.arange(start, slots[-1] + 1) * step).astype("datetime64[s]")
+    return grid, values[order[first:]][filled], length
+
+
+def _decode_series_chunk(task):
+    raw_chunk, keep_last = task
+    lengths = np.empty(len(raw_chunk), dtype=np.int64)
+    readings = []
+    for i, raw in enumerate(raw_chunk):
+        document = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+        series = document["series"]
+        # Tabular datasets keep the nested list as a JSON string
+        if isinstance(series, str):
+            series = json.loads(series)
+        _, values, lengths[i] = resample_series(
+            parse_timestamps(list(map(itemgetter("timestamp"), series))),
+            np.fromiter(
+                map(itemgetter("value"), series), dtype=np.float64, count=len(series)
+            ),
+            granularity_seconds(document["granularity"]),
+            keep_last=keep_last,
+        )
+        readings.append(values)
+
+    counts = np.fromiter(map(len, readings), dtype=np.int64, count=len(readings))
+    return lengths, counts, np.concatenate(readings or [np.empty(0)])
+
+
+def decode_series(
+    raw_series,
+    keep_last: int = None,
+    chunk_size: int = 10000,
+    n_workers: int = None,
+):
+    # decode_allevents for documents in the series format of sample.json, as JSON strings or dicts.
+    # Every series is resampled onto its granularity and gap filled, so "lengths" counts grid points
+    # rather than uploaded readings. Only the values are decoded, as the "temperature" column.
+    raw_series = list(raw_series)
+    tasks = [
+        (raw_series[start : start + chunk_size], keep_last)
+        for start in range(0, len(raw_series), chunk_size)
+    ]
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) <= 1:
+        chunks = [_decode_series_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks))) as executor:
+            chunks = list(executor.map(_decode_series_chunk, tasks))
+
+    if not chunks:
+        chunks = [_decode_series_chunk(([], keep_last))]
+    return DecodedEvents(
+        lengths=np.concatenate([lengths for lengths, _, _ in chunks]),
+        counts=np.concatenate([counts for _, counts, _ in chunks]),
+        columns={"temperature": np.concatenate([values for _, _, values in chunks])},
+    )
+
+
+def ragged_to_panel(
+    decoded: DecodedEvents, time_series_length: int, dimensions=("temperature",)
+):
+    # Convert decoded events into a dense panel of shape (n_cases, n_dims, time_series_length),
+    # plus the row position of every case.
+
+    # We ignore cases with insufficient readings
+    keep = decoded.lengths >= time_series_length
+    if np.any(decoded.counts[keep] < time_series_length):
+        raise ValueError(
+            f"Events were decoded with fewer than {time_series_length} readings per case."
+        )
+    case_index = np.flatnonzero(keep)
+
+    # We also slice samples with too many readings ([-size:])
+    ends = np.cumsum(decoded.counts)[keep]
+    readings = ends[:, np.newaxis] + np.arange(-time_series_length, 0)
+
+    panel = np.empty(
+        (len(case_index), len(dimensions), time_series_length), dtype=np.float64
+    )
+    for dim_id, dimension in enumerate(dimensions):
+        panel[:, dim_id, :] = decoded.columns[dimension][readings]
+
+    return panel, case_index
+
+
+def panel_labels(panel: np.ndarray, threshold: float):
+    # Fake some labels
+    # We simply explore the data, set an arbitrary threshold and define all series above that threshold as "True".
+    return panel[:, 0, :].max(axis=1) > threshold
+
+
+def _write_metadata(path: str, metadata: dict):
+    with open(os.path.join(path, "metadata.json"), "w") as fh:
+        json.dump(metadata, fh, indent=2)
+
+
+def _row_digest(row):
+    # Rows are JSON strings, or dicts for series documents read from a dataset
+    if isinstance(row, str):
+        row = row.encode()
+    elif not isinstance(row, bytes):
+        row = json.dumps(row, sort_keys=True).encode()
+    return int.from_bytes(hashlib.blake2b(row, digest_size=8).digest(), "little")
+
+
+def case_digests(raw_rows):
+    # A 64 bit digest of every raw row. Warm starts recognise the rows a model has learned from by
+    # them, wherever the rows end up in the panel.
+    return np.fromiter(map(_row_digest, raw_rows), dtype=np.uint64, count=len(raw_rows))
+
+
+def save_panel(
+    path: str,
+    panel: np.ndarray,
+    case_index: np.ndarray,
+    dtype=None,
+    digests: np.ndarray = None,
+    **metadata,
+):
+    # Store a panel as a versioned artifact. dtype=np.float32 halves the footprint on disk.
+    # digests holds the case_digests of the cases, i.e. of the raw rows in case_index.
+    os.makedirs(path, exist_ok=True)
+    panel = np.ascontiguousarray(panel, dtype=dtype)
+    np.save(os.path.join(path, "panel.npy"), panel)
+    np.save(
+        os.path.join(path, "case_index.npy"), np.asarray(case_index, dtype=np.int64)
+    )
+    if digests is not None:
+        np.save(
+            os.path.join(path, "case_digests.npy"), np.asarray(digests, dtype=np.uint64)
+        )
+
+    n_cases, n_dims, time_series_length = panel.shape
+    metadata.update(
+        format_version=PANEL_FORMAT_VERSION,
+        dtype=panel.dtype.name,
+        n_cases=n_cases,
+        n_dims=n_dims,
+        time_series_length=time_series_length,
+    )
+    _write_metadata(path, metadata)
+    return metadata
+
+
+def link_panel(source: str, path: str):
+    # Hand a stored panel to the next step without rewriting it. Falls back to a copy across devices.
+    os.makedirs(path, exist_ok=True)
+    for filename in ("panel.npy", "case_index.npy", "case_digests.npy"):
+        if not os.path.exists(os.path.join(source, filename)):
+            continue
+        target = os.path.join(path, filename)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(os.path.join(source, filename), target)
+        except OSError:
+            shutil.copyfile(os.path.join(source, filename), target)
+    shutil.copyfile(
+        os.path.join(source, "metadata.json"), os.path.join(path, "metadata.json")
+    )
+
+
+def save_labels(path: str, labels: np.ndarray, **metadata):
+    # Add labels (and e.g. the threshold they were computed with) to a stored panel
+    np.save(os.path.join(path, "labels.npy"), np.asarray(labels, dtype=bool))
+    with open(os.path.join(path, "metadata.json"), "r") as fh:
+        stored_metadata = json.load(fh)
+    stored_metadata.update(metadata)
+    _write_metadata(path, stored_metadata)
+    return stored_metadata
+
+
+def load_panel(path: str, mmap_mode: str = "r"):
+    # Open a panel artifact. The arrays are memory mapped unless mmap_mode is None.
+    with open(os.path.join(path, "metadata.json"), "r") as fh:
+        metadata = json.load(fh)
+    if metadata.get("format_version") != PANEL_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported panel format version {metadata.get('format_version')} in '{path}'."
+        )
+
+    panel = np.load(os.path.join(path, "panel.npy"), mmap_mode=mmap_mode)
+    case_index = np.load(os.path.join(path, "case_index.npy"), mmap_mode=mmap_mode)
+    optional = {}
+    for name in ("labels", "case_digests"):
+        optional_path = os.path.join(path, f"{name}.npy")
+        optional[name] = (
+            np.load(optional_path, mmap_mode=mmap_mode)
+            if os.path.exists(optional_path)
+            else None
+        )
+    return PanelArtifact(panel, case_index, metadata=metadata, **optional)
+
+
+def list_partitions(root: str):
+    # Local stand-in for the /{PartitionDate:yyyy/MM/dd}/ layout of the "sensordata" datastore.
+    # Returns {PartitionDate: [JSON lines files]} with PartitionDate formatted as yyyy-MM-dd.
+    partitions = {}
+    pattern = os.path.join(root, "[0-9]" * 4, "[0-9]" * 2, "[0-9]" * 2, "*.json")
+    for path in sorted(glob.glob(pattern)):
+        year, month, day = os.path.relpath(path, root).split(os.sep)[:3]
+        partitions.setdefault(f"{year}-{month}-{day}", []).append(path)
+    return partitions
+
+
+def partition_fingerprint(paths):
+    # Changes whenever a file of the partition is added, removed, rewritten or appended to
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+def read_allevents(paths):
+    # The raw "allevents" strings of JSON lines files, without building a DataFrame
+    raw_allevents = []
+    for path in paths:
+        with open(path, "r") as fh:
+            raw_allevents.extend(
+                json.loads(line)["allevents"] for line in fh if line.strip()
+            )
+    return raw_allevents
+
+
+def read_series(paths):
+    # Series documents as JSON strings: the whole file if it is one document like sample.json, else
+    # every line of a JSON lines file
+    raw_series = []
+    for path in paths:
+        with open(path, "r") as fh:
+            text = fh.read()
+        try:
+            json.loads(text)
+            raw_series.append(text)
+        except ValueError:
+            raw_series.extend(line for line in text.splitlines() if line.strip())
+    return raw_series
+
+
+def load_partition_state(cache_dir: str):
+    # Watermark, settings and per-partition fingerprints of a partition cache
+    path = os.path.join(cache_dir, PARTITION_STATE_FILENAME)
+    if not os.path.exists(path):
+        return {"watermark": None, "config": None, "partitions": {}}
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def save_partition_state(cache_dir: str, state: dict):
+    # Written last and atomically, so an interrupted run is simply redone
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, PARTITION_STATE_FILENAME)
+    with open(path + ".tmp", "w") as fh:
+        json.dump(state, fh, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def stale_partitions(state: dict, fingerprints: dict, config: dict):
+    # PartitionDates that have to be parsed: new ones, changed ones and those without a fingerprint.
+    # A fingerprint of None means the source cannot tell, e.g. the partitions after the watermark of a
+    # registered dataset. Different settings invalidate the whole cache.
+    if state["config"] != config:
+        return sorted(fingerprints)
+    cached = state["partitions"]
+    return sorted(
+        partition_date
+        for partition_date, fingerprint in fingerprints.items()
+        if fingerprint is None or cached.get(partition_date) != fingerprint
+    )
+
+
+def partition_path(cache_dir: str, partition_date: str):
+    return os.path.join(cache_dir, "partitions", partition_date)
+
+
+def preprocess_partition(
+    cache_dir: str,
+    partition_date: str,
+    raw_allevents,
+    time_series_length: int,
+    dtype=None,
+    chunk_size: int = 10000,
+    n_workers: int = None,
+    input_format: str = "allevents",
+):
+    # Parse one partition into its own cached panel artifact. Its case_index refers to rows of the
+    # partition, n_rows is kept to offset it once partitions are concatenated.
+    # With input_format "series", raw_allevents holds series documents instead.
+    raw_allevents = list(raw_allevents)
+    decode = decode_series if input_format == "series" else decode_allevents
+    decoded = decode(
+        raw_allevents,
+        keep_last=time_series_length,
+        chunk_size=chunk_size,
+        n_workers=n_workers,
+    )
+    panel, case_index = ragged_to_panel(decoded, time_series_length=time_series_length)
+    return save_panel(
+        partition_path(cache_dir, partition_date),
+        panel,
+        case_index,
+        dtype=dtype,
+        digests=case_digests(raw_allevents)[case_index],
+        partition_date=partition_date,
+        n_rows=len(raw_allevents),
+    )
+
+
+def concatenate_partitions(cache_dir: str, partition_dates, path: str, **metadata):
+    # Stack cached partition panels into one artifact in PartitionDate order. The output is written
+    # through a memory map, partition by partition, so no partition is parsed again and the full
+    # panel never has to fit in memory.
+    artifacts = [
+        load_panel(partition_path(cache_dir, partition_date))
+        for partition_date in sorted(partition_dates)
+    ]
+    if not artifacts:
+        raise ValueError(f"No cached partitions in '{cache_dir}'.")
+    n_cases = sum(len(artifact.case_index) for artifact in artifacts)
+    _, n_dims, time_series_length = artifacts[0].panel.shape
+
+    os.makedirs(path, exist_ok=True)
+    panel = np.lib.format.open_memmap(
+        os.path.join(path, "panel.npy"),
+        mode="w+",
+        dtype=artifacts[0].panel.dtype,
+        shape=(n_cases, n_dims, time_series_length),
+    )
+    case_index = np.empty(n_cases, dtype=np.int64)
+    # Partitions cached before digests were stored have none, their cases get 0
+    digests = np.zeros(n_cases, dtype=np.uint64)
+    case_offset, row_offset = 0, 0
+    for artifact in artifacts:
+        n_partition_cases = len(artifact.case_index)
+        panel[case_offset : case_offset + n_partition_cases] = artifact.panel
+        case_index[case_offset : case_offset + n_partition_cases] = (
+            artifact.case_index + row_offset
+        )
+        if artifact.case_digests is not None:
+            digests[case_offset : case_offset + n_partition_cases] = (
+                artifact.case_digests
+            )
+        case_offset += n_partition_cases
+        row_offset += artifact.metadata["n_rows"]
+    panel.flush()
+    np.save(os.path.join(path, "case_index.npy"), case_index)
+    np.save(os.path.join(path, "case_digests.npy"), digests)
+
+    metadata.update(
+        format_version=PANEL_FORMAT_VERSION,
+        dtype=panel.dtype.name,
+        n_cases=n_cases,
+        n_dims=n_dims,
+        time_series_length=time_series_length,
+        partitions=[artifact.metadata["partition_date"] for artifact in artifacts],
+        partition_cases=[len(artifact.case_index) for artifact in artifacts],
+    )
+    del panel
+    _write_metadata(path, metadata)
+    return metadata
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from azureml.core import Run
+from joblib import load
+from sklearn.metrics import accuracy_score
+
+from forest import COMPILED_MODEL_FILENAME, compact_forest, compile_forest
+from utils import load_panel
+
+run = Run.get_context()
+
+# Loads a model in a fresh interpreter and prints how much its resident set grew
+RESIDENT_SCRIPT = """
+import os, sys
+def resident():
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+import numpy as np
+from forest import CompiledForest
+before = resident()
+if sys.argv[1].endswith(".npz"):
+    model = CompiledForest.load(sys.argv[1])
+else:
+    import joblib
+    model = joblib.load(sys.argv[1])
+print(resident() - before)
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default=None, help="labeled panel")
+    parser.add_argument(
+        "--model_dir",
+        type=str,
+        default=os.path.join("outputs", "model"),
+        help="folder with the trained model.pkl",
+    )
+    parser.add_argument(
+        "--train_data_split",
+        type=float,
+        default=0.8,
+        help="Fraction of samples used for training, the rest is held out "
+        "(same split as train_pipeline.py without --warm_start)",
+    )
+    parser.add_argument(
+        "--variant",
+        type=str,
+        action="append",
+        default=None,
+        help="'lossless' or comma separated max_depth=, max_trees=, value_dtype= settings. "
+        "Repeat for several variants.",
+    )
+    parser.add_argument(
+        "--latency_cases",
+        type=int,
+        default=200,
+        help="held-out cases predicted one at a time for the latency percentiles",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=os.path.join("outputs", "compact"),
+        help="one compiled model per variant is written here",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def parse_variant(variant: str):
+    settings = {}
+    if variant == "lossless":
+        return settings
+    for setting in variant.split(","):
+        key, value = setting.split("=")
+        if key in ("max_depth", "max_trees"):
+            settings[key] = int(value)
+        elif key == "value_dtype":
+            settings[key] = value
+        else:
+            raise ValueError(f"Unknown compaction setting '{key}'.")
+    return settings
+
+
+def resident_mb(path: str):
+    output = subprocess.check_output(
+        [sys.executable, "-c", RESIDENT_SCRIPT, path],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return int(output) / 2**20
+
+
+def measure(forest, path, panel, labels, reference, latency_cases):
+    start = time.perf_counter()
+    y_pred = forest.predict(panel)
+    predict_seconds = time.perf_counter() - start
+
+    latencies = []
+    for case in range(min(latency_cases, len(panel))):
+        start = time.perf_counter()
+        forest.predict(panel[case : case + 1])
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "n_estimators": forest.n_estimators,
+        "n_nodes": len(forest.node_left),
+        "max_depth": forest.max_depth,
+        "file_bytes": os.path.getsize(path),
+        "array_bytes": sum(getattr(forest, name).nbytes for name in forest.ARRAYS),
+        "resident_mb": resident_mb(path),
+        "predict_seconds": predict_seconds,
+        "latency_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "latency_p99_ms": float(np.percentile(latencies, 99)) * 1000,
+        "accuracy": accuracy_score(labels, y_pred),
+        "agreement": float(np.mean(y_pred == reference)),
+    }
+
+
+def main(args):
+    artifact = load_panel(args.input)
+    # Same held-out cases as train_pipeline.py
+    train = pd.DataFrame(index=np.arange(len(artifact.panel))).sample(
+        frac=args.train_data_split, random_state=42
+    )
+    test_index = np.setdiff1d(np.arange(len(artifact.panel)), train.index)
+    panel = np.asarray(artifact.panel[test_index])
+    labels = np.asarray(artifact.labels[test_index])
+
+    # The reference is the uncompacted forest, which predicts exactly like the pickled model
+    pickle_path = os.path.join(args.model_dir, "model.pkl")
+    full_forest = compile_forest(load(pickle_path), compact=False)
+    os.makedirs(args.output_dir, exist_ok=True)
+    full_path = os.path.join(args.output_dir, "full_" + COMPILED_MODEL_FILENAME)
+    full_forest.save(full_path)
+    reference = full_forest.predict(panel)
+
+    report = [
+        {
+            "variant": "pickle",
+            "file_bytes": os.path.getsize(pickle_path),
+            "resident_mb": resident_mb(pickle_path),
+        },
+        dict(
+            variant="full",
+            **measure(
+                full_forest, full_path, panel, labels, reference, args.latency_cases
+            ),
+        ),
+    ]
+    for variant in args.variant or [
+        "lossless",
+        "value_dtype=float32",
+        "max_depth=8",
+        "max_depth=4",
+    ]:
+        forest = compact_forest(full_forest, **parse_variant(variant))
+        variant_dir = os.path.join(args.output_dir, variant.replace("=", "-"))
+        os.makedirs(variant_dir, exist_ok=True)
+        path = os.path.join(variant_dir, COMPILED_MODEL_FILENAME)
+        forest.save(path)
+        report.append(
+            dict(
+                variant=variant,
+                **measure(forest, path, panel, labels, reference, args.latency_cases),
+            )
+        )
+
+    full_accuracy = report[1]["accuracy"]
+    for row in report:
+        if "accuracy" in row:
+            row["accuracy_delta"] = row["accuracy"] - full_accuracy
+        run.log_row("compaction", **row)
+        print(json.dumps(row))
+    with open(os.path.join("outputs", "compaction.json"), "w") as fh:
+        json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args=args)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.metrics import accuracy_score
+
+from ensemble import fit_forest, predict
+
+CV_STRATEGIES = ("kfold", "stratified", "time")
+
+
+def fold_indices(
+    n_cases: int, n_folds: int, strategy: str = "kfold", labels=None, seed: int = 42
+):
+    # (train_index, test_index) pairs of index arrays:
+    # - kfold: shuffled, equally sized folds
+    # - stratified: like kfold, with every class spread evenly over the folds
+    # - time: cases stay in panel order, which is PartitionDate order. Fold k tests on block k + 1 and
+    #   trains on all blocks before it, so the model never sees the future.
+    if strategy == "time":
+        blocks = np.array_split(np.arange(n_cases), n_folds + 1)
+        return [
+            (np.concatenate(blocks[: fold + 1]), blocks[fold + 1])
+            for fold in range(n_folds)
+        ]
+
+    rng = np.random.RandomState(seed)
+    fold_of_case = np.empty(n_cases, dtype=np.int64)
+    if strategy == "stratified":
+        labels = np.asarray(labels)
+        offset = 0
+        for label in np.unique(labels):
+            cases = rng.permutation(np.flatnonzero(labels == label))
+            # Continue where the previous class stopped, so fold sizes stay balanced
+            fold_of_case[cases] = (np.arange(len(cases)) + offset) % n_folds
+            offset += len(cases)
+    elif strategy == "kfold":
+        fold_of_case[rng.permutation(n_cases)] = np.arange(n_cases) % n_folds
+    else:
+        raise ValueError(f"Unknown cross-validation strategy '{strategy}'.")
+    return [
+        (np.flatnonzero(fold_of_case != fold), np.flatnonzero(fold_of_case == fold))
+        for fold in range(n_folds)
+    ]
+
+
+def _shared_path(array: np.ndarray, directory: str, name: str):
+    # A .npy file workers can memory map: the array's own file if it is a memory mapped .npy
+    # (e.g. from load_panel), a temporary copy otherwise
+    filename = getattr(array, "filename", None)
+    if filename and filename.endswith(".npy"):
+        on_disk = np.load(filename, mmap_mode="r")
+        if on_disk.shape == array.shape and on_disk.dtype == array.dtype:
+            return filename
+    path = os.path.join(directory, f"{name}.npy")
+    np.save(path, np.asarray(array))
+    return path
+
+
+def _run_fold(task):
+    fold, panel_path, labels_path, train_index, test_index, n_estimators, seed = task
+    # Views into the shared arrays. Only the rows of this fold are read, and only sktime's nested
+    # frames are built from them.
+    panel = np.load(panel_path, mmap_mode="r")
+    labels = np.load(labels_path, mmap_mode="r")
+
+    start = time.perf_counter()
+    strategy = fit_forest(
+        panel[train_index],
+        labels[train_index],
+        n_estimators=n_estimators,
+        random_state=seed + fold,
+    )
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = predict(strategy, panel, test_index)
+    predict_seconds = time.perf_counter() - start
+
+    return {
+        "fold": fold,
+        "train_samples": len(train_index),
+        "test_samples": len(test_index),
+        "accuracy": accuracy_score(labels[test_index], y_pred),
+        "fit_seconds": fit_seconds,
+        "predict_seconds": predict_seconds,
+    }
+
+
+def cross_validate(
+    panel: np.ndarray,
+    labels: np.ndarray,
+    folds,
+    n_estimators: int,
+    seed: int = 42,
+    n_workers: int = None,
+):
+    # Fit and score every fold in its own process. Workers memory map the panel and the labels
+    # instead of receiving copies, folds are passed as index arrays.
+    work_dir = tempfile.mkdtemp()
+    try:
+        panel_path = _shared_path(panel, work_dir, "panel")
+        labels_path = _shared_path(labels, work_dir, "labels")
+        tasks = [
+            (
+                fold,
+                panel_path,
+                labels_path,
+                train_index,
+                test_index,
+                n_estimators,
+                seed,
+            )
+            for fold, (train_index, test_index) in enumerate(folds)
+        ]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(_run_fold, tasks))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def log_cross_validation(run, results):
+    # One row per fold plus the mean and spread of the accuracy
+    for result in results:
+        run.log_row("cross_validation", **result)
+    accuracies = [result["accuracy"] for result in results]
+    run.log("cv_accuracy_mean", float(np.mean(accuracies)), "Mean accuracy over folds")
+    run.log("cv_accuracy_std", float(np.std(accuracies)), "Spread of fold accuracies")
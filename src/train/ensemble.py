@@ -0,0 +1,85 @@
+import numpy as np
+
+# train_pipeline.py uses the sktime 0.3 module layout, train.py the later one
+try:
+    from sktime.classifiers.compose import TimeSeriesForestClassifier
+    from sktime.highlevel.strategies import TSCStrategy
+    from sktime.highlevel.tasks import TSCTask
+except ImportError:
+    from sktime.benchmarking.strategies import TSCStrategy
+    from sktime.benchmarking.tasks import TSCTask
+    from sktime.classification.compose import TimeSeriesForestClassifier
+
+from utils import panel_to_nested
+
+
+def nested_frame(panel: np.ndarray, labels: np.ndarray = None):
+    # sktime's input for a dense panel, with the "label" target column when labels are given
+    df_nested = panel_to_nested(np.asarray(panel))
+    if labels is not None:
+        df_nested["label"] = np.asarray(labels)
+    return df_nested
+
+
+def fit_forest(
+    panel: np.ndarray, labels: np.ndarray, n_estimators: int, random_state=None
+):
+    # Fit a TimeSeriesForestClassifier on a dense panel, wrapped like train_pipeline.py does
+    train = nested_frame(panel, labels)
+    task = TSCTask(target="label", metadata=train)
+    strategy = TSCStrategy(
+        TimeSeriesForestClassifier(n_estimators=n_estimators, random_state=random_state)
+    )
+    strategy.fit(task, train)
+    return strategy
+
+
+def predict(
+    strategy, panel: np.ndarray, index: np.ndarray = None, batch_size: int = None
+):
+    # Predict the rows `index` (default: all) of a possibly memory mapped panel batch by batch, so
+    # only one batch is loaded and nested at a time
+    index = np.arange(len(panel)) if index is None else np.asarray(index)
+    batch_size = batch_size or max(len(index), 1)
+    return np.concatenate(
+        [
+            np.asarray(
+                strategy.predict(nested_frame(panel[index[start : start + batch_size]]))
+            )
+            for start in range(0, len(index), batch_size)
+        ]
+        or [np.empty(0)]
+    )
+
+
+def forest_classes(strategy):
+    return np.asarray(getattr(strategy, "estimator", strategy).classes_)
+
+
+def merge_forests(strategies):
+    # Pool the trees of several fitted forests into the first one. Every forest has to know the same
+    # classes, a tree's class probabilities are only comparable then. The result pickles and predicts
+    # like a forest fitted in one go, with the votes of all trees averaged.
+    merged = strategies[0]
+    classes = forest_classes(merged)
+    for strategy in strategies[1:]:
+        if not np.array_equal(forest_classes(strategy), classes):
+            raise ValueError(
+                f"Cannot merge forests with classes {forest_classes(strategy)} and {classes}."
+            )
+    forest = getattr(merged, "estimator", merged)
+    forest.estimators_ = [
+        tree
+        for strategy in strategies
+        for tree in getattr(strategy, "estimator", strategy).estimators_
+    ]
+    forest.n_estimators = len(forest.estimators_)
+    return merged
+
+
+def retire_oldest_trees(strategy, max_estimators: int):
+    # Keep the newest max_estimators trees. merge_forests appends, so the oldest trees come first.
+    forest = getattr(strategy, "estimator", strategy)
+    forest.estimators_ = forest.estimators_[-max_estimators:]
+    forest.n_estimators = len(forest.estimators_)
+    return strategy
@@ -0,0 +1,347 @@
+import numpy as np
+
+COMPILED_FOREST_VERSION = 2
+COMPILED_MODEL_FILENAME = "model_compiled.npz"
+
+# Interval features used by sktime's TimeSeriesForestClassifier, in the order of their kind codes
+FEATURE_KINDS = ("mean", "std", "time_series_slope")
+
+
+class IntervalFeatures:
+    # Prefix sums of x, x**2 and t*x over a (n_cases, length) array, so the mean, std and slope of any
+    # interval cost O(1) per case instead of O(interval length). Rows are shifted by their first value
+    # beforehand to keep the sums small. Features are memoised by (start, end, kind): trees sharing an
+    # interval compute it once. The memo lives as long as the engine, i.e. one panel. Fitting does not
+    # use it, sktime computes its own features there.
+    def __init__(self, X: np.ndarray):
+        X = np.asarray(X, dtype=np.float64)
+        self.n_cases, self.length = X.shape
+        self.offset = X[:, 0] if self.length else np.zeros(self.n_cases)
+        self._X = X
+        centered = X - self.offset[:, np.newaxis]
+        t = np.arange(self.length)
+        self._sums = []
+        for values in (centered, centered**2, t * centered):
+            sums = np.zeros((self.n_cases, self.length + 1))
+            np.cumsum(values, axis=1, out=sums[:, 1:])
+            self._sums.append(sums)
+        self._cache = {}
+
+    def _interval_sums(self, start: int, end: int):
+        return [sums[:, end] - sums[:, start] for sums in self._sums]
+
+    def mean(self, start: int, end: int):
+        sum_x, _, _ = self._interval_sums(start, end)
+        return sum_x / (end - start) + self.offset
+
+    def std(self, start: int, end: int):
+        n = end - start
+        if n < 2:
+            return np.zeros(self.n_cases)
+        sum_x, sum_xx, _ = self._interval_sums(start, end)
+        var = sum_xx / n - (sum_x / n) ** 2
+        # Rounding of the prefix sums dominates where the variance is tiny compared to them.
+        # Those rows are recomputed from the readings.
+        unstable = var < 1e-6 * self._sums[1][:, end] / n
+        std = np.sqrt(np.maximum(var, 0.0))
+        if unstable.any():
+            std[unstable] = np.std(self._X[unstable, start:end], axis=1)
+        return std
+
+    def slope(self, start: int, end: int):
+        # sktime's time_series_slope, with time counted from the interval start
+        n = end - start
+        if n < 2:
+            return np.zeros(self.n_cases)
+        sum_x, _, sum_tx = self._interval_sums(start, end)
+        sum_tx = sum_tx - start * sum_x
+        return (sum_tx / n - (n - 1) / 2 * sum_x / n) / ((n**2 - 1) / 12)
+
+    def feature(self, start: int, end: int, kind: int):
+        key = (int(start), int(end), int(kind))
+        if key not in self._cache:
+            self._cache[key] = (self.mean, self.std, self.slope)[key[2]](*key[:2])
+        return self._cache[key]
+
+
+class CompiledForest:
+    # A TimeSeriesForestClassifier flattened into plain arrays:
+    # - feature_start/feature_end/feature_kind: every distinct interval feature used by any tree
+    # - node_*: the nodes of all trees back to back. Leaves point to themselves and node_value holds
+    #   the normalised class probabilities of every node.
+    # - tree_root: index of the first node of every tree
+    # Compacted forests (leaf_values) only keep the probabilities of leaves: node_value has one row per
+    # leaf and a leaf's node_feature is its row. Arrays may use any integer and float width.
+    # Keep in sync with deployment/forest.py, both folders are uploaded separately.
+    ARRAYS = (
+        "classes",
+        "feature_start",
+        "feature_end",
+        "feature_kind",
+        "node_feature",
+        "node_threshold",
+        "node_left",
+        "node_right",
+        "node_value",
+        "tree_root",
+    )
+
+    def __init__(self, max_depth: int, leaf_values: bool = False, **arrays):
+        self.max_depth = int(max_depth)
+        self.leaf_values = bool(leaf_values)
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @property
+    def n_estimators(self):
+        return len(self.tree_root)
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            format_version=COMPILED_FOREST_VERSION,
+            max_depth=self.max_depth,
+            leaf_values=self.leaf_values,
+            **{name: getattr(self, name) for name in self.ARRAYS},
+        )
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path, allow_pickle=False) as arrays:
+            # Version 1 forests have no leaf_values and read as uncompacted
+            if int(arrays["format_version"]) not in (1, COMPILED_FOREST_VERSION):
+                raise ValueError(
+                    f"Unsupported compiled forest version {int(arrays['format_version'])}."
+                )
+            return cls(
+                max_depth=int(arrays["max_depth"]),
+                leaf_values="leaf_values" in arrays and bool(arrays["leaf_values"]),
+                **{name: arrays[name] for name in cls.ARRAYS},
+            )
+
+    def features(self, X):
+        # All interval features of a (n_cases, length) array or of its IntervalFeatures
+        engine = X if isinstance(X, IntervalFeatures) else IntervalFeatures(X)
+        Xt = np.empty((engine.n_cases, len(self.feature_kind)))
+        for i, (start, end, kind) in enumerate(
+            zip(self.feature_start, self.feature_end, self.feature_kind)
+        ):
+            Xt[:, i] = engine.feature(start, end, kind)
+        return Xt
+
+    def apply(self, Xt: np.ndarray):
+        # Walk all trees for all cases at once, only advancing pairs that have not reached a leaf yet.
+        # Like sklearn, features are compared as float32.
+        Xt = Xt.astype(np.float32)
+        nodes = np.tile(self.tree_root, Xt.shape[0]).astype(np.intp)
+        rows = np.repeat(np.arange(Xt.shape[0]), self.n_estimators)
+        active = np.flatnonzero(self.node_left[nodes] != nodes)
+        while active.size:
+            current = nodes[active]
+            go_left = Xt[rows[active], self.node_feature[current]] <= (
+                self.node_threshold[current]
+            )
+            nodes[active] = np.where(
+                go_left, self.node_left[current], self.node_right[current]
+            )
+            active = active[self.node_left[nodes[active]] != nodes[active]]
+        return nodes.reshape(Xt.shape[0], self.n_estimators)
+
+    def predict_proba(self, panel):
+        # panel: (n_cases, 1, length), (n_cases, length) or the IntervalFeatures of either
+        X = panel
+        if not isinstance(X, IntervalFeatures):
+            X = np.asarray(panel, dtype=np.float64)
+            if X.ndim == 3:
+                X = X[:, 0, :]
+        Xt = self.features(X)
+        leaves = self.apply(Xt)
+        if self.leaf_values:
+            leaves = self.node_feature[leaves]
+
+        # Sum the trees one after another like sklearn's ForestClassifier does
+        proba = np.zeros((Xt.shape[0], len(self.classes)))
+        for tree in range(self.n_estimators):
+            proba += self.node_value[leaves[:, tree]]
+        return proba / self.n_estimators
+
+    def predict(self, panel: np.ndarray):
+        return self.classes.take(np.argmax(self.predict_proba(panel), axis=1), axis=0)
+
+
+def _feature_kinds(transformer):
+    features = transformer.features if transformer.features is not None else [np.mean]
+    names = [feature.__name__ for feature in features]
+    unsupported = set(names) - set(FEATURE_KINDS)
+    if unsupported:
+        raise ValueError(f"Unsupported interval features: {sorted(unsupported)}")
+    return [FEATURE_KINDS.index(name) for name in names]
+
+
+def compile_forest(model, compact: bool = True):
+    # Flatten a fitted TSCStrategy / TimeSeriesForestClassifier into a CompiledForest, compacted
+    # losslessly unless compact=False
+    forest = getattr(model, "estimator", model)
+    features = {}  # (start, end, kind) -> column
+    node_feature, node_threshold, node_left, node_right, node_value = [], [], [], [], []
+    tree_root = []
+    max_depth = 0
+    n_nodes = 0
+
+    for pipeline in forest.estimators_:
+        transformer, tree = pipeline.steps[0][1], pipeline.steps[-1][1]
+        intervals = np.asarray(transformer.intervals_)
+
+        # sktime orders the columns feature by feature, interval by interval
+        columns = np.array(
+            [
+                features.setdefault((int(start), int(end), kind), len(features))
+                for kind in _feature_kinds(transformer)
+                for start, end in intervals
+            ]
+        )
+
+        tree_ = tree.tree_
+        is_leaf = tree_.children_left < 0
+        node_ids = np.arange(tree_.node_count) + n_nodes
+        node_feature.append(np.where(is_leaf, 0, columns[np.maximum(tree_.feature, 0)]))
+        node_threshold.append(np.where(is_leaf, 0.0, tree_.threshold))
+        node_left.append(np.where(is_leaf, node_ids, tree_.children_left + n_nodes))
+        node_right.append(np.where(is_leaf, node_ids, tree_.children_right + n_nodes))
+
+        # Same normalisation as DecisionTreeClassifier.predict_proba
+        value = tree_.value[:, 0, : tree.n_classes_]
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        node_value.append(value / normalizer)
+
+        tree_root.append(n_nodes)
+        max_depth = max(max_depth, tree_.max_depth)
+        n_nodes += tree_.node_count
+
+    feature_start, feature_end, feature_kind = (
+        np.array(column) for column in zip(*features)
+    )
+    classes = np.asarray(forest.classes_)
+    if classes.dtype == object:
+        classes = classes.astype(str)
+    compiled_forest = CompiledForest(
+        max_depth=max_depth,
+        classes=classes,
+        feature_start=feature_start.astype(np.int32),
+        feature_end=feature_end.astype(np.int32),
+        feature_kind=feature_kind.astype(np.int8),
+        node_feature=np.concatenate(node_feature).astype(np.int32),
+        node_threshold=np.concatenate(node_threshold).astype(np.float64),
+        node_left=np.concatenate(node_left).astype(np.int32),
+        node_right=np.concatenate(node_right).astype(np.int32),
+        node_value=np.concatenate(node_value).astype(np.float64),
+        tree_root=np.array(tree_root, dtype=np.int32),
+    )
+    return compact_forest(compiled_forest) if compact else compiled_forest
+
+
+def _index_dtype(n: int):
+    # Smallest signed integer type holding 0 .. n - 1
+    for dtype in (np.int8, np.int16, np.int32):
+        if n <= np.iinfo(dtype).max + 1:
+            return dtype
+    return np.int64
+
+
+def _float32_thresholds(threshold: np.ndarray):
+    # The largest float32 not above every threshold. Features are compared as float32, and for any
+    # float32 x, x <= threshold exactly when x <= this value, so the narrowing is lossless. Thresholds
+    # beyond the float32 range become its largest value, or -inf below it.
+    largest = float(np.finfo(np.float32).max)
+    below = threshold < -largest
+    narrowed = np.clip(threshold, -largest, largest).astype(np.float32)
+    above = (narrowed > threshold) & ~below
+    narrowed[above] = np.nextafter(narrowed[above], np.float32(-np.inf))
+    narrowed[below] = -np.inf
+    return narrowed
+
+
+def node_depths(node_left: np.ndarray, node_right: np.ndarray, tree_root: np.ndarray):
+    # Depth of every node below the given roots, -1 for nodes no root reaches
+    depth = np.full(len(node_left), -1)
+    nodes = np.asarray(tree_root, dtype=np.intp)
+    level = 0
+    while nodes.size:
+        depth[nodes] = level
+        internal = nodes[node_left[nodes] != nodes]
+        nodes = np.concatenate([node_left[internal], node_right[internal]])
+        level += 1
+    return depth
+
+
+def compact_forest(
+    forest: CompiledForest,
+    max_depth: int = None,
+    max_trees: int = None,
+    value_dtype: str = None,
+):
+    # Shrink an uncompacted CompiledForest:
+    # - only leaves keep class probabilities, and only interval features some split uses are kept
+    # - thresholds are stored as float32 and indices in the smallest integer type, both lossless
+    # - value_dtype: None keeps the probabilities as float32 only where that is lossless, "float32"
+    #   forces it
+    # - max_trees keeps the newest trees (merged forests append), max_depth turns the nodes at that
+    #   depth into leaves predicting their training class distribution
+    # Without max_trees, max_depth or a forced value_dtype the predictions are unchanged.
+    if forest.leaf_values:
+        raise ValueError("The forest is compacted already.")
+    node_left = forest.node_left.astype(np.intp)
+    node_right = forest.node_right.astype(np.intp)
+    tree_root = forest.tree_root.astype(np.intp)
+    if max_trees is not None:
+        tree_root = tree_root[-max_trees:]
+
+    depth = node_depths(node_left, node_right, tree_root)
+    if max_depth is not None:
+        cut = np.flatnonzero(depth == max_depth)
+        node_left[cut] = cut
+        node_right[cut] = cut
+        depth = node_depths(node_left, node_right, tree_root)
+
+    # Renumber the nodes still reachable, in their original order
+    keep = np.flatnonzero(depth >= 0)
+    new_index = np.full(len(node_left), -1)
+    new_index[keep] = np.arange(len(keep))
+    left, right = new_index[node_left[keep]], new_index[node_right[keep]]
+    is_leaf = left == np.arange(len(keep))
+
+    used = np.unique(forest.node_feature[keep][~is_leaf])
+    feature_index = np.full(len(forest.feature_kind), -1)
+    feature_index[used] = np.arange(len(used))
+    node_feature = np.where(
+        is_leaf, np.cumsum(is_leaf) - 1, feature_index[forest.node_feature[keep]]
+    )
+
+    node_value = forest.node_value[keep][is_leaf]
+    if value_dtype is None:
+        value_dtype = (
+            np.float32
+            if np.array_equal(node_value.astype(np.float32), node_value)
+            else node_value.dtype
+        )
+    node_dtype = _index_dtype(len(keep))
+    position_dtype = _index_dtype(int(forest.feature_end.max(initial=0)) + 1)
+    return CompiledForest(
+        max_depth=int(depth.max()),
+        leaf_values=True,
+        classes=forest.classes,
+        feature_start=forest.feature_start[used].astype(position_dtype),
+        feature_end=forest.feature_end[used].astype(position_dtype),
+        feature_kind=forest.feature_kind[used].astype(np.int8),
+        node_feature=node_feature.astype(
+            _index_dtype(max(len(used), int(is_leaf.sum())))
+        ),
+        node_threshold=_float32_thresholds(
+            np.where(is_leaf, 0.0, forest.node_threshold[keep])
+        ),
+        node_left=left.astype(node_dtype),
+        node_right=right.astype(node_dtype),
+        node_value=node_value.astype(value_dtype),
+        tree_root=new_index[tree_root].astype(node_dtype),
+    )
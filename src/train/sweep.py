@@ -0,0 +1,313 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from azureml.core import Dataset, Model, Run
+from azureml.core.resource_configuration import ResourceConfiguration
+from joblib import dump, load
+from sklearn.metrics import accuracy_score
+
+from ensemble import fit_forest, predict
+from forest import COMPILED_MODEL_FILENAME, compile_forest
+from utils import (
+    decode_allevents,
+    load_decoded,
+    panel_labels,
+    ragged_to_panel,
+    read_local_allevents,
+    save_decoded,
+    save_training_state,
+    split_cases,
+)
+
+run = Run.get_context()
+# Offline runs, e.g. from 04_local_pipeline.py, have no workspace to register in
+offline = run.id.startswith("OfflineRun")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset_name",
+        type=str,
+        default="processed_json",
+        help="name of the input dataset",
+    )
+    parser.add_argument(
+        "--local_root",
+        type=str,
+        default=None,
+        help="read /yyyy/MM/dd/ JSON lines files from here instead of the dataset",
+    )
+    parser.add_argument(
+        "--time_series_lengths",
+        type=str,
+        default="10",
+        help="comma separated values to try",
+    )
+    parser.add_argument(
+        "--n_estimators", type=str, default="10", help="comma separated values to try"
+    )
+    parser.add_argument(
+        "--thresholds", type=str, default="180.0", help="comma separated values to try"
+    )
+    parser.add_argument(
+        "--n_trials",
+        type=int,
+        default=None,
+        help="random sample of the grid (default: the full grid)",
+    )
+    parser.add_argument(
+        "--train_data_split",
+        type=float,
+        default=0.8,
+        help="Fraction of samples for training",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        help="threshold whose best trial is registered (default: the first of --thresholds)",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="split and forest seed")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="trials fitted concurrently (default: all cores)",
+    )
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="sktime_freezer_classifier_sweep",
+        help="registered model name, warm starts continue from sktime_freezer_classifier",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def parameter_grid(args):
+    grid = [
+        {
+            "time_series_length": time_series_length,
+            "n_estimators": n_estimators,
+            "threshold": threshold,
+        }
+        for time_series_length, n_estimators, threshold in itertools.product(
+            [int(value) for value in args.time_series_lengths.split(",")],
+            [int(value) for value in args.n_estimators.split(",")],
+            [float(value) for value in args.thresholds.split(",")],
+        )
+    ]
+    if args.n_trials is not None and args.n_trials < len(grid):
+        rng = np.random.RandomState(args.seed)
+        grid = [grid[i] for i in sorted(rng.choice(len(grid), args.n_trials, False))]
+    return grid
+
+
+def best_trials(results):
+    # Best trial per threshold: every threshold labels the cases differently, so accuracies only
+    # compare within one. Ties go to the faster predictor.
+    best = {}
+    for result in results:
+        current = best.get(result["threshold"])
+        if current is None or (result["accuracy"], -result["predict_seconds"]) > (
+            current["accuracy"],
+            -current["predict_seconds"],
+        ):
+            best[result["threshold"]] = result
+    return best
+
+
+def registered_threshold(args, best):
+    # --threshold, or the first of --thresholds a trial was run for
+    if args.threshold is not None:
+        if args.threshold not in best:
+            raise ValueError(f"No trial was run for threshold {args.threshold}.")
+        return args.threshold
+    thresholds = [float(value) for value in args.thresholds.split(",")]
+    return next(threshold for threshold in thresholds if threshold in best)
+
+
+def trial_data(decoded_path: str, params: dict, train_data_split: float, seed: int):
+    # Panel, labels and split of one parameter combination. The decoded events are memory mapped,
+    # so every worker reads the same pages instead of parsing or copying the raw data.
+    decoded = load_decoded(decoded_path)
+    panel, _ = ragged_to_panel(decoded, time_series_length=params["time_series_length"])
+    labels = panel_labels(panel, params["threshold"])
+    train_index, test_index = split_cases(len(panel), train_data_split, seed)
+    return panel, labels, train_index, test_index
+
+
+def run_trial(task):
+    trial, params, decoded_path, train_data_split, seed, model_dir = task
+    panel, labels, train_index, test_index = trial_data(
+        decoded_path, params, train_data_split, seed
+    )
+    start = time.perf_counter()
+    strategy = fit_forest(
+        panel[train_index],
+        labels[train_index],
+        n_estimators=params["n_estimators"],
+        random_state=seed,
+    )
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = predict(strategy, panel[test_index])
+    predict_seconds = time.perf_counter() - start
+
+    model_path = os.path.join(model_dir, f"trial_{trial}.pkl")
+    dump(strategy, model_path)
+    return dict(
+        trial=trial,
+        **params,
+        train_samples=len(train_index),
+        test_samples=len(test_index),
+        accuracy=accuracy_score(labels[test_index], y_pred),
+        fit_seconds=fit_seconds,
+        predict_seconds=predict_seconds,
+        model_path=model_path,
+    )
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        grid = parameter_grid(args)
+
+        # Parse the raw data once, keeping enough readings for the longest time series
+        if args.local_root is not None:
+            raw_allevents = read_local_allevents(args.local_root)
+        else:
+            raw_allevents = Dataset.get_by_name(
+                run.experiment.workspace, name=args.dataset_name
+            ).to_pandas_dataframe()["allevents"]
+        decoded_path = os.path.join(work_dir, "decoded")
+        save_decoded(
+            decoded_path,
+            decode_allevents(
+                raw_allevents,
+                keep_last=max(params["time_series_length"] for params in grid),
+                n_workers=args.workers,
+            ),
+        )
+        del raw_allevents
+
+        # Fit all trials in a process pool
+        tasks = [
+            (trial, params, decoded_path, args.train_data_split, args.seed, work_dir)
+            for trial, params in enumerate(grid)
+        ]
+        results = []
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(run_trial, task) for task in tasks]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                run.log_row(
+                    "sweep",
+                    **{
+                        key: value
+                        for key, value in result.items()
+                        if key != "model_path"
+                    },
+                )
+                print(
+                    f"Trial {result['trial']}: accuracy {result['accuracy']:1.3f}, "
+                    f"fit {result['fit_seconds']:.2f}s, predict {result['predict_seconds']:.2f}s"
+                )
+        results.sort(key=lambda result: result["trial"])
+
+        best_per_threshold = best_trials(results)
+        for threshold, result in sorted(best_per_threshold.items()):
+            run.log_row(
+                "best_per_threshold",
+                threshold=threshold,
+                trial=result["trial"],
+                accuracy=result["accuracy"],
+            )
+        best = best_per_threshold[registered_threshold(args, best_per_threshold)]
+        best_params = {key: best[key] for key in grid[0]}
+        for key, value in best_params.items():
+            run.log(f"best_{key}", value)
+        run.log("Accuracy", f"{best['accuracy']:1.3f}", "Accuracy of the best model")
+
+        local_model_dir = os.path.join("outputs", "model")
+        os.makedirs(local_model_dir, exist_ok=True)
+        local_model_path = os.path.join(local_model_dir, "model.pkl")
+        shutil.copyfile(best["model_path"], local_model_path)
+        # The scoring service needs the winning trial's window length
+        save_training_state(
+            local_model_dir,
+            time_series_length=best_params["time_series_length"],
+            threshold=best_params["threshold"],
+        )
+        with open(os.path.join("outputs", "sweep.json"), "w") as fh:
+            json.dump(
+                [
+                    dict(
+                        {
+                            key: value
+                            for key, value in result.items()
+                            if key != "model_path"
+                        },
+                        best_for_threshold=result
+                        is best_per_threshold[result["threshold"]],
+                    )
+                    for result in results
+                ],
+                fh,
+                indent=2,
+            )
+
+        # Export the forest as plain arrays for the scoring service, if it reproduces the predictions
+        strategy = load(local_model_path)
+        panel, _, _, test_index = trial_data(
+            decoded_path, best_params, args.train_data_split, args.seed
+        )
+        compiled_forest = compile_forest(strategy)
+        mismatches = np.count_nonzero(
+            compiled_forest.predict(panel[test_index])
+            != predict(strategy, panel[test_index])
+        )
+        run.log(
+            "compiled_forest_mismatches",
+            mismatches,
+            "Test predictions where the compiled forest disagrees with sktime",
+        )
+        if mismatches == 0:
+            compiled_forest.save(os.path.join(local_model_dir, COMPILED_MODEL_FILENAME))
+    finally:
+        shutil.rmtree(work_dir)
+
+    # The model has no partition watermark, so it is registered next to the scheduled pipeline's
+    # sktime_freezer_classifier rather than as a version of it
+    if offline:
+        print(f"Offline run, model kept in {local_model_dir}")
+    else:
+        Model.register(
+            workspace=run.experiment.workspace,
+            model_name=args.model_name,
+            model_path=local_model_dir,  # Local folder to upload and register as a model.
+            tags={
+                "area": "freezerchain",
+                "type": "classification",
+                "purpose": "demonstration",
+                "source": "sweep",
+                **{key: str(value) for key, value in best_params.items()},
+            },
+            description="Sktime classifier to predict if freezer chain was interrupted.",
+            resource_configuration=ResourceConfiguration(cpu=1, memory_in_gb=0.5),
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args=args)
@@ -1,6 +1,7 @@
 import argparse
 import os
 
+import numpy as np
 from azureml.core import Run
 from joblib import dump
 from sklearn.metrics import accuracy_score
@@ -8,7 +9,14 @@ from sktime.classification.compose import TimeSeriesForestClassifier
 from sktime.benchmarking.strategies import TSCStrategy
 from sktime.benchmarking.tasks import TSCTask
 
-from utils import prepare_dataframe
+from crossval import (
+    CV_STRATEGIES,
+    cross_validate,
+    fold_indices,
+    log_cross_validation,
+)
+from forest import COMPILED_MODEL_FILENAME, compile_forest
+from utils import prepare_dataframe, save_training_state
 
 run = Run.get_context()
 
@@ -36,6 +44,19 @@ def parse_args():
     parser.add_argument(
         "--model_filename", type=str, default="model.pkl", help="Model filename"
     )
+    parser.add_argument(
+        "--cv_folds",
+        type=int,
+        default=0,
+        help="cross-validate with this many folds before training (0: off)",
+    )
+    parser.add_argument(
+        "--cv_strategy",
+        type=str,
+        default="kfold",
+        choices=CV_STRATEGIES,
+        help="how cases are assigned to folds",
+    )
     args = parser.parse_args()
     return args
 
@@ -44,7 +65,7 @@ def main(args):
     # Load and wrangle data
     raw_data_df = run.input_datasets["rawdata"].to_pandas_dataframe()
 
-    processed_data_df = prepare_dataframe(
+    processed_data_df, panel = prepare_dataframe(
         raw_data_df, time_series_length=args.timeserieslength, threshold=args.threshold
     )
 
@@ -61,6 +82,14 @@ def main(args):
     run.log("train_samples", train.shape[0], "Number of samples used for training")
     run.log("test_samples", test.shape[0], "Number of samples used for testing")
 
+    # Cross-validate in parallel. Folds are index arrays into one panel, not DataFrame copies.
+    if args.cv_folds > 1:
+        labels = processed_data_df["label"].to_numpy()
+        folds = fold_indices(len(panel), args.cv_folds, args.cv_strategy, labels=labels)
+        log_cross_validation(
+            run, cross_validate(panel, labels, folds, n_estimators=args.n_estimators)
+        )
+
     # Train
     task = TSCTask(target="label", metadata=train)
     clf = TimeSeriesForestClassifier(n_estimators=args.n_estimators)
@@ -77,9 +106,25 @@ def main(args):
     run.log("Accuracy", f"{accuracy:1.3f}", "Accuracy of model")
 
     # Persist model
-    os.makedirs("outputs", exist_ok=True)
-    model_path = os.path.join("outputs", args.model_filename)
-    dump(strategy, model_path)
+    model_dir = os.path.join("outputs", "model")
+    os.makedirs(model_dir, exist_ok=True)
+    dump(strategy, os.path.join(model_dir, args.model_filename))
+    save_training_state(
+        model_dir, time_series_length=args.timeserieslength, threshold=args.threshold
+    )
+
+    # Export the forest as plain arrays for the scoring service, if it reproduces the predictions
+    compiled_forest = compile_forest(strategy)
+    mismatches = np.count_nonzero(
+        compiled_forest.predict(panel[test.index]) != np.asarray(y_pred)
+    )
+    run.log(
+        "compiled_forest_mismatches",
+        mismatches,
+        "Test predictions where the compiled forest disagrees with sktime",
+    )
+    if mismatches == 0:
+        compiled_forest.save(os.path.join(model_dir, COMPILED_MODEL_FILENAME))
 
 
 if __name__ == "__main__":
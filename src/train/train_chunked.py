@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from azureml.core import Model, Run
+from azureml.core.resource_configuration import ResourceConfiguration
+from joblib import dump
+from sklearn.metrics import accuracy_score
+
+from ensemble import fit_forest, merge_forests, predict
+from forest import COMPILED_MODEL_FILENAME, compile_forest
+from utils import load_panel, save_training_state, split_cases
+
+run = Run.get_context()
+# Offline runs, e.g. from 04_local_pipeline.py, have no workspace to register in
+offline = run.id.startswith("OfflineRun")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default=None, help="labeled panel")
+    parser.add_argument(
+        "--chunk_cases",
+        type=int,
+        default=None,
+        help="cases per chunk (default: one chunk per partition, else 100000)",
+    )
+    parser.add_argument(
+        "--trees_per_chunk",
+        type=int,
+        default=10,
+        help="Number of tree estimators fitted on every chunk",
+    )
+    parser.add_argument(
+        "--train_data_split",
+        type=float,
+        default=0.8,
+        help="Fraction of samples for training",
+    )
+    parser.add_argument("--seed", type=int, default=42, help="split and forest seed")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="chunks fitted concurrently (default: all cores)",
+    )
+    parser.add_argument(
+        "--baseline",
+        action="store_true",
+        help="also fit one forest on all training cases in memory and compare",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def chunk_bounds(metadata: dict, n_cases: int, chunk_cases: int = None):
+    # (start, end) rows of every chunk: the partitions of an incrementally built panel, fixed size
+    # row ranges otherwise
+    if chunk_cases is None and "partition_cases" in metadata:
+        ends = np.cumsum(metadata["partition_cases"])
+        starts = ends - np.asarray(metadata["partition_cases"])
+    else:
+        starts = np.arange(0, n_cases, chunk_cases or 100000)
+        ends = np.minimum(starts + (chunk_cases or 100000), n_cases)
+    return [(int(start), int(end)) for start, end in zip(starts, ends) if end > start]
+
+
+def merge_single_class_chunks(bounds, labels, train_data_split: float, seed: int):
+    # Trees that only saw one class can't be pooled with the others. A chunk whose training cases
+    # hold a single class is merged into the next one, the last into the one before, so its cases
+    # still reach the model. Merged chunks are bigger than chunk_cases.
+    merged = []
+    for start, end in bounds:
+        if merged and merged[-1][2]:
+            start = merged.pop()[0]
+        train_index, _ = split_cases(end - start, train_data_split, seed + len(merged))
+        single_class = len(np.unique(np.asarray(labels[start:end])[train_index])) < 2
+        merged.append((start, end, single_class))
+    if len(merged) > 1 and merged[-1][2]:
+        merged.pop()
+        merged[-1] = (merged[-1][0], bounds[-1][1], False)
+    return [(start, end) for start, end, _ in merged]
+
+
+def fit_chunk(task):
+    # Fit a sub-forest on the training cases of one chunk. Only this chunk is read from the memory
+    # mapped panel, so a worker's memory is bounded by the chunk size.
+    chunk, path, start, end, n_estimators, train_data_split, seed = task
+    artifact = load_panel(path)
+    panel = np.asarray(artifact.panel[start:end])
+    labels = np.asarray(artifact.labels[start:end])
+    train_index, test_index = split_cases(len(panel), train_data_split, seed + chunk)
+
+    result = {
+        "chunk": chunk,
+        "start": start,
+        "end": end,
+        "train_index": train_index + start,
+        "test_index": test_index + start,
+    }
+    # Left by merge_single_class_chunks only if all training cases hold a single class
+    if len(np.unique(labels[train_index])) < 2:
+        raise ValueError(
+            f"The training cases of rows {start} to {end} hold a single class."
+        )
+
+    fit_start = time.perf_counter()
+    result["strategy"] = fit_forest(
+        panel[train_index],
+        labels[train_index],
+        n_estimators=n_estimators,
+        random_state=seed + chunk,
+    )
+    result["fit_seconds"] = time.perf_counter() - fit_start
+    return result
+
+
+def peak_rss_mb(children: bool = False):
+    # ru_maxrss is in kilobytes on Linux. The resource module is Unix only, None elsewhere.
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def main(args):
+    artifact = load_panel(args.input)
+    partition_bounds = chunk_bounds(
+        artifact.metadata, len(artifact.panel), args.chunk_cases
+    )
+    bounds = merge_single_class_chunks(
+        partition_bounds, artifact.labels, args.train_data_split, args.seed
+    )
+    batch_size = max(end - start for start, end in bounds)
+
+    # Fit one sub-forest per chunk in a process pool
+    start = time.perf_counter()
+    tasks = [
+        (
+            chunk,
+            args.input,
+            chunk_start,
+            chunk_end,
+            args.trees_per_chunk,
+            args.train_data_split,
+            args.seed,
+        )
+        for chunk, (chunk_start, chunk_end) in enumerate(bounds)
+    ]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(fit_chunk, tasks))
+    fit_seconds = time.perf_counter() - start
+
+    for result in results:
+        run.log_row(
+            "chunks",
+            chunk=result["chunk"],
+            cases=result["end"] - result["start"],
+            fit_seconds=result["fit_seconds"],
+        )
+    strategy = merge_forests([result["strategy"] for result in results])
+    test_index = np.concatenate([result["test_index"] for result in results])
+
+    # Metrics, predicted chunk by chunk
+    start = time.perf_counter()
+    y_pred = predict(strategy, artifact.panel, test_index, batch_size=batch_size)
+    predict_seconds = time.perf_counter() - start
+    accuracy = accuracy_score(artifact.labels[test_index], y_pred)
+
+    report = {
+        "chunks": len(bounds),
+        "merged_chunks": len(partition_bounds) - len(bounds),
+        "n_estimators": len(strategy.estimator.estimators_),
+        "train_samples": int(sum(len(r["train_index"]) for r in results)),
+        "test_samples": len(test_index),
+        "accuracy": accuracy,
+        "fit_seconds": fit_seconds,
+        "predict_seconds": predict_seconds,
+        "peak_worker_rss_mb": peak_rss_mb(children=True),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    # The all-in-memory baseline: one forest with as many trees on all training cases at once
+    if args.baseline:
+        train_index = np.concatenate([result["train_index"] for result in results])
+        start = time.perf_counter()
+        baseline = fit_forest(
+            artifact.panel[train_index],
+            artifact.labels[train_index],
+            n_estimators=report["n_estimators"],
+            random_state=args.seed,
+        )
+        report["baseline_fit_seconds"] = time.perf_counter() - start
+        report["baseline_accuracy"] = accuracy_score(
+            artifact.labels[test_index],
+            predict(baseline, artifact.panel, test_index, batch_size=batch_size),
+        )
+        report["baseline_peak_rss_mb"] = peak_rss_mb()
+        report["accuracy_delta"] = accuracy - report["baseline_accuracy"]
+        del baseline
+
+    for key, value in report.items():
+        run.log(key, value)
+    print(json.dumps(report, indent=2))
+
+    # Add to outputs
+    local_model_dir = os.path.join("outputs", "model")
+    os.makedirs(local_model_dir, exist_ok=True)
+    local_model_path = os.path.join(local_model_dir, "model.pkl")
+    dump(strategy, local_model_path)
+    save_training_state(
+        local_model_dir,
+        time_series_length=artifact.metadata["time_series_length"],
+        threshold=artifact.metadata.get("threshold"),
+    )
+    with open(os.path.join("outputs", "chunked.json"), "w") as fh:
+        json.dump(report, fh, indent=2)
+
+    # Export the forest as plain arrays for the scoring service, if it reproduces the predictions
+    compiled_forest = compile_forest(strategy)
+    mismatches = sum(
+        np.count_nonzero(
+            compiled_forest.predict(
+                artifact.panel[test_index[batch : batch + batch_size]]
+            )
+            != y_pred[batch : batch + batch_size]
+        )
+        for batch in range(0, len(test_index), batch_size)
+    )
+    run.log(
+        "compiled_forest_mismatches",
+        mismatches,
+        "Test predictions where the compiled forest disagrees with sktime",
+    )
+    if mismatches == 0:
+        compiled_forest.save(os.path.join(local_model_dir, COMPILED_MODEL_FILENAME))
+
+    if offline:
+        print(f"Offline run, model kept in {local_model_dir}")
+    else:
+        Model.register(
+            workspace=run.experiment.workspace,
+            model_name="sktime_freezer_classifier",
+            model_path=local_model_dir,  # Local folder to upload and register as a model.
+            tags={
+                "area": "freezerchain",
+                "type": "classification",
+                "purpose": "demonstration",
+                "source": "chunked",
+            },
+            description="Sktime classifier to predict if freezer chain was interrupted.",
+            resource_configuration=ResourceConfiguration(cpu=1, memory_in_gb=0.5),
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args=args)
@@ -1,81 +1,280 @@
 import argparse
 import os
+import tempfile
 
-import pandas as pd
+import numpy as np
 from azureml.core import Model, Run
 from azureml.core.resource_configuration import ResourceConfiguration
-from joblib import dump
+from azureml.exceptions import WebserviceException
+from joblib import dump, load
 from sklearn.metrics import accuracy_score
 from sktime.classifiers.compose import TimeSeriesForestClassifier
 from sktime.highlevel.strategies import TSCStrategy
 from sktime.highlevel.tasks import TSCTask
 
-run = Run.get_context()
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--input", type=str, default=None, help="input dataset")
-parser.add_argument(
-    "--n_estimators",
-    type=int,
-    default=10,
-    help="Number of tree estimators used in the model",
+from crossval import (
+    CV_STRATEGIES,
+    cross_validate,
+    fold_indices,
+    log_cross_validation,
 )
-parser.add_argument(
-    "--train_data_split",
-    type=float,
-    default=0.8,
-    help="Fraction of samples for training",
+from ensemble import merge_forests, retire_oldest_trees
+from forest import COMPILED_MODEL_FILENAME, compile_forest
+from utils import (
+    load_panel,
+    load_training_state,
+    new_rows,
+    panel_to_nested,
+    save_training_state,
+    watermark_case_digests,
 )
-args = parser.parse_args()
 
-# Load data
-pickle_path = os.path.join(args.input, "df_nested.pkl")
-processed_data_df = pd.read_pickle(pickle_path)
+run = Run.get_context()
+# Offline runs, e.g. from 04_local_pipeline.py, have no workspace to upload to or register in
+offline = run.id.startswith("OfflineRun")
 
-# Split data
-train = processed_data_df.sample(frac=args.train_data_split, random_state=42)
-test = processed_data_df.drop(train.index)
 
-# Example logging
-run.log(
-    "data_split_fraction",
-    args.train_data_split,
-    "Fraction of samples used for training",
-)
-run.log("train_samples", train.shape[0], "Number of samples used for training")
-run.log("test_samples", test.shape[0], "Number of samples used for testing")
-
-# Train
-task = TSCTask(target="label", metadata=train)
-clf = TimeSeriesForestClassifier(n_estimators=args.n_estimators)
-strategy = TSCStrategy(clf)
-strategy.fit(task, train)
-run.log(
-    "n_estimators", args.n_estimators, "Number of tree estimators used in the model"
-)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, default=None, help="input dataset")
+    parser.add_argument(
+        "--n_estimators",
+        type=int,
+        default=10,
+        help="Number of tree estimators used in the model",
+    )
+    parser.add_argument(
+        "--train_data_split",
+        type=float,
+        default=0.8,
+        help="Fraction of samples for training",
+    )
+    parser.add_argument(
+        "--warm_start",
+        type=lambda value: value.lower() in ("true", "1", "yes"),
+        nargs="?",
+        const=True,
+        default=False,
+        help="add trees for the cases the registered model has not seen, e.g. --warm_start "
+        "or --warm_start True (default: train from scratch)",
+    )
+    parser.add_argument(
+        "--max_estimators",
+        type=int,
+        default=None,
+        help="retire the oldest trees beyond this many",
+    )
+    parser.add_argument(
+        "--previous_model_dir",
+        type=str,
+        default=None,
+        help="model to warm start from (default: the registered model)",
+    )
+    parser.add_argument(
+        "--cv_folds",
+        type=int,
+        default=0,
+        help="cross-validate with this many folds before training (0: off)",
+    )
+    parser.add_argument(
+        "--cv_strategy",
+        type=str,
+        default="kfold",
+        choices=CV_STRATEGIES,
+        help="how cases are assigned to folds",
+    )
+    args = parser.parse_args()
+    return args
 
-# Metrics
-y_pred = strategy.predict(test)
-y_test = test[task.target]
-accuracy = accuracy_score(y_test, y_pred)
-run.log("Accuracy", f"{accuracy:1.3f}", "Accuracy of model")
-
-# Add to outputs
-os.makedirs("outputs", exist_ok=True)
-local_model_path = os.path.join("outputs", "model.pkl")
-dump(strategy, local_model_path)
-run.upload_file("pickled_model", local_model_path)
-
-model = Model.register(
-    workspace=run.experiment.workspace,
-    model_name="sktime_freezer_classifier",
-    model_path=local_model_path,  # Local file to upload and register as a model.
-    tags={
-        "area": "freezerchain",
-        "type": "classification",
-        "purpose": "demonstration",
-        "source": "pipeline",
-    },
-    description="Sktime classifier to predict if freezer chain was interrupted.",
-    resource_configuration=ResourceConfiguration(cpu=1, memory_in_gb=0.5),
-)
+
+def previous_model_dir(args):
+    # Download the registered model, None if there is none yet
+    if args.previous_model_dir is not None:
+        return args.previous_model_dir
+    if offline:
+        return None
+    try:
+        model = Model(run.experiment.workspace, "sktime_freezer_classifier")
+    except WebserviceException:
+        return None
+    return model.download(target_dir=tempfile.mkdtemp(), exist_ok=True)
+
+
+def main(args):
+    # Load data. The panel is memory mapped and only nested where sktime needs it.
+    artifact = load_panel(args.input)
+    partitions = artifact.metadata.get("partitions")
+    time_series_length = artifact.metadata["time_series_length"]
+    threshold = artifact.metadata.get("threshold")
+
+    # Warm start: only learn from the cases the previous model has not seen
+    previous_strategy, previous_state, seen, rows = None, None, None, None
+    if args.warm_start:
+        model_dir = previous_model_dir(args)
+        if model_dir is not None:
+            previous_state, seen = load_training_state(model_dir)
+        # Models of other trainers, e.g. train.py, have no watermark to continue from
+        if previous_state is None or previous_state.get("watermark") is None:
+            previous_state = None
+            print("No previous model with a training watermark, training from scratch")
+        else:
+            if partitions is None or artifact.case_digests is None:
+                raise ValueError(
+                    "Warm starts need a panel with partitions and case digests, "
+                    "see 01_raw_to_long.py."
+                )
+            # The new trees have to read the same window and learn the same labels as the previous
+            # ones
+            for key, value in (
+                ("time_series_length", time_series_length),
+                ("threshold", threshold),
+            ):
+                if previous_state.get(key) != value:
+                    raise ValueError(
+                        f"Cannot warm start a model trained with {key} "
+                        f"{previous_state.get(key)} on a panel with {value}."
+                    )
+            previous_strategy = load(os.path.join(model_dir, "model.pkl"))
+            # Models saved before watermark digests relearn their whole watermark partition
+            if seen is None:
+                seen = np.empty(0, dtype=np.uint64)
+            rows = new_rows(
+                artifact.metadata,
+                artifact.case_digests,
+                watermark=previous_state["watermark"],
+                seen_digests=seen,
+            )
+            run.log("previous_watermark", previous_state["watermark"])
+            run.log("new_samples", len(rows), "Samples added since the previous model")
+            # Too few new cases wait for the next run, the watermark stays where it is
+            if len(np.unique(artifact.labels[rows])) < 2:
+                print(
+                    f"{len(rows)} new samples since {previous_state['watermark']} do not "
+                    "cover both classes, nothing to train"
+                )
+                return
+
+    panel = artifact.panel if rows is None else artifact.panel[rows]
+    processed_data_df = panel_to_nested(panel)
+    processed_data_df["label"] = (
+        artifact.labels if rows is None else artifact.labels[rows]
+    )
+
+    # Split data
+    train = processed_data_df.sample(frac=args.train_data_split, random_state=42)
+    test = processed_data_df.drop(train.index)
+
+    # Example logging
+    run.log(
+        "data_split_fraction",
+        args.train_data_split,
+        "Fraction of samples used for training",
+    )
+    run.log("train_samples", train.shape[0], "Number of samples used for training")
+    run.log("test_samples", test.shape[0], "Number of samples used for testing")
+
+    # Cross-validate in parallel on index arrays into the memory mapped panel
+    if args.cv_folds > 1:
+        case_rows = np.arange(len(artifact.panel)) if rows is None else rows
+        folds = [
+            (case_rows[train_index], case_rows[test_index])
+            for train_index, test_index in fold_indices(
+                len(case_rows),
+                args.cv_folds,
+                args.cv_strategy,
+                labels=artifact.labels[case_rows],
+            )
+        ]
+        log_cross_validation(
+            run,
+            cross_validate(
+                artifact.panel, artifact.labels, folds, n_estimators=args.n_estimators
+            ),
+        )
+
+    # Train
+    task = TSCTask(target="label", metadata=train)
+    clf = TimeSeriesForestClassifier(n_estimators=args.n_estimators)
+    strategy = TSCStrategy(clf)
+    strategy.fit(task, train)
+    run.log(
+        "n_estimators", args.n_estimators, "Number of tree estimators used in the model"
+    )
+
+    # Add the new trees to the previous ones. Trees are kept oldest first, with the watermark they were
+    # trained up to.
+    tree_watermarks = [partitions[-1] if partitions else None] * args.n_estimators
+    if previous_strategy is not None:
+        strategy = merge_forests([previous_strategy, strategy])
+        tree_watermarks = previous_state["tree_watermarks"] + tree_watermarks
+    if args.max_estimators is not None and len(tree_watermarks) > args.max_estimators:
+        run.log("retired_estimators", len(tree_watermarks) - args.max_estimators)
+        strategy = retire_oldest_trees(strategy, args.max_estimators)
+        tree_watermarks = tree_watermarks[-args.max_estimators :]
+    run.log("total_estimators", len(tree_watermarks), "Trees in the registered model")
+
+    # Metrics
+    y_pred = strategy.predict(test)
+    y_test = test[task.target]
+    accuracy = accuracy_score(y_test, y_pred)
+    run.log("Accuracy", f"{accuracy:1.3f}", "Accuracy of model")
+
+    # Add to outputs
+    local_model_dir = os.path.join("outputs", "model")
+    os.makedirs(local_model_dir, exist_ok=True)
+    local_model_path = os.path.join(local_model_dir, "model.pkl")
+    dump(strategy, local_model_path)
+    # The watermark partition is usually still filling up, the digests of its cases tell the next
+    # warm start which of them it has learned from
+    save_training_state(
+        local_model_dir,
+        time_series_length=time_series_length,
+        watermark_digests=(
+            watermark_case_digests(
+                artifact.metadata, artifact.case_digests, previous_state, seen
+            )
+            if partitions and artifact.case_digests is not None
+            else None
+        ),
+        threshold=threshold,
+        watermark=partitions[-1] if partitions else None,
+        tree_watermarks=tree_watermarks,
+    )
+    if not offline:
+        run.upload_file("pickled_model", local_model_path)
+
+    # Export the forest as plain arrays for the scoring service, if it reproduces the predictions
+    compiled_forest = compile_forest(strategy)
+    mismatches = np.count_nonzero(
+        compiled_forest.predict(panel[test.index]) != np.asarray(y_pred)
+    )
+    run.log(
+        "compiled_forest_mismatches",
+        mismatches,
+        "Test predictions where the compiled forest disagrees with sktime",
+    )
+    if mismatches == 0:
+        compiled_forest.save(os.path.join(local_model_dir, COMPILED_MODEL_FILENAME))
+
+    if offline:
+        print(f"Offline run, model kept in {local_model_dir}")
+    else:
+        model = Model.register(
+            workspace=run.experiment.workspace,
+            model_name="sktime_freezer_classifier",
+            model_path=local_model_dir,  # Local folder to upload and register as a model.
+            tags={
+                "area": "freezerchain",
+                "type": "classification",
+                "purpose": "demonstration",
+                "source": "pipeline",
+            },
+            description="Sktime classifier to predict if freezer chain was interrupted.",
+            resource_configuration=ResourceConfiguration(cpu=1, memory_in_gb=0.5),
+        )
+
+
+# Cross-validation workers import this module again, e.g. on Windows where they are spawned
+if __name__ == "__main__":
+    args = parse_args()
+    main(args=args)
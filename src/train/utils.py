@@ -1,50 +1,473 @@
+import glob
 import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 
+import numpy as np
 import pandas as pd
 
-from sktime.utils.load_data import from_long_to_nested
+STRING_FIELDS = ("timeCreated", "ConnectionDeviceId")
+PANEL_FORMAT_VERSION = 1
+# Stored next to model.pkl: the time series length, threshold and watermarks of the model
+TRAINING_STATE_FILENAME = "training.json"
+# Stored next to training.json: the case digests of the watermark partition the model learned from
+WATERMARK_DIGESTS_FILENAME = "watermark_digests.npy"
+# Seconds between the readings of a series document, see decode_series
+GRANULARITIES = {"secondly": 1, "minutely": 60, "hourly": 3600, "daily": 86400}
 
+# A panel artifact on disk: panel.npy, case_index.npy, optionally labels.npy and case_digests.npy, and
+# a metadata.json sidecar.
+PanelArtifact = namedtuple(
+    "PanelArtifact", ["panel", "case_index", "labels", "metadata", "case_digests"]
+)
 
-def prepare_dataframe(
-    processed_json_df: pd.DataFrame, time_series_length: int, threshold: float
+# Compact, column-wise view of the "allevents" column. "lengths" holds the number of events per case,
+# "counts" the number of events actually kept per case and "columns" one flat array per field.
+DecodedEvents = namedtuple("DecodedEvents", ["lengths", "counts", "columns"])
+
+
+def _decode_chunk(task):
+    raw_chunk, fields, keep_last = task
+    lengths = np.empty(len(raw_chunk), dtype=np.int64)
+    values = {field: [] for field in fields}
+    for i, raw in enumerate(raw_chunk):
+        events = json.loads(raw)
+        lengths[i] = len(events)
+        if keep_last is not None:
+            events = events[-keep_last:]
+        for field in fields:
+            if field in STRING_FIELDS:
+                values[field].extend(event.get(field) or "" for event in events)
+            else:
+                values[field].extend(event[field] for event in events)
+
+    counts = lengths if keep_last is None else np.minimum(lengths, keep_last)
+    columns = {
+        field: np.array(
+            values[field], dtype=str if field in STRING_FIELDS else np.float64
+        )
+        for field in fields
+    }
+    return lengths, counts, columns
+
+
+def decode_allevents(
+    raw_allevents,
+    fields=("temperature",),
+    keep_last: int = None,
+    chunk_size: int = 10000,
+    n_workers: int = None,
+):
+    # Decode the "allevents" JSON strings chunk by chunk in a process pool. Workers only return the
+    # requested fields as flat arrays, so no decoded dicts outlive their chunk.
+    # With keep_last set, only the last keep_last events of every case are kept.
+    raw_allevents = list(raw_allevents)
+    tasks = [
+        (raw_allevents[start : start + chunk_size], tuple(fields), keep_last)
+        for start in range(0, len(raw_allevents), chunk_size)
+    ]
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) <= 1:
+        chunks = [_decode_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks))) as executor:
+            chunks = list(executor.map(_decode_chunk, tasks))
+
+    if not chunks:
+        chunks = [_decode_chunk(([], tuple(fields), keep_last))]
+    return DecodedEvents(
+        lengths=np.concatenate([lengths for lengths, _, _ in chunks]),
+        counts=np.concatenate([counts for _, counts, _ in chunks]),
+        columns={
+            field: np.concatenate([columns[field] for _, _, columns in chunks])
+            for field in fields
+        },
+    )
+
+
+# Series documents (sample.json), for prepare_dataframe. Copied from preprocess/utils.py down to
+# decode_series, train.py reads the raw dataset itself. Change them together.
+def granularity_seconds(granularity):
+    if not isinstance(granularity, str) or granularity not in GRANULARITIES:
+        raise ValueError(
+            f"Unknown granularity {granularity!r}, expected one of {sorted(GRANULARITIES)}."
+        )
+    return GRANULARITIES[granularity]
+
+
+def parse_timestamps(timestamps):
+    # ISO 8601 strings like "2020-06-28 11:33:00+02:00" -> datetime64[s] in UTC. The date and time,
+    # with or without seconds, are parsed by NumPy in one go and fractions of a second are dropped.
+    # The offset is parsed here: "Z" and no offset read as UTC, +HH:MM, +HHMM and +HH (or with "-")
+    # are subtracted. Raises ValueError for anything else.
+    raw = np.asarray(timestamps, dtype=bytes)
+    if not len(raw):
+        return np.empty(0, dtype="datetime64[s]")
+    lengths = np.char.str_len(raw)
+    if np.any(lengths < 16):
+        raise ValueError("Timestamps must look like yyyy-mm-ddThh:mm[:ss[.f]][offset].")
+    # Zero padding behind every timestamp, so the offset can be sliced out of the longest one
+    chars = np.zeros((len(raw), raw.itemsize + 7), dtype=np.uint8)
+    chars[:, : raw.itemsize] = raw.view(np.uint8).reshape(len(raw), raw.itemsize)
+    if np.any((chars[:, 10] != ord("T")) & (chars[:, 10] != ord(" "))):
+        raise ValueError("Timestamps must separate date and time with 'T' or ' '.")
+
+    # Where the offset starts: after hh:mm, :ss and the digits of a fraction
+    has_seconds = chars[:, 16] == ord(":")
+    ends = np.where(has_seconds, 19, 16)
+    has_fraction = has_seconds & (chars[:, 19] == ord("."))
+    if np.any(has_fraction):
+        digit = (chars >= ord("0")) & (chars <= ord("9"))
+        fraction_ends = np.argmax(~digit & (np.arange(chars.shape[1]) > 19), axis=1)
+        if np.any(fraction_ends[has_fraction] == 20):
+            raise ValueError("Timestamp fractions must have digits.")
+        ends = np.where(has_fraction, fraction_ends, ends)
+
+    # "yyyy-mm-ddThh:mm:ss" without fraction and offset, seconds default to zero
+    local = np.full((len(raw), 19), ord("0"), dtype=np.uint8)
+    local[:, :16] = chars[:, :16]
+    local[:, 10] = ord("T")
+    local[:, 16] = ord(":")
+    local[has_seconds, 17:19] = chars[has_seconds, 17:19]
+    utc = local.view("S19").ravel().astype("datetime64[s]")
+
+    offset_lengths = lengths - ends
+    offsets = np.take_along_axis(chars, ends[:, np.newaxis] + np.arange(6), axis=1)
+    signed = (offsets[:, 0] == ord("+")) | (offsets[:, 0] == ord("-"))
+    valid = (
+        (offset_lengths == 0)
+        | ((offset_lengths == 1) & (offsets[:, 0] == ord("Z")))
+        | (signed & np.isin(offset_lengths, (3, 5, 6)))
+    )
+    colon = offset_lengths == 6
+    if not np.all(valid) or np.any(offsets[signed & colon, 3] != ord(":")):
+        raise ValueError("Timestamp offsets must be Z, +HH:MM, +HHMM or +HH.")
+    if not np.any(signed):
+        return utc
+
+    rows = np.flatnonzero(signed)
+    offsets, offset_lengths, colon = offsets[rows], offset_lengths[rows], colon[rows]
+    # +HH:MM -> +HHMM and +HH -> +HH00
+    offsets[colon, 3:5] = offsets[colon, 4:6]
+    offsets[offset_lengths == 3, 3:5] = ord("0")
+    digits = offsets[:, 1:5].astype(np.int64) - ord("0")
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 2] * 10 + digits[:, 3]
+    if np.any((digits < 0) | (digits > 9)) or np.any((hours > 23) | (minutes > 59)):
+        raise ValueError("Timestamp offsets must be Z, +HH:MM, +HHMM or +HH.")
+    sign = np.where(offsets[:, 0] == ord("-"), -1, 1)
+    utc[rows] -= (sign * (hours * 3600 + minutes * 60)).astype("timedelta64[s]")
+    return utc
+
+
+def resample_series(times, values, step: int, keep_last: int = None):
+    # Put readings onto a grid of step seconds, from the first to the last reading. Every reading
+    # goes to the nearest grid point, the latest one wins where several do, and grid points without
+    # a reading repeat the one before. With keep_last, only the last keep_last grid points are built.
+    # Returns the grid (datetime64[s]), its values and the length of the full grid.
+    seconds = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+    values = np.asarray(values)
+    if not len(seconds):
+        return seconds.astype("datetime64[s]"), values, 0
+    order = np.argsort(seconds, kind="stable")
+    slots = (seconds[order] + step // 2) // step
+    latest = np.append(slots[1:] != slots[:-1], True)
+    slots, order = slots[latest], order[latest]
+    length = int(slots[-1] - slots[0]) + 1
+
+    # The grid starts keep_last points before the end, filled from the last reading before it
+    start = slots[0] if keep_last is None else max(slots[0], slots[-1] - keep_last + 1)
+    first = np.searchsorted(slots, start, side="right") - 1
+    positions = np.maximum(slots[first:] - start, 0)
+    filled = np.zeros(positions[-1] + 1, dtype=np.intp)
+    filled[positions] = np.arange(len(positions))
+    filled = np.maximum.accumulate(filled)
+
+    grid = (np.arange(start, slots[-1] + 1) * step).astype("datetime64[s]")
+    return grid, values[order[first:]][filled], length
+
+
+def _decode_series_chunk(task):
+    raw_chunk, keep_last = task
+    lengths = np.empty(len(raw_chunk), dtype=np.int64)
+    readings = []
+    for i, raw in enumerate(raw_chunk):
+        document = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+        series = document["series"]
+        # Tabular datasets keep the nested list as a JSON string
+        if isinstance(series, str):
+            series = json.loads(series)
+        _, values, lengths[i] = resample_series(
+            parse_timestamps(list(map(itemgetter("timestamp"), series))),
+            np.fromiter(
+                map(itemgetter("value"), series), dtype=np.float64, count=len(series)
+            ),
+            granularity_seconds(document["granularity"]),
+            keep_last=keep_last,
+        )
+        readings.append(values)
+
+    counts = np.fromiter(map(len, readings), dtype=np.int64, count=len(readings))
+    return lengths, counts, np.concatenate(readings or [np.empty(0)])
+
+
+def decode_series(
+    raw_series,
+    keep_last: int = None,
+    chunk_size: int = 10000,
+    n_workers: int = None,
+):
+    # decode_allevents for documents in the series format of sample.json, as JSON strings or dicts.
+    # Every series is resampled onto its granularity and gap filled, so "lengths" counts grid points
+    # rather than uploaded readings. Only the values are decoded, as the "temperature" column.
+    raw_series = list(raw_series)
+    tasks = [
+        (raw_series[start : start + chunk_size], keep_last)
+        for start in range(0, len(raw_series), chunk_size)
+    ]
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) <= 1:
+        chunks = [_decode_series_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks))) as executor:
+            chunks = list(executor.map(_decode_series_chunk, tasks))
+
+    if not chunks:
+        chunks = [_decode_series_chunk(([], keep_last))]
+    return DecodedEvents(
+        lengths=np.concatenate([lengths for lengths, _, _ in chunks]),
+        counts=np.concatenate([counts for _, counts, _ in chunks]),
+        columns={"temperature": np.concatenate([values for _, _, values in chunks])},
+    )
+
+
+def ragged_to_panel(
+    decoded: DecodedEvents, time_series_length: int, dimensions=("temperature",)
 ):
-    # Convert to JSON
-    processed_json_df["allevents"] = processed_json_df["allevents"].apply(
-        lambda x: json.loads(x)
+    # Convert decoded events into a dense panel of shape (n_cases, n_dims, time_series_length),
+    # plus the row position of every case.
+    # prepare_dataframe builds its panel like 01_raw_to_long.py, so this is preprocess/utils.py's.
+
+    # We ignore cases with insufficient readings
+    keep = decoded.lengths >= time_series_length
+    if np.any(decoded.counts[keep] < time_series_length):
+        raise ValueError(
+            f"Events were decoded with fewer than {time_series_length} readings per case."
+        )
+    case_index = np.flatnonzero(keep)
+
+    # We also slice samples with too many readings ([-size:])
+    ends = np.cumsum(decoded.counts)[keep]
+    readings = ends[:, np.newaxis] + np.arange(-time_series_length, 0)
+
+    panel = np.empty(
+        (len(case_index), len(dimensions), time_series_length), dtype=np.float64
     )
+    for dim_id, dimension in enumerate(dimensions):
+        panel[:, dim_id, :] = decoded.columns[dimension][readings]
+
+    return panel, case_index
 
-    # Reset PartitionDate Index to a simple range. We'll use it to index our "cases" ("samples")
-    processed_json_df.reset_index(drop=True, inplace=True)
 
-    # sktime expects a specific format. For now the easiest way is to convert our DataFrame to a long format
-    # and then use the sktime parser.
-    def dataframe_to_long(df, size=time_series_length):
-        case_id = 0
-        for _, case in df.iterrows():
-            events = case["allevents"]
+def load_panel(path: str, mmap_mode: str = "r"):
+    # Open a panel artifact. The arrays are memory mapped unless mmap_mode is None.
+    # Reads what preprocess/utils.py's save_panel writes, and mirrors its load_panel.
+    with open(os.path.join(path, "metadata.json"), "r") as fh:
+        metadata = json.load(fh)
+    if metadata.get("format_version") != PANEL_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported panel format version {metadata.get('format_version')} in '{path}'."
+        )
 
-            # We ignore cases with insufficient readings
-            if len(events) < size:
-                continue
+    panel = np.load(os.path.join(path, "panel.npy"), mmap_mode=mmap_mode)
+    case_index = np.load(os.path.join(path, "case_index.npy"), mmap_mode=mmap_mode)
+    optional = {}
+    for name in ("labels", "case_digests"):
+        optional_path = os.path.join(path, f"{name}.npy")
+        optional[name] = (
+            np.load(optional_path, mmap_mode=mmap_mode)
+            if os.path.exists(optional_path)
+            else None
+        )
+    return PanelArtifact(panel, case_index, metadata=metadata, **optional)
 
-            # We also slice samples with too many readings ([-size:])
-            for reading_id, values in enumerate(events[-size:]):
-                yield case_id, 0, reading_id, values["temperature"]
-                # We can add more dimensions later on.
-                # yield case_id, 1, reading_id, values["ambienttemperature"]
 
-            case_id += 1  # can't use the row index because we skip rows.
+def read_local_allevents(root: str):
+    # The "allevents" strings of all JSON lines files in a local /yyyy/MM/dd/ layout, in
+    # PartitionDate order. Local stand-in for the registered dataset.
+    raw_allevents = []
+    for path in sorted(glob.glob(os.path.join(root, "*", "*", "*", "*.json"))):
+        with open(path, "r") as fh:
+            raw_allevents.extend(
+                json.loads(line)["allevents"] for line in fh if line.strip()
+            )
+    return raw_allevents
 
-    df_long = pd.DataFrame(
-        dataframe_to_long(processed_json_df, size=time_series_length),
-        columns=["case_id", "dim_id", "reading_id", "value"],
+
+def save_decoded(path: str, decoded: DecodedEvents):
+    # Store decoded events as plain .npy files, so worker processes can memory map them
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "lengths.npy"), decoded.lengths)
+    np.save(os.path.join(path, "counts.npy"), decoded.counts)
+    for field, column in decoded.columns.items():
+        np.save(os.path.join(path, f"column_{field}.npy"), column)
+
+
+def load_decoded(path: str, mmap_mode: str = "r"):
+    columns = {
+        filename[len("column_") : -len(".npy")]: np.load(
+            os.path.join(path, filename), mmap_mode=mmap_mode
+        )
+        for filename in sorted(os.listdir(path))
+        if filename.startswith("column_")
+    }
+    return DecodedEvents(
+        lengths=np.load(os.path.join(path, "lengths.npy"), mmap_mode=mmap_mode),
+        counts=np.load(os.path.join(path, "counts.npy"), mmap_mode=mmap_mode),
+        columns=columns,
     )
 
-    # Convert to Sktime "nested" Format
-    df_nested = from_long_to_nested(df_long)
 
+def panel_to_nested(panel: np.ndarray):
+    # sktime's nested format: one column per dimension, holding one pd.Series per case
+    n_cases, n_dims, _ = panel.shape
+    return pd.DataFrame(
+        {
+            f"dim_{dim_id}": pd.Series(
+                [
+                    pd.Series(panel[case_id, dim_id], dtype=np.float64)
+                    for case_id in range(n_cases)
+                ],
+                dtype=object,
+            )
+            for dim_id in range(n_dims)
+        }
+    )
+
+
+def nested_to_panel(df_nested: pd.DataFrame):
+    # Inverse of panel_to_nested for the "dim_*" columns of a nested frame
+    dimensions = [column for column in df_nested.columns if column.startswith("dim_")]
+    return np.stack(
+        [
+            np.stack(
+                [np.asarray(series, dtype=np.float64) for series in df_nested[dim]]
+            )
+            for dim in dimensions
+        ],
+        axis=1,
+    )
+
+
+def panel_labels(panel: np.ndarray, threshold: float):
     # Fake some labels
     # We simply explore the data, set an arbitrary threshold and define all series above that threshold as "True".
-    df_nested["label"] = df_nested["dim_0"].apply(lambda x: x.max()) > threshold
+    return panel[:, 0, :].max(axis=1) > threshold
+
+
+def _partition_bounds(metadata: dict):
+    ends = np.cumsum(metadata["partition_cases"])
+    starts = ends - np.asarray(metadata["partition_cases"])
+    return zip(metadata["partitions"], starts, ends)
+
+
+def new_rows(metadata: dict, case_digests, watermark: str, seen_digests):
+    # Rows of a panel concatenated from partitions that a model trained up to the watermark
+    # PartitionDate has not learned from: all rows of later PartitionDates, and the rows of the
+    # watermark partition whose case digest is not in seen_digests. PartitionDates are days and Stream
+    # Analytics keeps adding to today's, in no particular row order, so the watermark partition is
+    # rarely complete. Rows of earlier partitions count as learned.
+    rows = [np.arange(0)]
+    for partition_date, start, end in _partition_bounds(metadata):
+        if partition_date > watermark:
+            rows.append(np.arange(start, end))
+        elif partition_date == watermark:
+            unseen = ~np.isin(np.asarray(case_digests[start:end]), seen_digests)
+            rows.append(start + np.flatnonzero(unseen))
+    return np.concatenate(rows)
+
+
+def watermark_case_digests(
+    metadata: dict, case_digests, previous_state=None, seen=None
+):
+    # The digests of the cases of the panel's last partition, the watermark of a model trained on it.
+    # A warm start inside the same partition keeps the digests seen before.
+    partition_date, start, end = list(_partition_bounds(metadata))[-1]
+    digests = np.asarray(case_digests[start:end])
+    if (
+        seen is not None
+        and previous_state is not None
+        and previous_state.get("watermark") == partition_date
+    ):
+        digests = np.union1d(seen, digests)
+    return np.unique(digests)
+
+
+def save_training_state(
+    model_dir: str, time_series_length: int, watermark_digests=None, **state
+):
+    # training.json is registered with the model. The scoring service cuts windows of
+    # time_series_length readings, warm starts continue from the watermarks of train_pipeline.py.
+    with open(os.path.join(model_dir, TRAINING_STATE_FILENAME), "w") as fh:
+        json.dump(dict(state, time_series_length=time_series_length), fh, indent=2)
+    if watermark_digests is not None:
+        np.save(
+            os.path.join(model_dir, WATERMARK_DIGESTS_FILENAME),
+            np.asarray(watermark_digests, dtype=np.uint64),
+        )
+
+
+def load_training_state(model_dir: str):
+    # (training.json, watermark digests) of a model, None for what it doesn't have
+    state_path = os.path.join(model_dir, TRAINING_STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return None, None
+    with open(state_path, "r") as fh:
+        state = json.load(fh)
+    digests_path = os.path.join(model_dir, WATERMARK_DIGESTS_FILENAME)
+    digests = np.load(digests_path) if os.path.exists(digests_path) else None
+    return state, digests
+
+
+def split_cases(n_cases: int, train_data_split: float, seed: int):
+    # Index arrays of a random train/test split
+    permutation = np.random.RandomState(seed).permutation(n_cases)
+    n_train = int(round(train_data_split * n_cases))
+    return np.sort(permutation[:n_train]), np.sort(permutation[n_train:])
+
+
+def prepare_dataframe(
+    processed_json_df: pd.DataFrame,
+    time_series_length: int,
+    threshold: float,
+    chunk_size: int = 10000,
+    n_workers: int = None,
+):
+    # Decode the JSON events in parallel, keeping only the readings we need. Datasets in the series
+    # format ("granularity" and "series" columns) are resampled like 01_raw_to_long.py does.
+    if "series" in processed_json_df.columns:
+        decoded = decode_series(
+            processed_json_df[["granularity", "series"]].to_dict("records"),
+            keep_last=time_series_length,
+            chunk_size=chunk_size,
+            n_workers=n_workers,
+        )
+    else:
+        decoded = decode_allevents(
+            processed_json_df["allevents"],
+            keep_last=time_series_length,
+            chunk_size=chunk_size,
+            n_workers=n_workers,
+        )
+
+    # Build a dense panel and convert it to the sktime "nested" format TSCStrategy expects. The panel
+    # is returned too, row i of the DataFrame is case i of the panel.
+    panel, _ = ragged_to_panel(decoded, time_series_length=time_series_length)
+    df_nested = panel_to_nested(panel)
+    df_nested["label"] = panel_labels(panel, threshold)
 
-    return df_nested
+    return df_nested, panel
@@ -0,0 +1,65 @@
+import importlib
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+# Every step folder is uploaded on its own and imports its siblings by module name, so folders share
+# module names (utils, forest, ...). Modules are imported fresh from the folder a test asks for.
+STEP_MODULES = (
+    "cache",
+    "crossval",
+    "encoding",
+    "ensemble",
+    "forest",
+    "score",
+    "server",
+    "utils",
+)
+WINDOW_LENGTH = 10
+
+
+def import_step(folder: str, name: str):
+    for module in STEP_MODULES:
+        sys.modules.pop(module, None)
+    path = os.path.join(SRC, folder)
+    sys.path.insert(0, path)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(path)
+
+
+@pytest.fixture
+def step_module():
+    return import_step
+
+
+@pytest.fixture
+def score(step_module, tmp_path, monkeypatch):
+    # One tree on the mean of the window: False up to 250 degrees, True above
+    forest = step_module("deployment", "forest")
+    forest.CompiledForest(
+        max_depth=1,
+        classes=np.array([False, True]),
+        feature_start=np.array([0]),
+        feature_end=np.array([WINDOW_LENGTH]),
+        feature_kind=np.array([0]),
+        node_feature=np.array([0, 0, 0]),
+        node_threshold=np.array([250.0, 0.0, 0.0]),
+        node_left=np.array([1, 1, 2]),
+        node_right=np.array([2, 1, 2]),
+        node_value=np.array([[0.5, 0.5], [1.0, 0.0], [0.0, 1.0]]),
+        tree_root=np.array([0]),
+    ).save(str(tmp_path / "model_compiled.npz"))
+    (tmp_path / "training.json").write_text(
+        json.dumps({"time_series_length": WINDOW_LENGTH})
+    )
+    monkeypatch.setenv("AZUREML_MODEL_DIR", str(tmp_path))
+    monkeypatch.setenv("SCORE_CACHE_CAPACITY", "0")
+    score = step_module("deployment", "score")
+    score.init()
+    return score
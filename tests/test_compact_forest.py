@@ -0,0 +1,149 @@
+import warnings
+
+import numpy as np
+import pytest
+
+LENGTH = 40
+
+
+def random_forest(forest_module, rng, n_trees, n_features, max_depth, features):
+    # An uncompacted CompiledForest of random trees, laid out like compile_forest does. Thresholds are
+    # drawn from the features of a panel and nudged onto and next to float32 values, where narrowing
+    # them could go wrong.
+    feature_start = rng.integers(0, LENGTH - 2, size=n_features)
+    feature_end = feature_start + rng.integers(2, LENGTH - feature_start + 1)
+    feature_kind = rng.integers(0, 3, size=n_features)
+    engine = forest_module.IntervalFeatures(features)
+    Xt = np.column_stack(
+        [
+            engine.feature(start, end, kind)
+            for start, end, kind in zip(feature_start, feature_end, feature_kind)
+        ]
+    )
+
+    nodes = {
+        name: [] for name in ("feature", "threshold", "left", "right", "value", "depth")
+    }
+
+    def add_node(depth):
+        index = len(nodes["feature"])
+        for values in nodes.values():
+            values.append(None)
+        nodes["depth"][index] = depth
+        value = rng.integers(0, 9, size=2).astype(np.float64) + 1
+        nodes["value"][index] = value / value.sum()
+        if depth == max_depth or rng.random() < 0.2:
+            nodes["feature"][index], nodes["threshold"][index] = 0, 0.0
+            nodes["left"][index] = nodes["right"][index] = index
+            return index
+        feature = int(rng.integers(n_features))
+        threshold = float(np.float32(rng.choice(Xt[:, feature])))
+        nodes["feature"][index] = feature
+        nodes["threshold"][index] = threshold + rng.choice(
+            [0.0, 1e-12 * abs(threshold), -1e-12 * abs(threshold)]
+        )
+        nodes["left"][index] = add_node(depth + 1)
+        nodes["right"][index] = add_node(depth + 1)
+        return index
+
+    tree_root = [add_node(0) for _ in range(n_trees)]
+    return forest_module.CompiledForest(
+        max_depth=max(nodes["depth"]),
+        classes=np.array([False, True]),
+        feature_start=feature_start.astype(np.int32),
+        feature_end=feature_end.astype(np.int32),
+        feature_kind=feature_kind.astype(np.int8),
+        node_feature=np.array(nodes["feature"], dtype=np.int32),
+        node_threshold=np.array(nodes["threshold"], dtype=np.float64),
+        node_left=np.array(nodes["left"], dtype=np.int32),
+        node_right=np.array(nodes["right"], dtype=np.int32),
+        node_value=np.array(nodes["value"]),
+        tree_root=np.array(tree_root, dtype=np.int32),
+    )
+
+
+# Small forests narrow everything to int8, large ones need int16 for nodes and features
+@pytest.mark.parametrize(
+    "n_trees, n_features, max_depth, index_dtype",
+    [(3, 5, 3, np.int8), (20, 200, 8, np.int16)],
+)
+def test_compact_forest_predicts_like_full_forest(
+    step_module, tmp_path, n_trees, n_features, max_depth, index_dtype
+):
+    forest_module = step_module("train", "forest")
+    rng = np.random.default_rng(n_trees)
+    panel = rng.normal(200.0, 30.0, size=(300, 1, LENGTH))
+    full = random_forest(
+        forest_module, rng, n_trees, n_features, max_depth, panel[:, 0]
+    )
+
+    compact = forest_module.compact_forest(full)
+    compact.save(str(tmp_path / "model_compiled.npz"))
+    loaded = step_module("deployment", "forest").CompiledForest.load(
+        str(tmp_path / "model_compiled.npz")
+    )
+
+    assert compact.leaf_values
+    np.testing.assert_array_equal(
+        compact.predict_proba(panel), full.predict_proba(panel)
+    )
+    np.testing.assert_array_equal(
+        loaded.predict_proba(panel), full.predict_proba(panel)
+    )
+    assert compact.node_left.dtype == compact.node_right.dtype == index_dtype
+    assert compact.node_feature.dtype == index_dtype
+    assert compact.node_threshold.dtype == np.float32
+    # No index wrapped around when it was narrowed
+    n_nodes = len(compact.node_left)
+    for name in ("node_left", "node_right", "tree_root"):
+        assert (
+            0 <= getattr(compact, name).min() <= getattr(compact, name).max() < n_nodes
+        )
+    assert compact.node_feature.min() >= 0
+
+
+def test_index_dtype_bounds(step_module):
+    forest_module = step_module("train", "forest")
+    for n, dtype in [
+        (1, np.int8),
+        (128, np.int8),
+        (129, np.int16),
+        (2**15, np.int16),
+        (2**15 + 1, np.int32),
+        (2**31 + 1, np.int64),
+    ]:
+        assert forest_module._index_dtype(n) == dtype
+        # The largest index, n - 1, survives the cast
+        assert np.array(n - 1).astype(dtype) == n - 1
+
+
+def test_float32_thresholds_are_lossless(step_module):
+    forest_module = step_module("train", "forest")
+    rng = np.random.default_rng(0)
+    x = rng.normal(0.0, 100.0, size=2000).astype(np.float32)
+    largest = np.finfo(np.float32).max
+    threshold = np.concatenate(
+        [
+            rng.normal(0.0, 100.0, size=2000),
+            # Exactly on float32 values and in the gaps right next to them
+            x.astype(np.float64),
+            np.nextafter(x.astype(np.float64), np.inf),
+            np.nextafter(x.astype(np.float64), -np.inf),
+            # Beyond the float32 range
+            [float(largest) * 2, -float(largest) * 2, 0.0, -0.0],
+        ]
+    )
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        narrowed = forest_module._float32_thresholds(threshold)
+
+    assert narrowed.dtype == np.float32
+    assert np.isfinite(narrowed[:-3]).all()
+    assert narrowed[-4] == largest and narrowed[-3] == -np.inf
+    assert (narrowed <= threshold).all()
+    probes = np.concatenate([x, narrowed, [largest, -largest]]).astype(np.float32)
+    np.testing.assert_array_equal(
+        probes[:, np.newaxis] <= narrowed[np.newaxis, :],
+        probes[:, np.newaxis] <= threshold[np.newaxis, :],
+    )
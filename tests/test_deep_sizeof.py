@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+
+class Opaque:
+    # Like sklearn's Cython trees: no __dict__, the arrays only show through __getstate__
+    __slots__ = ["_buffer"]
+
+    def __init__(self, n):
+        self._buffer = bytearray(n)
+
+    def __getstate__(self):
+        return {"values": np.frombuffer(self._buffer, dtype=np.uint8)}
+
+
+def test_deep_sizeof_counts_buffers_once(step_module):
+    cache = step_module("deployment", "cache")
+    array = np.zeros(10000)
+    baseline = cache.deep_sizeof([array])
+
+    # Views of a counted array add their header, not the buffer again
+    assert cache.deep_sizeof([array, array[::2], array[:10]]) < baseline + 1000
+    assert cache.deep_sizeof({"model": array}) >= array.nbytes
+    assert 50000 <= cache.deep_sizeof(Opaque(50000)) < 51000
+
+
+def test_deep_sizeof_sees_sklearn_trees(step_module):
+    tree = pytest.importorskip("sklearn.tree")
+    cache = step_module("deployment", "cache")
+    rng = np.random.default_rng(0)
+    model = tree.DecisionTreeClassifier(random_state=0).fit(
+        rng.random((2000, 5)), rng.random(2000) > 0.5
+    )
+    state = model.tree_.__getstate__()
+
+    assert cache.deep_sizeof(model) >= state["nodes"].nbytes + state["values"].nbytes
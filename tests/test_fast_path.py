@@ -0,0 +1,13 @@
+def test_fast_path_needs_passed_export(step_module, tmp_path, monkeypatch):
+    score = step_module("deployment", "score")
+    monkeypatch.setattr(score, "supports_fast_path", lambda model: True)
+    model_path = tmp_path / "model.pkl"
+    model_path.write_bytes(b"pickled forest")
+
+    # Trainers leave out model_compiled.npz when the export disagreed with sktime
+    entry = score.ScoringModel("default", object(), "pickle", str(model_path), 10)
+    assert not entry.supports_fast_path
+
+    (tmp_path / score.COMPILED_MODEL_FILENAME).write_bytes(b"")
+    entry = score.ScoringModel("default", object(), "pickle", str(model_path), 10)
+    assert entry.supports_fast_path
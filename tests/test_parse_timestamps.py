@@ -0,0 +1,96 @@
+import json
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+FOLDERS = ["deployment", "preprocess", "train"]
+
+TIMESTAMPS = {
+    "2020-06-28 11:33:00+02:00": "2020-06-28T09:33:00",
+    "2020-06-28T11:33:00+0200": "2020-06-28T09:33:00",
+    "2020-06-28T11:33:00+02": "2020-06-28T09:33:00",
+    "2020-06-28T11:33+02:00": "2020-06-28T09:33:00",
+    "2020-06-28T11:33-0130": "2020-06-28T13:03:00",
+    "2020-06-28T00:10:00+01": "2020-06-27T23:10:00",
+    "2020-06-28T11:33:05.123456Z": "2020-06-28T11:33:05",
+    "2020-06-28T11:33:05.1-05:00": "2020-06-28T16:33:05",
+    "2020-06-28T11:33Z": "2020-06-28T11:33:00",
+    "2020-06-28T11:33": "2020-06-28T11:33:00",
+    "2020-06-28 11:33:05": "2020-06-28T11:33:05",
+}
+
+INVALID = [
+    "NaT",
+    "2020-06-28",
+    "2020-06-28X11:33:00",
+    "2020-06-28T11:33:",
+    "2020-06-28T11:33:0Z",
+    "2020-06-28T11:33:00.Z",
+    "2020-06-28T11:33:00z",
+    "2020-06-28T11:33:00 +02:00",
+    "2020-06-28T11:33:00+2:00",
+    "2020-06-28T11:33:00+02:0",
+    "2020-06-28T11:33:00+02;00",
+    "2020-06-28T11:33:00+25:00",
+    "2020-06-28T11:33:00+02:00:00",
+]
+
+
+@pytest.mark.parametrize("folder", FOLDERS)
+def test_offsets(step_module, folder):
+    utils = step_module(folder, "utils")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        utc = utils.parse_timestamps(list(TIMESTAMPS))
+        # Every timestamp on its own, as its length changes how it is sliced
+        single = [utils.parse_timestamps([timestamp])[0] for timestamp in TIMESTAMPS]
+
+    expected = np.array(list(TIMESTAMPS.values()), dtype="datetime64[s]")
+    np.testing.assert_array_equal(utc, expected)
+    np.testing.assert_array_equal(single, expected)
+
+
+@pytest.mark.parametrize("folder", FOLDERS)
+@pytest.mark.parametrize("timestamp", INVALID)
+def test_invalid(step_module, folder, timestamp):
+    utils = step_module(folder, "utils")
+    with pytest.raises(ValueError):
+        utils.parse_timestamps(["2020-06-28T11:33:00Z", timestamp])
+
+
+def series_documents(lengths, seed=0):
+    rng = np.random.RandomState(seed)
+    return [
+        {
+            "granularity": "minutely",
+            "series": json.dumps(
+                [
+                    {"timestamp": f"2020-06-28T11:{minute:02d}:00+0200", "value": value}
+                    for minute, value in enumerate(rng.uniform(240, 265, length))
+                ]
+            ),
+        }
+        for length in lengths
+    ]
+
+
+def test_prepare_dataframe_reads_series(step_module):
+    documents = series_documents([5, 12, 30, 9, 10])
+    preprocess = step_module("preprocess", "utils")
+    expected, _ = preprocess.ragged_to_panel(
+        preprocess.decode_series(documents, keep_last=10, n_workers=1),
+        time_series_length=10,
+    )
+
+    utils = step_module("train", "utils")
+    df_nested, panel = utils.prepare_dataframe(
+        pd.DataFrame(documents), time_series_length=10, threshold=250, n_workers=1
+    )
+
+    np.testing.assert_array_equal(panel, expected)
+    np.testing.assert_array_equal(
+        utils.nested_to_panel(df_nested.drop(columns="label")), expected
+    )
+    np.testing.assert_array_equal(df_nested["label"], utils.panel_labels(expected, 250))
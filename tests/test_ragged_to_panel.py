@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def dataframe_to_long(df, size):
+    # The iterrows generator 01_raw_to_long.py and prepare_dataframe used before ragged_to_panel
+    case_id = 0
+    for _, case in df.iterrows():
+        events = case["allevents"]
+
+        # We ignore cases with insufficient readings
+        if len(events) < size:
+            continue
+
+        # We also slice samples with too many readings ([-size:])
+        for reading_id, values in enumerate(events[-size:]):
+            yield case_id, 0, reading_id, values["temperature"]
+
+        case_id += 1  # can't use the row index because we skip rows.
+
+
+def raw_allevents(lengths, seed=0):
+    rng = np.random.RandomState(seed)
+    return [
+        json.dumps(
+            [
+                {
+                    "temperature": float(temperature),
+                    "timeCreated": f"2020-04-07T05:51:{second % 60:02d}Z",
+                    "ConnectionDeviceId": "dev1",
+                }
+                for second, temperature in enumerate(rng.uniform(240, 265, length))
+            ]
+        )
+        for length in lengths
+    ]
+
+
+def legacy_panel(raw, time_series_length):
+    df = pd.DataFrame({"allevents": [json.loads(events) for events in raw]})
+    df_long = pd.DataFrame(
+        dataframe_to_long(df, size=time_series_length),
+        columns=["case_id", "dim_id", "reading_id", "value"],
+    )
+    n_cases = df_long["case_id"].nunique()
+    panel = np.full((n_cases, 1, time_series_length), np.nan)
+    panel[df_long["case_id"], df_long["dim_id"], df_long["reading_id"]] = df_long[
+        "value"
+    ]
+    return panel
+
+
+@pytest.mark.parametrize("folder", ["preprocess", "train"])
+@pytest.mark.parametrize(
+    "chunk_size, n_workers", [(10000, 1), (3, 1), (4, 2)], ids=["one", "chunks", "pool"]
+)
+def test_matches_iterrows_generator(step_module, folder, chunk_size, n_workers):
+    utils = step_module(folder, "utils")
+    time_series_length = 10
+    lengths = [5, 10, 30, 31, 0, 9, 11, 10, 1, 30, 31, 5]
+    raw = raw_allevents(lengths)
+
+    decoded = utils.decode_allevents(
+        raw,
+        keep_last=time_series_length,
+        chunk_size=chunk_size,
+        n_workers=n_workers,
+    )
+    panel, case_index = utils.ragged_to_panel(
+        decoded, time_series_length=time_series_length
+    )
+
+    np.testing.assert_array_equal(panel, legacy_panel(raw, time_series_length))
+    np.testing.assert_array_equal(
+        case_index, np.flatnonzero(np.asarray(lengths) >= time_series_length)
+    )
+
+
+@pytest.mark.parametrize("folder", ["preprocess", "train"])
+def test_no_case_long_enough(step_module, folder):
+    utils = step_module(folder, "utils")
+    decoded = utils.decode_allevents(raw_allevents([5, 9]), keep_last=10, n_workers=1)
+    panel, case_index = utils.ragged_to_panel(decoded, time_series_length=10)
+
+    assert panel.shape == (0, 1, 10)
+    assert len(case_index) == 0
+
+
+@pytest.mark.parametrize("folder", ["preprocess", "train"])
+def test_rejects_events_decoded_too_short(step_module, folder):
+    utils = step_module(folder, "utils")
+    decoded = utils.decode_allevents(raw_allevents([30]), keep_last=5, n_workers=1)
+    with pytest.raises(ValueError):
+        utils.ragged_to_panel(decoded, time_series_length=10)
@@ -0,0 +1,158 @@
+import json
+
+import pytest
+
+from conftest import WINDOW_LENGTH
+
+
+class Request:
+    # The parts of AMLRequest, a flask Request, that score.run reads
+    def __init__(self, body, content_type=None, method="POST"):
+        self.method = method
+        self.headers = {} if content_type is None else {"Content-Type": content_type}
+        self.body = body
+
+    def get_data(self, cache=True):
+        return self.body
+
+
+class Response:
+    def __init__(self, message, status_code, response_headers=None, json_str=False):
+        self.body = message
+        self.status_code = status_code
+        self.headers = dict(response_headers or {})
+        if json_str:
+            self.headers["Content-Type"] = "application/json"
+
+
+@pytest.fixture
+def raw_score(score, monkeypatch):
+    monkeypatch.setattr(score, "AMLResponse", Response)
+    return score
+
+
+def payload(temperature, device_id="dev1"):
+    return {
+        "ConnectionDeviceId": device_id,
+        "allevents": [
+            {"temperature": temperature, "timeCreated": f"2020-04-07T05:51:{i:02d}Z"}
+            for i in range(WINDOW_LENGTH)
+        ],
+    }
+
+
+def test_json_request_matches_string(raw_score):
+    body = json.dumps([payload(245.0), payload(255.0)])
+    response = raw_score.run(Request(body.encode(), "application/json; charset=utf-8"))
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/json"
+    assert json.loads(response.body) == raw_score.run(body)
+
+
+def test_missing_content_type_is_json(raw_score):
+    response = raw_score.run(Request(json.dumps(payload(255.0)).encode()))
+
+    assert response.status_code == 200
+    assert json.loads(response.body)["result"] is True
+
+
+def test_float32_request(raw_score, step_module):
+    encoding = step_module("deployment", "encoding")
+    body = encoding.encode_frame(
+        [245.0] * WINDOW_LENGTH, "dev1"
+    ) + encoding.encode_frame([255.0] * WINDOW_LENGTH, "dev2")
+    response = raw_score.run(Request(body, encoding.FLOAT32))
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == encoding.FLOAT32
+    records = encoding.decode_records(response.body)
+    assert [record["result"] for record in records] == [False, True]
+    assert [record["ConnectionDeviceId"] for record in records] == ["dev1", "dev2"]
+
+
+def test_msgpack_request(raw_score):
+    msgpack = pytest.importorskip("msgpack")
+    body = msgpack.packb(payload(255.0))
+    response = raw_score.run(Request(body, "application/x-msgpack"))
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert msgpack.unpackb(response.body, raw=False)["result"] is True
+
+
+def test_invalid_body_is_json_error(raw_score):
+    response = raw_score.run(Request(b"\x00\x01", "application/x-freezer-float32"))
+
+    assert response.status_code == 400
+    assert response.headers["Content-Type"] == "application/json"
+    assert (
+        "Invalid application/x-freezer-float32 body"
+        in json.loads(response.body)["error"]
+    )
+
+
+def test_get_is_rejected(raw_score):
+    assert raw_score.run(Request(b"", method="GET")).status_code == 405
+
+
+def test_handler_failures_are_json_errors(raw_score, step_module):
+    encoding = step_module("deployment", "encoding")
+    body = encoding.encode_frame([255.0] * WINDOW_LENGTH, "dev1")
+
+    def fail(data):
+        raise KeyError("model")
+
+    status, _, content_type = raw_score.handle_request(body, encoding.FLOAT32, fail)
+    assert (status, content_type) == (500, "application/json")
+
+    # Responses a FLOAT32 record can't hold fail like any other error
+    def long_device_id(data):
+        return dict(raw_score.handle_payload(data)[0], ConnectionDeviceId="d" * 2**16)
+
+    status, body, content_type = raw_score.handle_request(
+        body, encoding.FLOAT32, long_device_id
+    )
+    assert (status, content_type) == (500, "application/json")
+    assert "ConnectionDeviceId" in json.loads(body)["error"]
+
+
+def test_long_error_messages_are_cut_off(step_module):
+    encoding = step_module("deployment", "encoding")
+    response = {
+        "result": None,
+        "ConnectionDeviceId": "dev1",
+        "timeCreatedStart": "",
+        "timeCreatedEnd": "",
+        "hasError": True,
+        "errorMessage": "é" * 2**16,
+    }
+
+    (record,) = encoding.decode_records(encoding.encode_records([response]))
+
+    assert record["errorMessage"] == "é" * (encoding.MAX_FIELD_BYTES // 2)
+    with pytest.raises(ValueError):
+        encoding.encode_frame([1.0], "d" * 2**16)
+
+
+def test_loadtest_skips_payloads_float32_cant_carry(score, step_module):
+    loadtest = step_module("deployment", "loadtest")
+    payloads = loadtest.generate_payloads(200, invalid_fraction=0.5)
+    conflicting = [
+        payload
+        for payload in payloads
+        if len(
+            {
+                event.get("ConnectionDeviceId")
+                for event in json.loads(payload)["allevents"]
+            }
+            - {None}
+        )
+        > 1
+    ]
+
+    encodable = loadtest.encodable_payloads(payloads, "application/x-freezer-float32")
+
+    assert conflicting
+    assert sorted(encodable + conflicting) == sorted(payloads)
+    assert loadtest.encodable_payloads(payloads, "application/json") == payloads
@@ -0,0 +1,117 @@
+import numpy as np
+
+# Two partitions of raw rows, one case each. Stream Analytics keeps adding to the last one.
+EARLIER = [f'[{{"temperature": {i}}}]' for i in range(4)]
+WATERMARK = [f'[{{"temperature": {i}}}]' for i in range(100, 105)]
+
+
+def panel_metadata(partitions):
+    return {
+        "partitions": list(partitions),
+        "partition_cases": [len(rows) for rows in partitions.values()],
+    }
+
+
+def test_new_rows_survive_reordered_watermark_partition(step_module):
+    preprocess = step_module("preprocess", "utils")
+    trained = {"2020-06-27": EARLIER, "2020-06-28": WATERMARK}
+    trained_digests = preprocess.case_digests(EARLIER + WATERMARK)
+    train = step_module("train", "utils")
+    seen = train.watermark_case_digests(panel_metadata(trained), trained_digests)
+
+    # Late rows land in the middle of the watermark partition, which comes back in another order,
+    # and a new partition follows
+    late = ['[{"temperature": 200}]', '[{"temperature": 201}]']
+    watermark = WATERMARK[3:] + [late[0]] + WATERMARK[:3] + [late[1]]
+    partitions = {
+        "2020-06-27": EARLIER,
+        "2020-06-28": watermark,
+        "2020-06-29": ['[{"temperature": 300}]'],
+    }
+    rows_in_order = [row for rows in partitions.values() for row in rows]
+    rows = train.new_rows(
+        panel_metadata(partitions),
+        preprocess.case_digests(rows_in_order),
+        watermark="2020-06-28",
+        seen_digests=seen,
+    )
+
+    assert [rows_in_order[row] for row in rows] == late + ['[{"temperature": 300}]']
+
+
+def test_watermark_digests_accumulate_within_partition(step_module):
+    preprocess = step_module("preprocess", "utils")
+    train = step_module("train", "utils")
+    metadata = panel_metadata({"2020-06-28": WATERMARK[:2]})
+    first = train.watermark_case_digests(
+        metadata, preprocess.case_digests(WATERMARK[:2])
+    )
+    # A warm start that only saw the last rows still knows about the first ones
+    metadata = panel_metadata({"2020-06-28": WATERMARK[2:]})
+    second = train.watermark_case_digests(
+        metadata,
+        preprocess.case_digests(WATERMARK[2:]),
+        previous_state={"watermark": "2020-06-28"},
+        seen=first,
+    )
+    np.testing.assert_array_equal(second, np.unique(preprocess.case_digests(WATERMARK)))
+
+    # A new watermark partition starts over
+    metadata = panel_metadata({"2020-06-28": WATERMARK, "2020-06-29": EARLIER})
+    third = train.watermark_case_digests(
+        metadata,
+        preprocess.case_digests(WATERMARK + EARLIER),
+        previous_state={"watermark": "2020-06-28"},
+        seen=second,
+    )
+    np.testing.assert_array_equal(third, np.unique(preprocess.case_digests(EARLIER)))
+
+
+def test_training_state_round_trip(step_module, tmp_path):
+    train = step_module("train", "utils")
+    assert train.load_training_state(str(tmp_path)) == (None, None)
+
+    digests = np.array([3, 1, 2], dtype=np.uint64)
+    train.save_training_state(
+        str(tmp_path),
+        time_series_length=10,
+        watermark_digests=digests,
+        threshold=180.0,
+        watermark="2020-06-28",
+    )
+    state, seen = train.load_training_state(str(tmp_path))
+
+    assert state == {
+        "time_series_length": 10,
+        "threshold": 180.0,
+        "watermark": "2020-06-28",
+    }
+    np.testing.assert_array_equal(seen, digests)
+
+
+def test_full_parse_records_partitions(step_module, tmp_path):
+    raw_to_long = step_module("preprocess", "01_raw_to_long")
+    row_partitions = ["2020-06-27"] * 3 + ["2020-06-28"] * 4
+    # Rows that decode to no case are left out of the panel
+    case_index = np.array([0, 2, 3, 4, 6])
+
+    assert raw_to_long.partition_metadata(row_partitions, case_index) == {
+        "partitions": ["2020-06-27", "2020-06-28"],
+        "partition_cases": [2, 3],
+    }
+
+    preprocess = step_module("preprocess", "utils")
+    rows = EARLIER[:3] + WATERMARK[:4]
+    preprocess.save_panel(
+        str(tmp_path),
+        np.zeros((len(case_index), 1, 10)),
+        case_index,
+        digests=preprocess.case_digests(rows)[case_index],
+        **raw_to_long.partition_metadata(row_partitions, case_index),
+    )
+    artifact = step_module("train", "utils").load_panel(str(tmp_path))
+
+    np.testing.assert_array_equal(
+        artifact.case_digests, preprocess.case_digests(rows)[case_index]
+    )
+    assert artifact.metadata["partition_cases"] == [2, 3]